@@ -0,0 +1,151 @@
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from router_utils import download_file  # noqa: E402
+
+
+class _Server:
+    """Local stand-in for Geofabrik: ranges, If-Range, ETag, md5 sidecar and dropped connections"""
+
+    def __init__(self):
+        self.data = os.urandom(300000)
+        self.etag = '"v1"'
+        self.honour_if_range = True
+        self.drops = 0
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                data = server.data
+                server.requests.append((self.path, self.headers.get("Range"), self.headers.get("If-Range")))
+                if self.path.endswith(".md5"):
+                    body = f"{hashlib.md5(data).hexdigest()}  file.osm.pbf\n".encode()
+                    self.send_response(200)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+                start = 0
+                range_ = self.headers.get("Range")
+                if_range = self.headers.get("If-Range")
+                if range_ and (not server.honour_if_range or if_range in (None, server.etag)):
+                    start = int(range_.split("=")[1].split("-")[0])
+                    if start >= len(data):
+                        self.send_response(416)
+                        self.send_header("Content-Range", f"bytes */{len(data)}")
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+                else:
+                    self.send_response(200)
+                self.send_header("ETag", server.etag)
+                self.send_header("Content-Length", str(len(data) - start))
+                self.end_headers()
+                if server.drops > 0:
+                    server.drops -= 1
+                    self.wfile.write(data[start:start + 100000])
+                    self.wfile.flush()
+                    self.connection.close()
+                    return
+                self.wfile.write(data[start:])
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/file.osm.pbf"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def downloads(self):
+        """Range and If-Range of the file requests since the last call"""
+        requests = [(range_, if_range) for path, range_, if_range in self.requests if not path.endswith(".md5")]
+        self.requests = []
+        return requests
+
+
+class DownloadFileTest(unittest.TestCase):
+    def setUp(self):
+        self.server = _Server()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "file.osm.pbf")
+
+    def tearDown(self):
+        self.server.httpd.shutdown()
+        self.server.httpd.server_close()
+        shutil.rmtree(self.directory)
+
+    def download(self):
+        return download_file(self.server.url, self.path, chunk_size=16384, backoff=0)
+
+    def write_part(self, data, validator):
+        with open(self.path + ".part", "wb") as f:
+            f.write(data)
+        with open(self.path + ".part.validator", "w") as f:
+            f.write(validator)
+
+    def assertDownloaded(self):
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), self.server.data)
+        self.assertFalse(os.path.exists(self.path + ".part"))
+        self.assertFalse(os.path.exists(self.path + ".part.validator"))
+
+    def test_resumes_dropped_connections(self):
+        self.server.drops = 2
+        self.download()
+        self.assertDownloaded()
+        requests = self.server.downloads()
+        self.assertEqual(len(requests), 3)
+        self.assertIsNone(requests[0][0])
+        self.assertTrue(all(range_ is not None and if_range == '"v1"' for range_, if_range in requests[1:]))
+
+    def test_resumes_part_file(self):
+        self.write_part(self.server.data[:50000], '"v1"')
+        self.download()
+        self.assertDownloaded()
+        self.assertEqual(self.server.downloads(), [("bytes=50000-", '"v1"')])
+
+    def test_part_file_without_validator_restarts(self):
+        with open(self.path + ".part", "wb") as f:
+            f.write(b"x" * 50000)
+        self.download()
+        self.assertDownloaded()
+        self.assertEqual(self.server.downloads(), [(None, None)])
+
+    def test_changed_file_is_sent_whole(self):
+        self.write_part(os.urandom(50000), '"v0"')
+        self.download()
+        self.assertDownloaded()
+        self.assertEqual(self.server.downloads(), [("bytes=50000-", '"v0"')])
+
+    def test_md5_mismatch_after_resume_restarts_once(self):
+        self.server.honour_if_range = False
+        self.write_part(os.urandom(50000), '"v0"')
+        self.download()
+        self.assertDownloaded()
+        self.assertEqual(self.server.downloads(), [("bytes=50000-", '"v0"'), (None, None)])
+
+    def test_416_with_complete_part(self):
+        self.write_part(self.server.data, '"v1"')
+        self.download()
+        self.assertDownloaded()
+        self.assertEqual(self.server.downloads(), [(f"bytes={len(self.server.data)}-", '"v1"')])
+
+    def test_416_with_longer_part_restarts(self):
+        self.write_part(self.server.data + b"extra", '"v1"')
+        self.download()
+        self.assertDownloaded()
+        self.assertEqual(self.server.downloads(), [(f"bytes={len(self.server.data) + 5}-", '"v1"'), (None, None)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,14 @@
+import numpy as np
 from shapely.geometry import LineString
 from shapely.geometry import Point
 from geopandas import GeoSeries
 
+try:
+    # shapely >= 2.0 builds and reads whole arrays of geometries in C
+    from shapely import linestrings as _linestrings, points as _points, get_coordinates as _get_coordinates
+except ImportError:
+    _linestrings = _points = _get_coordinates = None
+
 def latlon2linestring(lat, lon):
     """
     convert sequence of latitudes and longitudes to a geometry
@@ -13,19 +20,23 @@ def latlon2linestring(lat, lon):
     Return:
     GeoSeries: converted geometry
     """
-    return GeoSeries(LineString([[lon, lat] for lat, lon in zip(lat, lon)]))
+    return GeoSeries(LineString(np.column_stack([lon, lat])))
 
 def linestring2latlon(linestring):
     """
     convert polyline geometry to sequence of latitudes and longitudes
 
     Parameters:
-    linestring (shapely.geometry.LineString): polyline geometry
+    linestring (shapely.geometry.LineString or GeoSeries): polyline geometry,
+    e.g. from latlon2linestring
 
     Return:
     array[2, float]: array of latitudes and longitudes
     """
-    return [elem.xy for elem in t.values]
+    if isinstance(linestring, GeoSeries):
+        linestring = linestring.values[0]
+    lon, lat = linestring.xy
+    return np.array([lat, lon])
 
 def latlon2n_points(lats, lons):
     """
@@ -38,4 +49,89 @@ def latlon2n_points(lats, lons):
     Return:
     GeoSeries: converted points geometry
     """
-    return GeoSeries([Point([lat, lon]) for lat, lon in zip(lats,lons)])
+    return latlon2points(lats, lons)
+
+def latlon2points(lats, lons):
+    """
+    convert arrays of latitudes and longitudes to points in one call
+
+    Parameters:
+    lats (array[float]): latitudes
+    lons (array[float]): longitudes
+
+    Return:
+    GeoSeries: one point per coordinate
+    """
+    coords = np.column_stack([lons, lats]).astype(float)
+    if _points is not None:
+        return GeoSeries(_points(coords))
+    return GeoSeries([Point(xy) for xy in coords])
+
+def ragged2linestrings(lat, lon, offsets):
+    """
+    convert flat coordinates of many polylines to linestrings in one call,
+    e.g. the lat, lon and geometry_offsets of OSRMFramework.route_many
+
+    Parameters:
+    lat (array[float]): latitudes of all polylines, concatenated
+    lon (array[float]): longitudes of all polylines, concatenated
+    offsets (array[int]): polyline i is lat[offsets[i]:offsets[i + 1]]
+
+    Return:
+    GeoSeries: one linestring per polyline, None for polylines with less than 2 points
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    coords = np.column_stack([lon, lat]).astype(float)
+    lengths = np.diff(offsets)
+    valid = lengths >= 2
+    geometries = np.full(len(lengths), None, dtype=object)
+
+    if _linestrings is not None:
+        # coordinates of the valid polylines, labelled 0..n_valid - 1
+        keep = np.repeat(valid, lengths)
+        indices = np.repeat(np.arange(valid.sum()), lengths[valid])
+        geometries[valid] = _linestrings(coords[keep], indices=indices)
+    else:
+        for i in np.flatnonzero(valid):
+            geometries[i] = LineString(coords[offsets[i] : offsets[i + 1]])
+    return GeoSeries(geometries)
+
+def linestrings2ragged(geometries):
+    """
+    convert many linestrings back to flat coordinates, the reverse of ragged2linestrings
+
+    All coordinates are read into a single (n, 2) array in one call, lat
+    and lon are views on it.
+
+    Parameters:
+    geometries (GeoSeries): linestrings, None for missing polylines
+
+    Return:
+    lat (array[float]): latitudes of all polylines, concatenated
+    lon (array[float]): longitudes of all polylines, concatenated
+    offsets (array[int]): polyline i is lat[offsets[i]:offsets[i + 1]]
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    offsets = np.zeros(len(geometries) + 1, dtype=np.int64)
+    if _get_coordinates is not None:
+        coords, index = _get_coordinates(geometries, return_index=True)
+        np.cumsum(np.bincount(index, minlength=len(geometries)), out=offsets[1:])
+    else:
+        parts = [np.asarray(g.coords) if g is not None else np.empty((0, 2)) for g in geometries]
+        np.cumsum([len(part) for part in parts], out=offsets[1:])
+        coords = np.concatenate(parts) if len(parts) else np.empty((0, 2))
+    return coords[:, 1], coords[:, 0], offsets
+
+def points2latlon(geometries):
+    """
+    convert many points back to coordinate arrays, the reverse of latlon2points
+
+    Parameters:
+    geometries (GeoSeries): points
+
+    Return:
+    lat (array[float]): latitudes
+    lon (array[float]): longitudes
+    """
+    lat, lon, _ = linestrings2ragged(geometries)
+    return lat, lon
@@ -0,0 +1,325 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from geodesic import LocalProjection
+from lookup_store import META_FILE, save_arrays, load_arrays
+
+ARRAY_NAMES = ["features", "fares", "ids"]
+LABELS_FILE = "id_labels.npy"
+MINUTES_PER_WEEK = 7 * 24 * 60
+
+
+def _ids(ids):
+    """
+    Ids as an array that can be memory-mapped, and their labels
+
+    Integer ids become int64, strings (e.g. the keys of Kaggle's taxi fare
+    data) fixed-width unicode and other fixed-size types stay as they are,
+    all without labels. Any other ids are factorised: int64 codes into an
+    object array of the distinct ids.
+
+    Returns:
+    tuple: keys (array), labels (array[object] or None)
+    """
+    ids = np.asarray(ids)
+    if ids.dtype.kind in "iu":
+        return ids.astype(np.int64, copy=False), None
+    if ids.dtype != object:
+        return ids, None
+    if len(ids) > 0 and pd.api.types.infer_dtype(ids, skipna=False) == "string":
+        return ids.astype(str), None
+    codes, labels = pd.factorize(ids)
+    return codes.astype(np.int64, copy=False), np.asarray(labels, dtype=object)
+
+
+def _query(tree, x, k, workers):
+    """cKDTree.query in parallel, `workers` was called `n_jobs` before scipy 1.6"""
+    try:
+        return tree.query(x, k=k, workers=workers)
+    except TypeError:
+        return tree.query(x, k=k, n_jobs=workers)
+
+
+class NeighbourFareIndex:
+    """
+    Average fare of the nearest trips, without refitting a model per call
+
+    Trips are points of a 6-d space in km: pickup and dropoff projected
+    with a LocalProjection, plus the pickup time on a circle, so that
+    Sunday 23:50 is close to Monday 00:10. `km_per_hour` sets how far apart
+    trips one hour away are, the arc length between them. The points live
+    in a cKDTree built once; queries return the mean fare of several k at
+    once from a single neighbour search. Trips can be appended: they go to
+    a small second tree, merged into the main one when it grows beyond
+    `rebuild_fraction` of it.
+
+    Example:
+    index = NeighbourFareIndex.from_frame(df_train)
+    df_train['nn_avg_fare'] = index.leave_one_out(ks=[7])[7]
+    df_test['nn_avg_fare'] = index.predict_frame(df_test, ks=[7])[7]
+    # the n_neighbors sweep, in one query
+    fares = index.predict_frame(df_test, ks=range(1, 12))
+    """
+
+    def __init__(self, features, fares, lat0, lon0, ids=None, km_per_hour=1.0, rebuild_fraction=0.1):
+        """
+        Parameters:
+        features (array[float]): (n, 6) points, see `encode`
+        fares (array[float]): fare of each trip
+        lat0 (float): latitude of the projection center
+        lon0 (float): longitude of the projection center
+        ids (array): id of each trip, e.g. the DataFrame index, integers or
+        any other hashable values. Defaults to 0..n-1
+        km_per_hour (float): distance between trips one hour apart
+        rebuild_fraction (float): appended trips, as a fraction of the main
+        tree, above which the main tree is rebuilt
+        """
+        self.features = np.asarray(features, dtype=float).reshape(-1, 6)
+        self.fares = np.asarray(fares, dtype=float)
+        self._id_keys, self._id_labels = _ids(np.arange(len(self.fares)) if ids is None else ids)
+        self.km_per_hour = float(km_per_hour)
+        self.projection = LocalProjection(lat0, lon0)
+        self.rebuild_fraction = rebuild_fraction
+        self._rebuild()
+
+    @classmethod
+    def from_frame(
+        cls,
+        df,
+        target_col="fare_amount",
+        pickup_latitude="pickup_latitude",
+        pickup_longitude="pickup_longitude",
+        dropoff_latitude="dropoff_latitude",
+        dropoff_longitude="dropoff_longitude",
+        pickup_datetime_col="pickup_datetime",
+        km_per_hour=1.0,
+    ):
+        """
+        Index the trips of a DataFrame, ids are its index
+
+        Returns:
+        NeighbourFareIndex: index
+        """
+        projection = LocalProjection.around(df[pickup_latitude], df[pickup_longitude])
+        index = cls(np.empty((0, 6)), [], projection.lat0, projection.lon0, km_per_hour=km_per_hour)
+        index.append(
+            index.encode(
+                df[pickup_latitude], df[pickup_longitude], df[dropoff_latitude], df[dropoff_longitude],
+                df[pickup_datetime_col],
+            ),
+            df[target_col],
+            df.index,
+        )
+        return index
+
+    def encode(self, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, timestamps):
+        """
+        Points of trips in the index space
+
+        Parameters:
+        pickup_lat (array[float]): pickup latitudes
+        pickup_lon (array[float]): pickup longitudes
+        dropoff_lat (array[float]): dropoff latitudes
+        dropoff_lon (array[float]): dropoff longitudes
+        timestamps (array[datetime]): pickup times
+
+        Returns:
+        array[float]: (n, 6) points in km
+        """
+        pickup_x, pickup_y = self.projection.forward(pickup_lat, pickup_lon)
+        dropoff_x, dropoff_y = self.projection.forward(dropoff_lat, dropoff_lon)
+        timestamps = pd.to_datetime(pd.Series(timestamps).reset_index(drop=True))
+        minutes = timestamps.dt.dayofweek.values * (24 * 60) + timestamps.dt.hour.values * 60 + timestamps.dt.minute.values
+        angle = 2 * np.pi * minutes / MINUTES_PER_WEEK
+        # circle whose circumference is a week at km_per_hour
+        radius = self.km_per_hour * (MINUTES_PER_WEEK / 60) / (2 * np.pi)
+        return np.column_stack(
+            [pickup_x / 1000, pickup_y / 1000, dropoff_x / 1000, dropoff_y / 1000,
+             radius * np.cos(angle), radius * np.sin(angle)]
+        )
+
+    @property
+    def ids(self):
+        """Id of each trip"""
+        return self._id_keys if self._id_labels is None else self._id_labels[self._id_keys]
+
+    def _rebuild(self):
+        self._n_main = len(self.fares)
+        self._main = cKDTree(self.features)
+        self._extra = None
+
+    def append(self, features, fares, ids=None):
+        """
+        Add trips without rebuilding the whole index
+
+        Parameters:
+        features (array[float]): (n, 6) points, see `encode`
+        fares (array[float]): fare of each trip
+        ids (array): id of each trip. Defaults to the positions after the indexed trips
+        """
+        features = np.asarray(features, dtype=float).reshape(-1, 6)
+        if ids is None:
+            ids = np.arange(len(self.fares), len(self.fares) + len(features))
+        keys, labels = _ids(ids)
+        if len(self.fares) == 0:
+            self._id_keys, self._id_labels = keys, labels
+        elif self._id_labels is None and labels is None and keys.dtype.kind == self._id_keys.dtype.kind:
+            self._id_keys = np.concatenate([self._id_keys, keys])
+        else:
+            # different kinds of ids, factorised together
+            new_ids = keys if labels is None else labels[keys]
+            old_ids, new_ids = pd.Index(self.ids).astype(object), pd.Index(new_ids).astype(object)
+            self._id_keys, self._id_labels = _ids(np.concatenate([old_ids, new_ids]))
+        self.features = np.concatenate([self.features, features])
+        self.fares = np.concatenate([self.fares, np.asarray(fares, dtype=float)])
+        if len(self.fares) - self._n_main > self.rebuild_fraction * self._n_main:
+            self._rebuild()
+        else:
+            self._extra = cKDTree(self.features[self._n_main:])
+
+    def _neighbours(self, x, k, workers):
+        """Positions and distances of the k nearest trips, missing ones at position -1"""
+        k_main = min(k, self._n_main)
+        distances, positions = _query(self._main, x, max(k_main, 1), workers)
+        distances, positions = distances.reshape(len(x), -1)[:, :k_main], positions.reshape(len(x), -1)[:, :k_main]
+        if self._extra is not None:
+            k_extra = min(k, self._extra.n)
+            extra_distances, extra_positions = _query(self._extra, x, k_extra, workers)
+            distances = np.hstack([distances, extra_distances.reshape(len(x), -1)])
+            positions = np.hstack([positions, extra_positions.reshape(len(x), -1) + self._n_main])
+            order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+            rows = np.arange(len(x))[:, None]
+            distances, positions = distances[rows, order], positions[rows, order]
+        missing = k - distances.shape[1]
+        if missing > 0:
+            distances = np.hstack([distances, np.full((len(x), missing), np.inf)])
+            positions = np.hstack([positions, np.full((len(x), missing), -1)])
+        return positions, distances
+
+    def _mean_fares(self, positions, ks):
+        fares = np.where(positions >= 0, self.fares[np.maximum(positions, 0)], np.nan)
+        sums = np.nancumsum(fares, axis=1)
+        counts = np.cumsum(positions >= 0, axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return {k: sums[:, k - 1] / counts[:, k - 1] for k in ks}
+
+    def predict(self, features, ks=(7,), exclude_ids=None, workers=1, block_size=100000):
+        """
+        Mean fare of the nearest trips, for several k in one query
+
+        Parameters:
+        features (array[float]): (n, 6) query points, see `encode`
+        ks (array[int]): numbers of neighbours
+        exclude_ids (array): trip id to leave out of each query's
+        neighbours, e.g. the query trip itself. Defaults to none
+        workers (int): query processes, -1 for all cores
+        block_size (int): queries per block, bounds memory
+
+        Returns:
+        dict: k -> mean fare of each query, NaN without neighbours
+        """
+        if exclude_ids is not None and self._id_labels is not None:
+            # compare codes, ids that aren't indexed get -1 and match nothing
+            exclude_ids = pd.Index(self._id_labels).get_indexer(np.asarray(exclude_ids, dtype=object))
+        return self._predict(features, ks, self._id_keys, exclude_ids, workers, block_size)
+
+    def _predict(self, features, ks, keys, exclude, workers, block_size):
+        """`predict` leaving out, for each query, the neighbour whose key is its `exclude` value"""
+        features = np.asarray(features, dtype=float).reshape(-1, 6)
+        ks = sorted(set(ks))
+        k = ks[-1] + (exclude is not None)
+        results = {k_: np.empty(len(features)) for k_ in ks}
+        for start in range(0, len(features), block_size):
+            positions, _ = self._neighbours(features[start:start + block_size], k, workers)
+            if exclude is not None:
+                own = keys[np.maximum(positions, 0)] == np.asarray(exclude)[start:start + block_size, None]
+                own &= positions >= 0
+                # drop the first match, or the farthest neighbour if the trip is not among them
+                drop = np.where(own.any(axis=1), own.argmax(axis=1), k - 1)
+                keep = np.ones(positions.shape, dtype=bool)
+                keep[np.arange(len(positions)), drop] = False
+                positions = positions[keep].reshape(len(positions), k - 1)
+            for k_, mean in self._mean_fares(positions, ks).items():
+                results[k_][start:start + block_size] = mean
+        return results
+
+    def leave_one_out(self, ks=(7,), workers=1, block_size=100000):
+        """
+        Mean fare of the nearest trips of every indexed trip, without itself
+
+        The training counterpart of `predict`: a trip never averages its own
+        fare. Trips are told apart by position, so duplicated ids are fine.
+
+        Returns:
+        dict: k -> mean fare of each indexed trip, in index order
+        """
+        positions = np.arange(len(self.fares))
+        return self._predict(self.features, ks, positions, positions, workers, block_size)
+
+    def predict_frame(
+        self,
+        df,
+        ks=(7,),
+        pickup_latitude="pickup_latitude",
+        pickup_longitude="pickup_longitude",
+        dropoff_latitude="dropoff_latitude",
+        dropoff_longitude="dropoff_longitude",
+        pickup_datetime_col="pickup_datetime",
+        workers=1,
+    ):
+        """
+        `predict` on the trips of a DataFrame
+
+        Returns:
+        dict: k -> mean fare of each row
+        """
+        features = self.encode(
+            df[pickup_latitude], df[pickup_longitude], df[dropoff_latitude], df[dropoff_longitude],
+            df[pickup_datetime_col],
+        )
+        return self.predict(features, ks, workers=workers)
+
+    def save(self, path):
+        """
+        Save the trips as .npy files
+
+        Ids are saved as they are kept in memory, see `_ids`: the arrays
+        are memory-mapped by `load`, only the labels of factorised ids are
+        pickled and read whole.
+
+        Parameters:
+        path (str): directory, created if needed
+        """
+        save_arrays(path, {"features": self.features, "fares": self.fares, "ids": self._id_keys})
+        labels_path = os.path.join(path, LABELS_FILE)
+        if self._id_labels is not None:
+            np.save(labels_path, self._id_labels, allow_pickle=True)
+        elif os.path.exists(labels_path):
+            os.remove(labels_path)
+        with open(os.path.join(path, META_FILE), "w") as f:
+            json.dump(
+                {"km_per_hour": self.km_per_hour, "lat0": self.projection.lat0, "lon0": self.projection.lon0,
+                 "rebuild_fraction": self.rebuild_fraction},
+                f,
+            )
+
+    @classmethod
+    def load(cls, path):
+        """
+        Memory-map an index saved with `save` and rebuild its tree
+
+        Returns:
+        NeighbourFareIndex: index
+        """
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        index = cls(**load_arrays(path, ARRAY_NAMES), **meta)
+        labels_path = os.path.join(path, LABELS_FILE)
+        if os.path.exists(labels_path):
+            index._id_labels = np.load(labels_path, allow_pickle=True)
+        return index
+
+    def __len__(self):
+        return len(self.fares)
@@ -0,0 +1,342 @@
+import hashlib
+import os
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+# compact dtypes of the Kaggle NYC taxi fare CSV, about 3x smaller than the defaults
+TAXI_DTYPES = {
+    "fare_amount": "float32",
+    "pickup_longitude": "float32",
+    "pickup_latitude": "float32",
+    "dropoff_longitude": "float32",
+    "dropoff_latitude": "float32",
+    "passenger_count": "uint8",
+}
+TAXI_DATES = ["pickup_datetime"]
+
+
+def read_chunks(source, columns=None, chunksize=100000, dtypes=TAXI_DTYPES, parse_dates=TAXI_DATES):
+    """
+    Chunks of a CSV with compact dtypes, only reading the given columns
+
+    Parameters:
+    source (pandas.DataFrame, str or iterator): a DataFrame, a CSV path or an iterator of DataFrames
+    columns (array[str]): columns to read from a CSV. Defaults to all
+    chunksize (int): rows per chunk when source is a CSV path
+    dtypes (dict): column -> dtype of the CSV columns
+    parse_dates (array[str]): datetime columns of the CSV
+
+    Returns:
+    iterator[pandas.DataFrame]: chunks
+    """
+    if isinstance(source, pd.DataFrame):
+        return iter([source])
+    if not isinstance(source, str):
+        return iter(source)
+    if columns is not None:
+        columns = list(columns)
+        dtypes = {name: dtype for name, dtype in dtypes.items() if name in columns}
+        parse_dates = [name for name in parse_dates if name in columns]
+    return pd.read_csv(source, usecols=columns, dtype=dtypes, parse_dates=parse_dates, chunksize=chunksize)
+
+
+def compact(values):
+    """
+    Smaller dtype for a computed column: float32 floats, the smallest
+    integer type and categorical strings
+
+    Parameters:
+    values (pandas.Series): column
+
+    Returns:
+    pandas.Series: column with a compact dtype
+    """
+    if values.dtype == np.float64:
+        return values.astype(np.float32)
+    if values.dtype.kind in "iu":
+        return pd.to_numeric(values, downcast="integer" if values.dtype.kind == "i" else "unsigned")
+    if values.dtype == object or pd.api.types.is_string_dtype(values.dtype):
+        return values.astype("category")
+    return values
+
+
+def hash_columns(df):
+    """Content hash of DataFrame columns, index excluded"""
+    digest = hashlib.sha1()
+    for name in df.columns:
+        digest.update(str(name).encode())
+        digest.update(pd.util.hash_pandas_object(df[name], index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+class FeaturePipeline:
+    """
+    Feature columns declared as a DAG of producers, computed lazily over chunks
+
+    A step is a function of input columns returning output columns. Asking
+    for columns runs only the steps they depend on, in dependency order,
+    chunk by chunk, so the whole data set never sits in memory. Raw columns
+    are read with compact dtypes and computed ones are compacted too.
+
+    With a cache directory, the outputs of a step on a chunk are stored on
+    disk, keyed by the step name, its version, its code and a hash of its
+    input columns. Adding or changing a step only computes that step and
+    the ones below it: everything else is read back from the cache. Bump
+    `version` when a step's result changes without its code changing, e.g.
+    a model it closes over.
+
+    Example:
+    pipeline = taxi_pipeline(cache_dir='data/feature_cache')
+
+    @pipeline.step(inputs=['route_distance_km', 'fare_amount'], outputs=['price_per_km'])
+    def price_per_km(distance, fare):
+        return fare / distance
+
+    for chunk in pipeline.run('data/train.csv', ['haversine_dist_km', 'price_per_km', 'fare_amount']):
+        ...
+    df = pipeline.compute('data/taxi_fare_sample_100000.csv', ['euclidean_dist_km', 'fare_amount'])
+    """
+
+    def __init__(self, cache_dir=None):
+        """
+        Parameters:
+        cache_dir (str): directory of the memoised step outputs. Defaults to no cache
+        """
+        self.cache_dir = cache_dir
+        self.steps = OrderedDict()
+        self.producers = {}
+        self.stats = {"computed": 0, "cached": 0}
+
+    def add(self, name, func, inputs, outputs, version=0):
+        """
+        Declare a step
+
+        Parameters:
+        name (str): step name, unique
+        func (function): called with the input columns, as pandas.Series in
+        the order of `inputs`. Returns one column per output, as a
+        pandas.Series, an array or a tuple of them
+        inputs (array[str]): input columns, raw or produced by other steps
+        outputs (array[str]): columns produced
+        version (int): part of the cache key
+        """
+        for output in outputs:
+            if output in self.producers and self.producers[output] != name:
+                raise ValueError(f"column {output} is already produced by step {self.producers[output]}")
+        code = getattr(func, "__code__", None)
+        if code is not None:
+            # nested code objects are left out, their repr holds a memory address
+            constants = [value for value in code.co_consts if not hasattr(value, "co_code")]
+            code_hash = hashlib.sha1(code.co_code + repr(constants).encode()).hexdigest()
+        else:
+            code_hash = hashlib.sha1(repr(func).encode()).hexdigest()
+        self.steps[name] = {
+            "func": func,
+            "inputs": list(inputs),
+            "outputs": list(outputs),
+            "key": f"{name}:{version}:{code_hash}",
+        }
+        for output in outputs:
+            self.producers[output] = name
+
+    def step(self, inputs, outputs, name=None, version=0):
+        """Decorator version of `add`, the step is named after the function by default"""
+
+        def decorator(func):
+            self.add(name or func.__name__, func, inputs, outputs, version)
+            return func
+
+        return decorator
+
+    def plan(self, columns):
+        """
+        Steps needed for some columns, in execution order, and the raw columns they read
+
+        Parameters:
+        columns (array[str]): wanted columns
+
+        Returns:
+        steps (array[str]): step names, each after the steps it depends on
+        raw (array[str]): columns read from the source
+        """
+        order, raw, state = [], [], {}
+
+        def visit(column, path):
+            name = self.producers.get(column)
+            if name is None:
+                if column not in raw:
+                    raw.append(column)
+                return
+            if state.get(name) == "done":
+                return
+            if state.get(name) == "visiting":
+                raise ValueError(f"cycle in the feature steps: {' -> '.join(path + [name])}")
+            state[name] = "visiting"
+            for input_ in self.steps[name]["inputs"]:
+                visit(input_, path + [name])
+            state[name] = "done"
+            order.append(name)
+
+        for column in columns:
+            visit(column, [])
+        return order, raw
+
+    def _run_step(self, name, chunk):
+        step = self.steps[name]
+        inputs = chunk[step["inputs"]]
+        path = None
+        if self.cache_dir is not None:
+            key = hashlib.sha1((step["key"] + hash_columns(inputs)).encode()).hexdigest()
+            path = os.path.join(self.cache_dir, name, f"{key}.pkl")
+            if os.path.exists(path):
+                self.stats["cached"] += 1
+                outputs = pd.read_pickle(path)
+                outputs.index = chunk.index
+                return outputs
+
+        result = step["func"](*[inputs[input_] for input_ in step["inputs"]])
+        if len(step["outputs"]) == 1:
+            result = (result,)
+        outputs = pd.DataFrame(
+            OrderedDict(
+                (output, compact(pd.Series(np.asarray(values), index=chunk.index)))
+                for output, values in zip(step["outputs"], result)
+            ),
+            index=chunk.index,
+        )
+        self.stats["computed"] += 1
+        if path is not None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write then rename, so an interrupted run never leaves a partial file
+            outputs.to_pickle(path + ".tmp")
+            os.replace(path + ".tmp", path)
+        return outputs
+
+    def run(self, source, columns, where=None, chunksize=100000, dtypes=TAXI_DTYPES, parse_dates=TAXI_DATES):
+        """
+        Compute columns chunk by chunk
+
+        Parameters:
+        source (pandas.DataFrame, str or iterator): a DataFrame, a CSV path or an iterator of DataFrames
+        columns (array[str]): wanted columns, raw or produced
+        where (str): boolean column, only rows where it is True are returned
+        chunksize (int): rows per chunk when source is a CSV path
+        dtypes (dict): column -> dtype of the CSV columns
+        parse_dates (array[str]): datetime columns of the CSV
+
+        Returns:
+        iterator[pandas.DataFrame]: chunks with the wanted columns
+        """
+        wanted = list(columns) + ([where] if where is not None and where not in columns else [])
+        steps, raw = self.plan(wanted)
+        for chunk in read_chunks(source, raw, chunksize, dtypes, parse_dates):
+            chunk = chunk[raw]
+            for name in steps:
+                outputs = self._run_step(name, chunk)
+                chunk = pd.concat([chunk, outputs], axis=1)
+            if where is not None:
+                chunk = chunk.loc[chunk[where].values.astype(bool)]
+            yield chunk[list(columns)]
+
+    def compute(self, source, columns, where=None, chunksize=100000, dtypes=TAXI_DTYPES, parse_dates=TAXI_DATES):
+        """
+        `run` collected in a single DataFrame
+
+        Returns:
+        pandas.DataFrame: wanted columns
+        """
+        chunks = list(self.run(source, columns, where, chunksize, dtypes, parse_dates))
+        if not chunks:
+            return pd.DataFrame(columns=list(columns))
+        df = pd.concat(chunks)
+        # chunks have different categories, concat falls back to strings
+        for name in columns:
+            if all(chunk[name].dtype.name == "category" for chunk in chunks):
+                df[name] = pd.Series(union_categoricals([chunk[name] for chunk in chunks]), index=df.index)
+        return df
+
+
+def _h3_cells(lat, lon, resolution):
+    """H3 cells, None for missing coordinates"""
+    from hexagons import cells
+
+    valid = np.isfinite(lat) & np.isfinite(lon)
+    result = np.full(len(lat), None, dtype=object)
+    result[valid] = cells(lat[valid], lon[valid], resolution)
+    return result
+
+
+def taxi_pipeline(cache_dir=None, utm_zone=18, h3_resolution=7):
+    """
+    FeaturePipeline with the distance and time features of the workshop
+
+    Columns produced: pickup/dropoff_easting/northing (UTM, meters),
+    euclidean_dist_km, manhattan_dist_km, haversine_dist_km,
+    minutes_since_monday_midnight, pickup_h3, dropoff_h3 and valid, True
+    for rows without missing values nor zero length trips.
+
+    Parameters:
+    cache_dir (str): directory of the memoised step outputs
+    utm_zone (int): UTM zone of the projected coordinates, 18 for New York
+    h3_resolution (int): resolution of the H3 cells
+
+    Returns:
+    FeaturePipeline: pipeline, more steps can be added to it
+    """
+    from geodesic import LocalProjection, haversine
+
+    pipeline = FeaturePipeline(cache_dir)
+    projection = LocalProjection(0, 0, utm_zone=utm_zone)
+
+    for point in ["pickup", "dropoff"]:
+        pipeline.add(
+            f"{point}_utm",
+            lambda lat, lon: projection.forward(lat.values, lon.values),
+            [f"{point}_latitude", f"{point}_longitude"],
+            [f"{point}_easting", f"{point}_northing"],
+            version=utm_zone,
+        )
+        pipeline.add(
+            f"{point}_h3",
+            lambda lat, lon: _h3_cells(lat.values, lon.values, h3_resolution),
+            [f"{point}_latitude", f"{point}_longitude"],
+            [f"{point}_h3"],
+            version=h3_resolution,
+        )
+
+    projected = ["pickup_easting", "pickup_northing", "dropoff_easting", "dropoff_northing"]
+    pipeline.add(
+        "euclidean_dist_km",
+        lambda x1, y1, x2, y2: np.hypot(x2.values.astype(float) - x1.values, y2.values.astype(float) - y1.values) / 1000,
+        projected,
+        ["euclidean_dist_km"],
+    )
+    pipeline.add(
+        "manhattan_dist_km",
+        lambda x1, y1, x2, y2: (np.abs(x2.values.astype(float) - x1.values) + np.abs(y2.values.astype(float) - y1.values)) / 1000,
+        projected,
+        ["manhattan_dist_km"],
+    )
+    pipeline.add(
+        "haversine_dist_km",
+        lambda lat1, lon1, lat2, lon2: haversine(lat1.values, lon1.values, lat2.values, lon2.values),
+        ["pickup_latitude", "pickup_longitude", "dropoff_latitude", "dropoff_longitude"],
+        ["haversine_dist_km"],
+    )
+    pipeline.add(
+        "minutes_since_monday_midnight",
+        lambda t: t.dt.dayofweek * (24 * 60) + t.dt.hour * 60 + t.dt.minute,
+        ["pickup_datetime"],
+        ["minutes_since_monday_midnight"],
+    )
+    pipeline.add(
+        "valid",
+        lambda lat1, lon1, lat2, lon2, distance: (
+            pd.concat([lat1, lon1, lat2, lon2], axis=1).notnull().all(axis=1) & (distance > 0)
+        ),
+        ["pickup_latitude", "pickup_longitude", "dropoff_latitude", "dropoff_longitude", "haversine_dist_km"],
+        ["valid"],
+    )
+    return pipeline
@@ -0,0 +1,331 @@
+import heapq
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+from helpers import routes_to_columns
+
+EARTH_RADIUS_M = 6367000  # same radius as helpers.np_distance_haversine
+
+
+def _speed_kmh(maxspeed, default_speed):
+    """Best effort conversion of a maxspeed value set by RouteAnnotator.add_speeds"""
+    if isinstance(maxspeed, list):
+        maxspeed = maxspeed[0]
+    try:
+        speed = float(maxspeed)
+    except (TypeError, ValueError):
+        return default_speed
+    return speed if speed > 0 else default_speed
+
+
+class GraphRouter:
+    """
+    Offline router over the street graph downloaded by RouteAnnotator
+
+    The graph is stored as CSR arrays (one forward, one backward) so queries
+    don't go through networkx nor HTTP. Point to point queries use
+    bidirectional Dijkstra. Queries from the same origin reuse the forward
+    search: the search is resumed from where the previous query stopped
+    instead of starting over, which makes one-to-many batches cheap.
+
+    Results have the same shape as OSRMFramework.route, so both can be used
+    interchangeably, e.g. in tests or when no OSRM container is available.
+
+    Example:
+    ra = RouteAnnotator('new york, USA', 'drive_service')
+    ra.build_lookups()
+    router = GraphRouter.from_route_annotator(ra)
+    lat, lon, distance, duration, osm_node_ids = router.route(40.732605, -73.996070, 40.761864, -73.980675)
+    """
+
+    def __init__(self, G, default_speed=25):
+        """
+        Parameters:
+        G (networkx.MultiDiGraph): OSMnx street graph. Edges need `length`
+        (meters) and either `travel_time` (seconds) or `maxspeed` (km/h)
+        default_speed (float): km/h used for edges without a usable maxspeed
+        """
+        self.node_ids = np.array(sorted(G.nodes), dtype=np.int64)
+        node_ix = {node: ix for ix, node in enumerate(self.node_ids.tolist())}
+        self.node_lat = np.array([G.nodes[node]["y"] for node in self.node_ids.tolist()], dtype=float)
+        self.node_lon = np.array([G.nodes[node]["x"] for node in self.node_ids.tolist()], dtype=float)
+
+        edges = list(G.edges(data=True))
+        edge_from = np.array([node_ix[u] for u, v, data in edges], dtype=np.int64)
+        edge_to = np.array([node_ix[v] for u, v, data in edges], dtype=np.int64)
+        edge_length = np.array([data["length"] for u, v, data in edges], dtype=float)
+        if all("travel_time" in data for u, v, data in edges):
+            edge_duration = np.array([data["travel_time"] for u, v, data in edges], dtype=float)
+        else:
+            speeds = [_speed_kmh(data.get("maxspeed"), default_speed) for u, v, data in edges]
+            edge_duration = edge_length / (np.array(speeds, dtype=float) / 3.6)
+
+        # forward CSR: edges sorted by origin node. Edge ids below are
+        # positions in this order
+        order = np.argsort(edge_from, kind="stable")
+        self.edge_from = edge_from[order]
+        self.edge_to = edge_to[order]
+        self.edge_length = edge_length[order]
+        self.edge_duration = edge_duration[order]
+        n_nodes = len(self.node_ids)
+        self.indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.edge_from, minlength=n_nodes), out=self.indptr[1:])
+
+        # backward CSR: edge ids sorted by destination node
+        self.reverse_edges = np.argsort(self.edge_to, kind="stable")
+        self.reverse_indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.edge_to, minlength=n_nodes), out=self.reverse_indptr[1:])
+
+        # plain lists are much faster than numpy scalars inside the search loops
+        self._forward = (self.indptr.tolist(), self.edge_to.tolist(), list(range(len(order))))
+        self._backward = (
+            self.reverse_indptr.tolist(),
+            self.edge_from[self.reverse_edges].tolist(),
+            self.reverse_edges.tolist(),
+        )
+        self._duration = self.edge_duration.tolist()
+
+        # nodes projected to a local equirectangular plane for snapping
+        self._lat0 = np.radians(np.mean(self.node_lat)) if n_nodes else 0.0
+        self._node_tree = cKDTree(self._project(self.node_lat, self.node_lon))
+
+        self._search = None
+        self._csgraph = None
+
+    @classmethod
+    def from_route_annotator(cls, route_annotator, default_speed=25):
+        """
+        Build the router from the graph of a RouteAnnotator
+
+        Parameters:
+        route_annotator (RouteAnnotator): annotator after `build_lookups`
+        default_speed (float): km/h used for edges without a usable maxspeed
+
+        Returns:
+        GraphRouter: router
+        """
+        return cls(route_annotator.G, default_speed=default_speed)
+
+    def _project(self, lat, lon):
+        lat, lon = np.radians(lat), np.radians(lon)
+        return np.column_stack([EARTH_RADIUS_M * lon * np.cos(self._lat0), EARTH_RADIUS_M * lat])
+
+    def snap(self, lat, lon):
+        """
+        Get the closest graph node of each point
+
+        Parameters:
+        lat (array[float]): latitudes
+        lon (array[float]): longitudes
+
+        Returns:
+        array[int]: node positions in `node_ids`
+        """
+        _, ix = self._node_tree.query(self._project(np.atleast_1d(lat), np.atleast_1d(lon)))
+        return ix
+
+    def route(self, lat1, lon1, lat2, lon2):
+        """
+        Get route between two points
+
+        Both points are snapped to their closest graph node and the fastest
+        path is found with bidirectional Dijkstra.
+
+        Parameters:
+        lat1 (float): pick-up latitude
+        lon1 (float): pick-up longitude
+        lat2 (float): dropoff latitude
+        lon2 (float): dropoff longitude
+
+        Returns:
+        lat (array[float]): latitudes of the route points
+        lon (array[float]): longitude of the route points
+        distance (float): route distance in meters
+        duration (float): route duration in seconds
+        osm_node_ids (array[int]): OSM node ids that are part of the route
+        All NaN if there is no path between the points
+        """
+        source, target = self.snap([lat1, lat2], [lon1, lon2])
+        edges = self._bidirectional_dijkstra(source, target)
+        return self._route_result(source, edges)
+
+    def route_many(self, lat1, lon1, lat2, lon2, df=None):
+        """
+        Get routes between many pick-ups and dropoffs
+
+        Trips are grouped by snapped origin, so all trips leaving from the same
+        node are answered by a single forward search.
+
+        Parameters:
+        lat1 (array[float] or str): pick-up latitudes, or column name if `df` is given
+        lon1 (array[float] or str): pick-up longitudes, or column name if `df` is given
+        lat2 (array[float] or str): dropoff latitudes, or column name if `df` is given
+        lon2 (array[float] or str): dropoff longitudes, or column name if `df` is given
+        df (pandas.DataFrame): optional frame holding the coordinates
+
+        Returns:
+        dict, in input order, with the same columns as OSRMFramework.route_many
+        """
+        if df is not None:
+            lat1, lon1, lat2, lon2 = [df[col].values for col in [lat1, lon1, lat2, lon2]]
+        sources = self.snap(lat1, lon1)
+        targets = self.snap(lat2, lon2)
+
+        results = [None] * len(sources)
+        for trip in np.argsort(sources, kind="stable"):
+            edges = self._forward_search(sources[trip], targets[trip])
+            results[trip] = self._route_result(sources[trip], edges)
+        return routes_to_columns(results)
+
+    def route_one_to_many(self, lat, lon, destinations_lat, destinations_lon):
+        """
+        Get routes from one origin to many destinations with a single search
+
+        Parameters:
+        lat (float): origin latitude
+        lon (float): origin longitude
+        destinations_lat (array[float]): destinations' latitudes
+        destinations_lon (array[float]): destinations' longitudes
+
+        Returns:
+        dict, in destination order, with the same columns as OSRMFramework.route_many
+        """
+        source = self.snap(lat, lon)[0]
+        targets = self.snap(destinations_lat, destinations_lon)
+        return routes_to_columns([self._route_result(source, self._forward_search(source, t)) for t in targets])
+
+    def reachable(self, source, max_duration):
+        """
+        Travel time from a node to every node reachable within max_duration
+
+        Runs a single Dijkstra bounded by max_duration, so all thresholds up
+        to it can be answered from the same search (e.g. isochrones).
+
+        Parameters:
+        source (int): node position in `node_ids`, e.g. from `snap`
+        max_duration (float): seconds
+
+        Returns:
+        nodes (array[int]): positions in `node_ids` of the reached nodes
+        durations (array[float]): seconds to reach each node
+        """
+        if self._csgraph is None:
+            # parallel edges would be summed by the sparse matrix: keep the
+            # fastest one. Zero weights would be read as missing edges
+            keys = self.edge_from * len(self.node_ids) + self.edge_to
+            order = np.lexsort([self.edge_duration, keys])
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = keys[order][1:] != keys[order][:-1]
+            fastest = order[first]
+            self._csgraph = csr_matrix(
+                (
+                    np.maximum(self.edge_duration[fastest], 1e-6),
+                    (self.edge_from[fastest], self.edge_to[fastest]),
+                ),
+                shape=(len(self.node_ids), len(self.node_ids)),
+            )
+        durations = dijkstra(self._csgraph, indices=source, limit=max_duration)
+        nodes = np.flatnonzero(np.isfinite(durations))
+        return nodes, durations[nodes]
+
+    def _route_result(self, source, edges):
+        if edges is None:
+            return np.nan, np.nan, np.nan, np.nan, np.nan
+        nodes = np.concatenate([[source], self.edge_to[edges]]).astype(np.int64)
+        return (
+            self.node_lat[nodes].tolist(),
+            self.node_lon[nodes].tolist(),
+            float(self.edge_length[edges].sum()),
+            float(self.edge_duration[edges].sum()),
+            self.node_ids[nodes].tolist(),
+        )
+
+    def _bidirectional_dijkstra(self, source, target):
+        """Edge ids of the fastest path from source to target, None if unreachable"""
+        if source == target:
+            return np.array([], dtype=np.int64)
+
+        dist = ({source: 0.0}, {target: 0.0})
+        pred = ({source: -1}, {target: -1})
+        settled = (set(), set())
+        heaps = ([(0.0, source)], [(0.0, target)])
+        graphs = (self._forward, self._backward)
+        best, meeting_node = np.inf, None
+
+        while heaps[0] and heaps[1]:
+            if heaps[0][0][0] + heaps[1][0][0] >= best:
+                break
+            side = 0 if heaps[0][0][0] <= heaps[1][0][0] else 1
+            d, u = heapq.heappop(heaps[side])
+            if u in settled[side]:
+                continue
+            settled[side].add(u)
+
+            indptr, neighbours, edge_ids = graphs[side]
+            for e in range(indptr[u], indptr[u + 1]):
+                v, edge = neighbours[e], edge_ids[e]
+                nd = d + self._duration[edge]
+                if nd < dist[side].get(v, np.inf):
+                    dist[side][v] = nd
+                    pred[side][v] = edge
+                    heapq.heappush(heaps[side], (nd, v))
+                    if v in dist[1 - side] and nd + dist[1 - side][v] < best:
+                        best, meeting_node = nd + dist[1 - side][v], v
+
+        if meeting_node is None:
+            return None
+
+        path = []
+        node = meeting_node
+        while pred[0][node] != -1:
+            path.append(pred[0][node])
+            node = int(self.edge_from[pred[0][node]])
+        path.reverse()
+        node = meeting_node
+        while pred[1][node] != -1:
+            path.append(pred[1][node])
+            node = int(self.edge_to[pred[1][node]])
+        return np.array(path, dtype=np.int64)
+
+    def _forward_search(self, source, target):
+        """
+        Edge ids of the fastest path from source to target, None if unreachable.
+
+        The search state of the last source is kept, so a new target from the
+        same source either is already settled or resumes the search.
+        """
+        if self._search is None or self._search["source"] != source:
+            self._search = {
+                "source": source,
+                "dist": {source: 0.0},
+                "pred": {source: -1},
+                "settled": set(),
+                "heap": [(0.0, source)],
+            }
+        search = self._search
+        dist, pred, settled, heap = search["dist"], search["pred"], search["settled"], search["heap"]
+        indptr, neighbours, edge_ids = self._forward
+
+        while target not in settled and heap:
+            d, u = heapq.heappop(heap)
+            if u in settled:
+                continue
+            settled.add(u)
+            for e in range(indptr[u], indptr[u + 1]):
+                v, edge = neighbours[e], edge_ids[e]
+                nd = d + self._duration[edge]
+                if nd < dist.get(v, np.inf):
+                    dist[v] = nd
+                    pred[v] = edge
+                    heapq.heappush(heap, (nd, v))
+
+        if target not in settled:
+            return None
+        path = []
+        node = target
+        while pred[node] != -1:
+            path.append(pred[node])
+            node = int(self.edge_from[pred[node]])
+        path.reverse()
+        return np.array(path, dtype=np.int64)
@@ -18,4 +18,67 @@ def np_distance_haversine(lat1, lon1, lat2, lon2):
 
     c = 2 * np.arcsin(np.sqrt(a))
     km = 6367 * c
-    return km
\ No newline at end of file
+    return km
+
+
+def to_ragged(sequences, dtype=np.float64):
+    """
+    Flatten a sequence of variable length arrays into values and offsets
+
+    Parameters:
+    sequences (array[array]): variable length sequences, e.g., routes' latitudes
+    dtype (numpy.dtype): type of the flattened values
+
+    Returns:
+    values (array): all sequences concatenated
+    offsets (array[int]): sequence i is values[offsets[i]:offsets[i + 1]]
+    """
+    lengths = np.fromiter((len(seq) for seq in sequences), dtype=np.int64)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    if offsets[-1] == 0:
+        return np.empty(0, dtype=dtype), offsets
+    values = np.concatenate([np.asarray(seq, dtype=dtype) for seq in sequences if len(seq) > 0])
+    return values, offsets
+
+
+def from_ragged(values, offsets):
+    """
+    Split flattened values back into a list of sequences (views, no copy)
+
+    Parameters:
+    values (array): all sequences concatenated
+    offsets (array[int]): sequence i is values[offsets[i]:offsets[i + 1]]
+
+    Returns:
+    array[array]: list of sequences
+    """
+    return [values[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def routes_to_columns(results):
+    """
+    Columns of many route results, with ragged geometries and node ids
+
+    Parameters:
+    results (array[tuple]): (lat list, lon list, distance, duration, node ids)
+    per route, as returned by OSRMFramework.route. Routes not found have NaN
+    instead of the lists
+
+    Returns:
+    dict, in input order, with distance, duration, lat, lon,
+    geometry_offsets, node_ids and node_offsets, see OSRMFramework.route_many
+    """
+    found = [isinstance(r[0], list) for r in results]
+    lat, geometry_offsets = to_ragged([r[0] if ok else [] for r, ok in zip(results, found)])
+    lon, _ = to_ragged([r[1] if ok else [] for r, ok in zip(results, found)])
+    node_ids, node_offsets = to_ragged([r[4] if ok else [] for r, ok in zip(results, found)], dtype=np.int64)
+    return {
+        "distance": np.array([r[2] for r in results], dtype=float),
+        "duration": np.array([r[3] for r in results], dtype=float),
+        "lat": lat,
+        "lon": lon,
+        "geometry_offsets": geometry_offsets,
+        "node_ids": node_ids,
+        "node_offsets": node_offsets,
+    }
@@ -0,0 +1,199 @@
+import numpy as np
+import pandas as pd
+
+try:
+    # h3 3.x, as pinned in requirements.txt
+    from h3 import h3
+
+    _geo_to_cell, _cell_to_geo = h3.geo_to_h3, h3.h3_to_geo
+except ImportError:
+    # h3 >= 4.0 renamed the functions
+    import h3
+
+    _geo_to_cell, _cell_to_geo = h3.latlng_to_cell, h3.cell_to_latlng
+
+
+def cells(lat, lon, resolutions):
+    """
+    H3 cells of many coordinates
+
+    Repeated coordinates, common in taxi pickups, are only indexed once,
+    whatever the number of resolutions. Each resolution is indexed from the
+    coordinates: the parent of a cell does not always contain the points of
+    the cell, so coarser cells are not derived from finer ones.
+
+    Parameters:
+    lat (array[float]): latitudes
+    lon (array[float]): longitudes
+    resolutions (int or array[int]): H3 resolution(s)
+
+    Returns:
+    array[str]: H3 cell of each coordinate, or a dict resolution -> cells
+    when several resolutions are given
+    """
+    coords = np.column_stack([np.asarray(lat, dtype=float), np.asarray(lon, dtype=float)])
+    if len(coords):
+        unique, inverse = np.unique(coords, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+    else:
+        unique, inverse = coords, np.empty(0, dtype=np.int64)
+    result = {}
+    for resolution in np.atleast_1d(resolutions).tolist():
+        unique_cells = np.array([_geo_to_cell(a, b, resolution) for a, b in unique], dtype=object)
+        result[resolution] = unique_cells[inverse]
+    return result if np.ndim(resolutions) else result[resolutions]
+
+
+class CentroidTable:
+    """
+    Memoised H3 cell -> centroid lookup
+
+    Each distinct cell is converted once for the lifetime of the table,
+    instead of once per row with .apply(h3.h3_to_geo).
+
+    Example:
+    centroids = CentroidTable()
+    df['lat_pickup'], df['lng_pickup'] = centroids.lookup(df['pickup_h3'])
+    """
+
+    def __init__(self):
+        self.table = {}
+
+    def lookup(self, cells_):
+        """
+        Parameters:
+        cells_ (array[str]): H3 cells
+
+        Returns:
+        lat (array[float]): centroid latitudes
+        lon (array[float]): centroid longitudes
+        """
+        codes, unique = pd.factorize(np.asarray(cells_, dtype=object))
+        for cell in unique:
+            if cell not in self.table:
+                self.table[cell] = _cell_to_geo(cell)
+        centroids = np.array([self.table[cell] for cell in unique], dtype=float).reshape(-1, 2)
+        return centroids[codes, 0], centroids[codes, 1]
+
+    def __len__(self):
+        return len(self.table)
+
+
+class HexCube:
+    """
+    Trip counts per H3 cell x weekday x hour, and per origin-destination
+    arc, at several resolutions
+
+    Each distinct coordinate is indexed once per resolution. Chunks of trips can be
+    added incrementally; slices over weekdays/hours are summed from the
+    cube, without going back to the trips.
+
+    Example:
+    cube = HexCube(resolutions=[7, 8], timezone='America/New_York')
+    for chunk in pd.read_csv('data/train.csv', chunksize=100000):
+        cube.add(chunk['pickup_latitude'], chunk['pickup_longitude'],
+                 chunk['dropoff_latitude'], chunk['dropoff_longitude'], chunk['pickup_datetime'])
+    df_demand = cube.demand(7, by=['weekday'])
+    df_arc = cube.arcs(7, by=['weekday'], hours=range(7, 10))
+    """
+
+    def __init__(self, resolutions=(7,), timezone=None):
+        """
+        Parameters:
+        resolutions (array[int]): H3 resolutions to count at
+        timezone (str): timezone of weekdays and hours, timestamps are read as UTC.
+        Defaults to the timestamps as given
+        """
+        self.resolutions = sorted(resolutions)
+        self.timezone = timezone
+        self.centroids = CentroidTable()
+        self._demand = {resolution: None for resolution in self.resolutions}
+        self._arcs = {resolution: None for resolution in self.resolutions}
+
+    def _weekday_hour(self, timestamps):
+        timestamps = pd.to_datetime(pd.Series(timestamps).reset_index(drop=True), utc=self.timezone is not None)
+        if self.timezone is not None:
+            timestamps = timestamps.dt.tz_convert(self.timezone)
+        return timestamps.dt.dayofweek.values, timestamps.dt.hour.values
+
+    @staticmethod
+    def _merge(current, new):
+        if current is None:
+            return new
+        return current.add(new, fill_value=0).astype(np.int64)
+
+    def add(self, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, timestamps):
+        """
+        Add a chunk of trips
+
+        Parameters:
+        pickup_lat (array[float]): pickup latitudes
+        pickup_lon (array[float]): pickup longitudes
+        dropoff_lat (array[float]): dropoff latitudes
+        dropoff_lon (array[float]): dropoff longitudes
+        timestamps (array[datetime]): pickup times
+        """
+        weekday, hour = self._weekday_hour(timestamps)
+        pickup = cells(pickup_lat, pickup_lon, self.resolutions)
+        dropoff = cells(dropoff_lat, dropoff_lon, self.resolutions)
+
+        for resolution in self.resolutions:
+            trips = pd.DataFrame(
+                {"pickup_h3": pickup[resolution], "dropoff_h3": dropoff[resolution], "weekday": weekday, "hour": hour}
+            )
+            demand = trips.groupby(["pickup_h3", "weekday", "hour"]).size()
+            arcs = trips.groupby(["pickup_h3", "dropoff_h3", "weekday", "hour"]).size()
+            self._demand[resolution] = self._merge(self._demand[resolution], demand)
+            self._arcs[resolution] = self._merge(self._arcs[resolution], arcs)
+
+    @staticmethod
+    def _slice(counts, weekdays, hours, keys):
+        counts = counts.reset_index(name="counts")
+        if weekdays is not None:
+            counts = counts[counts["weekday"].isin(list(weekdays))]
+        if hours is not None:
+            counts = counts[counts["hour"].isin(list(hours))]
+        return counts.groupby(keys)["counts"].sum().reset_index()
+
+    def demand(self, resolution, weekdays=None, hours=None, by=("weekday",)):
+        """
+        Pickups per cell
+
+        Parameters:
+        resolution (int): one of the cube resolutions
+        weekdays (array[int]): weekdays to keep, 0 is Monday. Defaults to all
+        hours (array[int]): hours to keep. Defaults to all
+        by (array[str]): keep these dimensions, among 'weekday' and 'hour',
+        the others are summed
+
+        Returns:
+        pandas.DataFrame: pickup_h3, lat, lng, the `by` columns and counts
+        """
+        df = self._slice(self._demand[resolution], weekdays, hours, ["pickup_h3"] + list(by))
+        df.insert(1, "lat", 0.0)
+        df.insert(2, "lng", 0.0)
+        df["lat"], df["lng"] = self.centroids.lookup(df["pickup_h3"])
+        return df
+
+    def arcs(self, resolution, weekdays=None, hours=None, by=("weekday",)):
+        """
+        Trips per origin-destination cell pair
+
+        Parameters:
+        resolution (int): one of the cube resolutions
+        weekdays (array[int]): weekdays to keep, 0 is Monday. Defaults to all
+        hours (array[int]): hours to keep. Defaults to all
+        by (array[str]): keep these dimensions, among 'weekday' and 'hour'
+
+        Returns:
+        pandas.DataFrame: lat_pickup, lng_pickup, lat_dropoff, lng_dropoff,
+        pickup_h3, dropoff_h3, the `by` columns and counts
+        """
+        df = self._slice(self._arcs[resolution], weekdays, hours, ["pickup_h3", "dropoff_h3"] + list(by))
+        lat_pickup, lng_pickup = self.centroids.lookup(df["pickup_h3"])
+        lat_dropoff, lng_dropoff = self.centroids.lookup(df["dropoff_h3"])
+        coords = pd.DataFrame(
+            {"lat_pickup": lat_pickup, "lng_pickup": lng_pickup, "lat_dropoff": lat_dropoff, "lng_dropoff": lng_dropoff},
+            index=df.index,
+        )
+        return pd.concat([coords, df], axis=1)
@@ -0,0 +1,151 @@
+import hashlib
+import multiprocessing
+import numpy as np
+from geopandas import GeoDataFrame
+from shapely import affinity
+from shapely.geometry import GeometryCollection
+from shapely.ops import unary_union
+from conversor import ragged2linestrings
+from graph_router import EARTH_RADIUS_M
+
+# engine used by the worker processes. Set before forking, so workers share
+# the parent's graph arrays instead of receiving a pickled copy each
+_WORKER_ENGINE = None
+
+
+def _worker_isochrones(node):
+    return _WORKER_ENGINE._node_isochrones(node)
+
+
+class IsochroneEngine:
+    """
+    Isochrones for many origins over the RouteAnnotator street graph
+
+    Each origin needs a single shortest path search, bounded by the largest
+    trip time, and every threshold is cut from that same search. Isochrones
+    are built by buffering the edges whose both ends are reached, which
+    follows the street network instead of covering empty areas as a convex
+    hull does. The buffers of an origin are computed once and each
+    threshold's isochrone is the previous one merged with the buffers of
+    the edges reached in between.
+
+    Results are cached by (snapped node, thresholds, speed profile), so
+    depots snapped to the same node, or repeated runs, are free.
+
+    Example:
+    ra = RouteAnnotator('munich, germany', 'drive')
+    ra.build_lookups()
+    engine = IsochroneEngine(GraphRouter.from_route_annotator(ra), trip_times_min=[3, 5, 7])
+    isochrones = engine.isochrones(depots['lat'], depots['lon'], processes=8)
+    """
+
+    def __init__(self, router, trip_times_min, buffer_m=50, profile_key=None):
+        """
+        Parameters:
+        router (graph_router.GraphRouter): router over the street graph
+        trip_times_min (array[float]): isochrone thresholds in minutes
+        buffer_m (float): buffer around reached edges, in meters
+        profile_key (str): identifies the speed profile in the cache. Defaults
+        to a hash of the router's edge durations
+        """
+        self.router = router
+        self.trip_times_min = sorted(trip_times_min)
+        self.buffer_m = buffer_m
+        if profile_key is None:
+            profile_key = hashlib.md5(np.ascontiguousarray(router.edge_duration).tobytes()).hexdigest()
+        self.profile_key = profile_key
+        self.cache = {}
+
+        # router nodes in the same local projection used for snapping, in meters
+        projected = router._project(router.node_lat, router.node_lon)
+        self._node_x, self._node_y = projected[:, 0], projected[:, 1]
+        self._meters_per_degree_x = EARTH_RADIUS_M * np.cos(router._lat0) * np.pi / 180
+        self._meters_per_degree_y = EARTH_RADIUS_M * np.pi / 180
+
+    def _cache_key(self, node):
+        return node, tuple(self.trip_times_min), self.buffer_m, self.profile_key
+
+    def _node_isochrones(self, node):
+        """Isochrone polygons (lon/lat) of a graph node, one per threshold"""
+        thresholds = np.array(self.trip_times_min, dtype=float) * 60
+        reached, durations = self.router.reachable(node, thresholds[-1])
+
+        node_duration = np.full(len(self.router.node_ids), np.inf)
+        node_duration[reached] = durations
+        # an edge belongs to the isochrone of the time its farthest end is reached
+        edge_duration = np.maximum(
+            node_duration[self.router.edge_from], node_duration[self.router.edge_to]
+        )
+        edges = np.flatnonzero(edge_duration <= thresholds[-1])
+        edge_duration = edge_duration[edges]
+
+        from_, to = self.router.edge_from[edges], self.router.edge_to[edges]
+        # ragged2linestrings takes lat/lon, here y/x in meters
+        lines = ragged2linestrings(
+            np.column_stack([self._node_y[from_], self._node_y[to]]).ravel(),
+            np.column_stack([self._node_x[from_], self._node_x[to]]).ravel(),
+            np.arange(0, 2 * len(edges) + 1, 2),
+        )
+        buffers = lines.buffer(self.buffer_m).values
+
+        polygons = []
+        polygon, previous = GeometryCollection(), -np.inf
+        for threshold in thresholds:
+            band = (edge_duration > previous) & (edge_duration <= threshold)
+            if band.any():
+                polygon = unary_union([polygon] + list(buffers[band]))
+            previous = threshold
+            # projected meters back to lon/lat
+            polygons.append(
+                affinity.scale(
+                    polygon,
+                    xfact=1 / self._meters_per_degree_x,
+                    yfact=1 / self._meters_per_degree_y,
+                    origin=(0, 0),
+                )
+            )
+        return polygons
+
+    def isochrones(self, lats, lons, processes=1):
+        """
+        Isochrones of many origins
+
+        Parameters:
+        lats (array[float]): origins' latitudes
+        lons (array[float]): origins' longitudes
+        processes (int): worker processes. With more than one, the graph is
+        shared with the workers through fork, which is only available on
+        Unix systems
+
+        Returns:
+        GeoDataFrame: one row per origin and threshold with columns origin
+        (position in the input), node (snapped OSM node id), trip_time_min
+        and the isochrone geometry
+        """
+        global _WORKER_ENGINE
+        nodes = self.router.snap(lats, lons)
+
+        missing = [node for node in np.unique(nodes) if self._cache_key(node) not in self.cache]
+        if processes > 1 and len(missing) > 1:
+            # build the search graph before forking so every worker shares it
+            self.router.reachable(missing[0], 0)
+            _WORKER_ENGINE = self
+            try:
+                with multiprocessing.get_context("fork").Pool(processes) as pool:
+                    results = pool.map(_worker_isochrones, missing)
+            finally:
+                _WORKER_ENGINE = None
+        else:
+            results = [self._node_isochrones(node) for node in missing]
+        for node, polygons in zip(missing, results):
+            self.cache[self._cache_key(node)] = polygons
+
+        rows = []
+        for origin, node in enumerate(nodes):
+            for trip_time, polygon in zip(self.trip_times_min, self.cache[self._cache_key(node)]):
+                rows.append((origin, self.router.node_ids[node], trip_time, polygon))
+        return GeoDataFrame(
+            [row[:3] for row in rows],
+            columns=["origin", "node", "trip_time_min"],
+            geometry=[row[3] for row in rows],
+        )
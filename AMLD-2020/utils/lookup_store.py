@@ -0,0 +1,252 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+from helpers import to_ragged
+
+META_FILE = "meta.json"
+
+
+def save_arrays(path, arrays):
+    """
+    Save named arrays as .npy files inside a directory
+
+    Parameters:
+    path (str): directory, created if needed
+    arrays (dict): name -> numpy array
+    """
+    os.makedirs(path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f"{name}.npy"), np.asarray(array))
+
+
+def load_arrays(path, names):
+    """
+    Memory-map named arrays saved by `save_arrays`
+
+    Opening is instant whatever the file size: pages are only read when
+    accessed, and processes mapping the same files share them in the page
+    cache instead of each holding a copy.
+
+    Parameters:
+    path (str): directory
+    names (array[str]): array names
+
+    Returns:
+    dict: name -> read-only numpy memmap
+    """
+    return {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in names}
+
+
+def _column_kind(values):
+    present = [value for value in values if value is not None]
+    if all(isinstance(value, (int, np.integer)) and not isinstance(value, bool) for value in present):
+        return "int" if len(present) == len(values) else "float"
+    if all(isinstance(value, (int, float, np.number)) and not isinstance(value, bool) for value in present):
+        return "float"
+    if all(isinstance(value, list) and all(isinstance(v, (int, np.integer)) for v in value) for value in present):
+        return "ragged"
+    return "dictionary"
+
+
+def _json_value(value):
+    """Make values hashable and JSON friendly for dictionary encoding"""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [_json_value(v) for v in value]
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return str(value)
+
+
+class ColumnTable:
+    """
+    Read-only id -> metadata lookup stored as columns
+
+    Drop-in replacement for the {id: {attribute: value}} dicts of
+    RouteAnnotator: `table[id]` returns the same dict, built on the fly from
+    the columns. Each attribute is stored with the most compact layout:
+
+    - int/float: one int64/float64 array (NaN for missing floats)
+    - ragged: lists of ints, e.g. the way node sequence, as values + offsets
+    - dictionary: anything else, e.g. highway or maxspeed, as int32 codes
+    into a list of distinct values (-1 for missing)
+
+    Example:
+    table = ColumnTable.from_dict(ra.way_lookup_)
+    table.save('data/lookups/ways')
+    table = ColumnTable.load('data/lookups/ways')
+    table[way_id]['highway']
+    """
+
+    def __init__(self, ids, columns, kinds, categories):
+        """
+        Parameters:
+        ids (array[int]): sorted ids
+        columns (dict): attribute -> array, or (values, offsets) for ragged attributes
+        kinds (dict): attribute -> one of 'int', 'float', 'ragged', 'dictionary'
+        categories (dict): dictionary attribute -> list of distinct values
+        """
+        self.ids = ids
+        self.columns = columns
+        self.kinds = kinds
+        self.categories = categories
+
+    @classmethod
+    def from_dict(cls, lookup):
+        """
+        Build the table from an {id: {attribute: value}} dict
+
+        Parameters:
+        lookup (dict): metadata per id
+
+        Returns:
+        ColumnTable: table
+        """
+        ids = np.array(sorted(lookup), dtype=np.int64)
+        rows = [lookup[id_] for id_ in ids.tolist()]
+        attributes = sorted({attribute for row in rows for attribute in row})
+
+        columns, kinds, categories = {}, {}, {}
+        for attribute in attributes:
+            values = [row.get(attribute) for row in rows]
+            kind = _column_kind(values)
+            kinds[attribute] = kind
+            if kind == "int":
+                columns[attribute] = np.array(values, dtype=np.int64)
+            elif kind == "float":
+                columns[attribute] = np.array([np.nan if v is None else v for v in values], dtype=float)
+            elif kind == "ragged":
+                columns[attribute] = to_ragged([[] if v is None else v for v in values], dtype=np.int64)
+            else:
+                encoded = [None if v is None else json.dumps(_json_value(v)) for v in values]
+                distinct = sorted({v for v in encoded if v is not None})
+                code = {v: i for i, v in enumerate(distinct)}
+                columns[attribute] = np.array([-1 if v is None else code[v] for v in encoded], dtype=np.int32)
+                categories[attribute] = [json.loads(v) for v in distinct]
+        return cls(ids, columns, kinds, categories)
+
+    def save(self, path):
+        """
+        Save the table in a directory of .npy files plus a JSON header
+
+        Parameters:
+        path (str): directory, created if needed
+        """
+        arrays = {"ids": self.ids}
+        for attribute, kind in self.kinds.items():
+            if kind == "ragged":
+                arrays[f"{attribute}.values"], arrays[f"{attribute}.offsets"] = self.columns[attribute]
+            else:
+                arrays[attribute] = self.columns[attribute]
+        save_arrays(path, arrays)
+        with open(os.path.join(path, META_FILE), "w") as f:
+            json.dump({"kinds": self.kinds, "categories": self.categories}, f)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Memory-map a table saved with `save`
+
+        Parameters:
+        path (str): directory
+
+        Returns:
+        ColumnTable: table backed by read-only memmaps
+        """
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        columns = {}
+        for attribute, kind in meta["kinds"].items():
+            if kind == "ragged":
+                arrays = load_arrays(path, [f"{attribute}.values", f"{attribute}.offsets"])
+                columns[attribute] = (arrays[f"{attribute}.values"], arrays[f"{attribute}.offsets"])
+            else:
+                columns[attribute] = load_arrays(path, [attribute])[attribute]
+        ids = load_arrays(path, ["ids"])["ids"]
+        return cls(ids, columns, meta["kinds"], meta["categories"])
+
+    def positions(self, ids):
+        """
+        Row of each id, -1 for unknown ids
+
+        Parameters:
+        ids (array[int]): ids
+
+        Returns:
+        array[int]: rows
+        """
+        ids = np.atleast_1d(np.asarray(ids, dtype=np.int64))
+        if len(self.ids) == 0:
+            return np.full(len(ids), -1, dtype=np.int64)
+        ix = np.searchsorted(self.ids, ids)
+        ix[ix == len(self.ids)] = 0
+        return np.where(np.asarray(self.ids)[ix] == ids, ix, -1)
+
+    def take(self, ids, attributes=None):
+        """
+        Metadata of many ids at once, in one vectorised pass
+
+        Parameters:
+        ids (array[int]): ids, possibly repeated
+        attributes (array[str]): attributes to return. Defaults to all
+
+        Returns:
+        pandas.DataFrame: one row per id, in input order, with a `found` column.
+        Unknown ids and missing attributes are NaN/None instead of raising KeyError.
+        Integer attributes become float when some id is unknown
+        """
+        rows = self.positions(ids)
+        found = rows >= 0
+        safe_rows = np.where(found, rows, 0)
+
+        data = {"found": found}
+        for attribute in self.kinds if attributes is None else attributes:
+            kind, column = self.kinds[attribute], self.columns[attribute]
+            if kind in ("int", "float"):
+                values = np.asarray(column[safe_rows]) if len(self.ids) else np.zeros(len(rows))
+                data[attribute] = values if found.all() else np.where(found, values, np.nan)
+            elif kind == "ragged":
+                values, offsets = column
+                sequences = np.empty(len(rows), dtype=object)
+                for i, row in enumerate(rows):
+                    sequences[i] = values[offsets[row] : offsets[row + 1]] if row >= 0 else None
+                data[attribute] = sequences
+            else:
+                categories = np.empty(len(self.categories[attribute]) + 1, dtype=object)
+                for code, value in enumerate(self.categories[attribute]):
+                    categories[code] = value
+                codes = np.asarray(column[safe_rows]) if len(self.ids) else np.zeros(len(rows), dtype=np.int32)
+                # code -1 (missing) picks the trailing None
+                data[attribute] = categories[np.where(found, codes, -1)]
+        return pd.DataFrame(data)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(np.asarray(self.ids).tolist())
+
+    def __contains__(self, id_):
+        return self.positions([id_])[0] >= 0
+
+    def __getitem__(self, id_):
+        row = self.positions([id_])[0]
+        if row < 0:
+            raise KeyError(id_)
+
+        metadata = {}
+        for attribute, kind in self.kinds.items():
+            column = self.columns[attribute]
+            if kind == "int":
+                metadata[attribute] = int(column[row])
+            elif kind == "float":
+                if not np.isnan(column[row]):
+                    metadata[attribute] = float(column[row])
+            elif kind == "ragged":
+                values, offsets = column
+                metadata[attribute] = values[offsets[row] : offsets[row + 1]].tolist()
+            elif column[row] >= 0:
+                metadata[attribute] = self.categories[attribute][column[row]]
+        return metadata
@@ -0,0 +1,380 @@
+import json
+import os
+import osmium
+import pyarrow as pa
+import pyarrow.parquet as pq
+from multiprocessing import Pool
+from shapely import wkb as wkblib
+from geopandas import GeoDataFrame
+
+# same road types as the RouteAnnotator notebook
+ROAD_TYPES = [
+    "motorway",
+    "trunk",
+    "primary",
+    "secondary",
+    "tertiary",
+    "road",
+    "residential",
+    "service",
+    "motorway_link",
+    "trunk_link",
+    "primary_link",
+    "secondary_link",
+    "tertiary_link",
+]
+
+ROAD_SCHEMA = [
+    ("way_id", pa.int64()),
+    ("nodes", pa.list_(pa.int64())),
+    ("highway", pa.string()),
+    ("name", pa.string()),
+    ("maxspeed", pa.string()),
+    ("oneway", pa.string()),
+    ("geometry", pa.binary()),
+]
+
+POI_SCHEMA = [
+    ("node_id", pa.int64()),
+    ("amenity", pa.string()),
+    ("name", pa.string()),
+    ("lat", pa.float64()),
+    ("lon", pa.float64()),
+    ("geometry", pa.binary()),
+]
+
+
+class GeoParquetWriter:
+    """
+    Write rows to a GeoParquet file in fixed size batches
+
+    Rows are buffered in columns and written as one row group every
+    batch_size rows, so memory is bounded by the batch size whatever the
+    number of rows. The geometry column holds WKB, described in the file
+    metadata as GeoParquet expects, so geopandas >= 0.8 and GDAL can read
+    the files directly (see also `read_geoparquet`).
+
+    Example:
+    with GeoParquetWriter('roads.parquet', ROAD_SCHEMA, 'LineString') as writer:
+        writer.append((way_id, nodes, 'primary', name, '50', 'yes', wkb))
+    """
+
+    def __init__(self, path, schema, geometry_type, batch_size=50000):
+        """
+        Parameters:
+        path (str): parquet file
+        schema (array[(str, pyarrow.DataType)]): column names and types, the geometry column is named 'geometry'
+        geometry_type (str): GeoJSON geometry type, e.g. 'Point'
+        batch_size (int): rows per row group
+        """
+        geo = {
+            "version": "1.0.0",
+            "primary_column": "geometry",
+            "columns": {"geometry": {"encoding": "WKB", "geometry_types": [geometry_type]}},
+        }
+        self.schema = pa.schema([pa.field(name, type_) for name, type_ in schema]).with_metadata(
+            {"geo": json.dumps(geo)}
+        )
+        self.batch_size = batch_size
+        self.path = path
+        self.rows = 0
+        self._buffer = [[] for _ in schema]
+        self._writer = pq.ParquetWriter(path, self.schema)
+
+    def append(self, row):
+        """
+        Parameters:
+        row (tuple): one value per schema column
+        """
+        for column, value in zip(self._buffer, row):
+            column.append(value)
+        if len(self._buffer[0]) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows as a row group"""
+        if len(self._buffer[0]) == 0:
+            return
+        arrays = [pa.array(column, type=field.type) for column, field in zip(self._buffer, self.schema)]
+        self._writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+        self.rows += len(self._buffer[0])
+        self._buffer = [[] for _ in self._buffer]
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class StreamingExtractor(osmium.SimpleHandler):
+    """
+    Stream a .osm.pbf file into road and POI GeoParquet files
+
+    Unlike the notebook extractors, nothing is accumulated for the whole
+    file: ways and nodes are filtered while reading and written in batches.
+    Only the node location index kept by osmium grows with the file, use
+    index='sparse_file_array,<path>' to keep it on disk for large extracts,
+    or share one prebuilt index with `locations_path`.
+
+    Objects can be split between several extractors with `part`: each one
+    reads the file but only builds and writes the objects whose id falls in
+    its part, see `extract`.
+    """
+
+    def __init__(
+        self,
+        roads_path=None,
+        pois_path=None,
+        bbox=None,
+        road_types=ROAD_TYPES,
+        amenities=None,
+        batch_size=50000,
+        part=(0, 1),
+    ):
+        """
+        Parameters:
+        roads_path (str): roads parquet file, None to skip roads
+        pois_path (str): amenity parquet file, None to skip POIs
+        bbox (array[2]): [[lat, lon] bottom_left, [lat, lon] upper_right].
+        Ways are kept if any of their nodes is inside
+        road_types (array[str]): highway values to keep, None for all highways
+        amenities (array[str]): amenity values to keep, None for all amenities
+        batch_size (int): rows per written batch
+        part (tuple): (index, count), only handle objects with id % count == index
+        """
+        osmium.SimpleHandler.__init__(self)
+        self.bbox = bbox
+        self.road_types = None if road_types is None else set(road_types)
+        self.amenities = None if amenities is None else set(amenities)
+        self.part, self.n_parts = part
+        self.wkbfab = osmium.geom.WKBFactory()
+        self.roads = GeoParquetWriter(roads_path, ROAD_SCHEMA, "LineString", batch_size) if roads_path else None
+        self.pois = GeoParquetWriter(pois_path, POI_SCHEMA, "Point", batch_size) if pois_path else None
+
+    def _in_bbox(self, location):
+        if self.bbox is None:
+            return True
+        (min_lat, min_lon), (max_lat, max_lon) = self.bbox
+        return min_lat <= location.lat <= max_lat and min_lon <= location.lon <= max_lon
+
+    def node(self, elem):
+        if self.pois is None or elem.id % self.n_parts != self.part:
+            return
+        amenity = elem.tags.get("amenity")
+        if amenity is None or (self.amenities is not None and amenity not in self.amenities):
+            return
+        if not elem.location.valid() or not self._in_bbox(elem.location):
+            return
+        self.pois.append(
+            (
+                elem.id,
+                amenity,
+                elem.tags.get("name", ""),
+                elem.location.lat,
+                elem.location.lon,
+                bytes.fromhex(self.wkbfab.create_point(elem)),
+            )
+        )
+
+    def way(self, elem):
+        if self.roads is None or elem.id % self.n_parts != self.part:
+            return
+        highway = elem.tags.get("highway")
+        if highway is None or (self.road_types is not None and highway not in self.road_types):
+            return
+        if self.bbox is not None and not any(n.location.valid() and self._in_bbox(n.location) for n in elem.nodes):
+            return
+        try:
+            line = bytes.fromhex(self.wkbfab.create_linestring(elem))
+        except (osmium.InvalidLocationError, RuntimeError):
+            # missing node locations (clipped extract) or a single node way
+            return
+        self.roads.append(
+            (
+                elem.id,
+                [n.ref for n in elem.nodes],
+                highway,
+                elem.tags.get("name", ""),
+                elem.tags.get("maxspeed"),
+                elem.tags.get("oneway"),
+                line,
+            )
+        )
+
+    def run(self, pbf_path, index="flex_mem", locations_path=None):
+        """
+        Read the whole file and close the output files
+
+        Parameters:
+        pbf_path (str): .osm.pbf file
+        index (str): osmium node location index type
+        locations_path (str): dense_file_array index already holding the node
+        locations, see `store_locations`. Used instead of building an index:
+        nodes and ways are then read in two passes
+
+        Returns:
+        dict: rows written, {'roads': int, 'pois': int}
+        """
+        try:
+            if locations_path is None:
+                self.apply_file(pbf_path, locations=self.roads is not None, idx=index)
+            else:
+                if self.pois is not None:
+                    _apply(pbf_path, osmium.osm.osm_entity_bits.NODE, self)
+                if self.roads is not None:
+                    locations = osmium.NodeLocationsForWays(
+                        osmium.index.create_map(f"dense_file_array,{locations_path}")
+                    )
+                    locations.ignore_errors()
+                    _apply(pbf_path, osmium.osm.osm_entity_bits.WAY, locations, self)
+        finally:
+            for writer in (self.roads, self.pois):
+                if writer is not None:
+                    writer.close()
+        return {
+            "roads": self.roads.rows if self.roads else 0,
+            "pois": self.pois.rows if self.pois else 0,
+        }
+
+
+def _apply(pbf_path, entities, *handlers):
+    reader = osmium.io.Reader(pbf_path, entities)
+    try:
+        osmium.apply(reader, *handlers)
+    finally:
+        reader.close()
+
+
+def store_locations(pbf_path, locations_path):
+    """
+    Store the node locations of a .osm.pbf file in a file based index
+
+    The dense_file_array index is a memory-mapped file of 8 bytes per node
+    id up to the largest one. Its holes take no disk space on most file
+    systems, and processes reading it share its pages.
+
+    Parameters:
+    pbf_path (str): .osm.pbf file
+    locations_path (str): index file
+    """
+    index = osmium.index.create_map(f"dense_file_array,{locations_path}")
+    _apply(pbf_path, osmium.osm.osm_entity_bits.NODE, osmium.NodeLocationsForWays(index))
+    del index
+
+
+def _extract_part(args):
+    pbf_path, roads_path, pois_path, kwargs, part, index, locations_path = args
+    return StreamingExtractor(roads_path, pois_path, part=part, **kwargs).run(
+        pbf_path, index=index, locations_path=locations_path
+    )
+
+
+def extract(
+    pbf_path,
+    output_dir,
+    bbox=None,
+    road_types=ROAD_TYPES,
+    amenities=None,
+    roads=True,
+    pois=True,
+    batch_size=50000,
+    processes=1,
+    index="flex_mem",
+):
+    """
+    Extract roads and POIs of a .osm.pbf file into GeoParquet part files
+
+    With several processes, each one streams the file and handles the
+    objects whose id falls in its share, writing its own part file. pyosmium
+    doesn't expose the PBF blocks, so every worker decodes the file, but
+    the costly part (tag filtering, geometry building and writing) is split.
+    The node locations are first stored once in a disk based index in
+    output_dir, see `store_locations`, which all workers read, so memory
+    does not grow with the number of processes. It is removed at the end.
+
+    Parameters:
+    pbf_path (str): .osm.pbf file
+    output_dir (str): directory for roads/part-<i>.parquet and pois/part-<i>.parquet
+    bbox (array[2]): [[lat, lon] bottom_left, [lat, lon] upper_right]
+    road_types (array[str]): highway values to keep, None for all highways
+    amenities (array[str]): amenity values to keep, None for all amenities
+    roads (bool): extract roads
+    pois (bool): extract amenity nodes
+    batch_size (int): rows per written batch, bounds the memory of each process
+    processes (int): worker processes
+    index (str): osmium node location index type with one process, e.g.
+    'sparse_file_array,/tmp/nodes.idx' for country sized extracts
+
+    Returns:
+    dict: rows written, {'roads': int, 'pois': int}
+
+    Example:
+    extract('data/berlin-latest.osm.pbf', 'data/berlin', amenities=['school'], processes=4)
+    ways = read_geoparquet('data/berlin/roads')
+    """
+    roads_dir, pois_dir = os.path.join(output_dir, "roads"), os.path.join(output_dir, "pois")
+    for directory, enabled in ((roads_dir, roads), (pois_dir, pois)):
+        if enabled:
+            os.makedirs(directory, exist_ok=True)
+
+    kwargs = {"bbox": bbox, "road_types": road_types, "amenities": amenities, "batch_size": batch_size}
+    locations_path = None
+    if processes > 1 and roads:
+        locations_path = os.path.join(output_dir, "node_locations.idx")
+        store_locations(pbf_path, locations_path)
+    tasks = []
+    for part in range(processes):
+        file_name = f"part-{part}.parquet"
+        tasks.append(
+            (
+                pbf_path,
+                os.path.join(roads_dir, file_name) if roads else None,
+                os.path.join(pois_dir, file_name) if pois else None,
+                kwargs,
+                (part, processes),
+                index,
+                locations_path,
+            )
+        )
+
+    try:
+        if processes == 1:
+            counts = [_extract_part(tasks[0])]
+        else:
+            with Pool(processes) as pool:
+                counts = pool.map(_extract_part, tasks)
+    finally:
+        if locations_path is not None and os.path.exists(locations_path):
+            os.remove(locations_path)
+    return {
+        "roads": sum(count["roads"] for count in counts),
+        "pois": sum(count["pois"] for count in counts),
+    }
+
+
+def read_geoparquet(path, columns=None):
+    """
+    Read a GeoParquet file, or a directory of part files, into a GeoDataFrame
+
+    Parameters:
+    path (str): parquet file or directory
+    columns (array[str]): columns to read, the geometry is always read
+
+    Returns:
+    geopandas.GeoDataFrame: table with shapely geometries
+    """
+    if columns is not None and "geometry" not in columns:
+        columns = list(columns) + ["geometry"]
+    if os.path.isdir(path):
+        files = sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".parquet"))
+        table = pa.concat_tables([pq.read_table(file, columns=columns) for file in files])
+    else:
+        table = pq.read_table(path, columns=columns)
+    df = table.to_pandas()
+    geometry = [wkblib.loads(value) for value in df.pop("geometry")]
+    return GeoDataFrame(df, geometry=geometry)
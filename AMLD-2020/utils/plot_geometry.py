@@ -1,15 +1,52 @@
 import geopandas as gpd
 import json
+import os
+import re
+import time
 import folium
+import numpy as np
+import requests
+from branca.element import CssLink, Element, JavascriptLink, MacroElement, Template
 from shapely.geometry import LineString
 from folium.plugins import MarkerCluster
+from conversor import linestrings2ragged
 
-def plot_geometry(geometry, marker_cluster=False):
+# above this many geometries, plot_geometry switches to the level of detail mode
+LARGE_THRESHOLD = 5000
+
+def plot_geometry(
+    geometry,
+    marker_cluster=False,
+    large=None,
+    zoom_levels=(10, 13, 16),
+    precision=5,
+    max_bytes=20000000,
+    tiles="auto",
+    leaflet_assets=None,
+):
     """
     Plot geometries in Folium
 
+    Large geometry sets (more than LARGE_THRESHOLD geometries by default)
+    are plotted with levels of detail instead of one GeoJson layer, see
+    `add_lod_layer`. Its report is then kept in the `lod_report` attribute
+    of the returned map. That mode has no background map by default, and
+    with `leaflet_assets` the page works fully offline; without, Leaflet is
+    still loaded from its CDN.
+
     Parameters:
     geometry (shapely.geometry.LineString/Point or geopandas.GeoSeries)
+    marker_cluster (bool): cluster points, only without levels of detail
+    large (bool): force the level of detail mode on or off. Defaults to automatic
+    zoom_levels (array[int]): zooms where a more detailed level starts
+    precision (int): decimals kept for the coordinates of the finest level
+    max_bytes (int): levels whose encoded geometries exceed this size are
+    plotted as density grids instead
+    tiles (str): folium tiles, None for no background map. Defaults to
+    OpenStreetMap, or None in the level of detail mode
+    leaflet_assets (str): directory with leaflet.js and leaflet.css, see
+    `save_leaflet_assets`. They are inlined in the page and every other
+    CDN link is removed, only with levels of detail
 
     Example:
     lat = [40.732605, 40.732612, 40.732255, 40.731856, 40.731469]
@@ -20,10 +57,23 @@ def plot_geometry(geometry, marker_cluster=False):
     if (type(geometry) != gpd.GeoSeries):
         geometry = gpd.GeoSeries(geometry)
 
+    if large is None:
+        large = len(geometry) > LARGE_THRESHOLD
+    if tiles == "auto":
+        tiles = None if large else "OpenStreetMap"
+    if large:
+        min_lon, min_lat, max_lon, max_lat = geometry.total_bounds
+        map_ = folium.Map([(min_lat + max_lat) / 2, (min_lon + max_lon) / 2], tiles=tiles, prefer_canvas=True)
+        map_.fit_bounds([[min_lat, min_lon], [max_lat, max_lon]])
+        map_.lod_report = add_lod_layer(map_, geometry, zoom_levels, precision, max_bytes)
+        if leaflet_assets is not None:
+            map_.add_child(_InlineLeaflet(leaflet_assets))
+        return map_
+
     geometry_ = geometry.geometry[0]
     initial_coords = [geometry_.xy[1][0], geometry_.xy[0][0]]
 
-    map_ = folium.Map(initial_coords, zoom_start=14)
+    map_ = folium.Map(initial_coords, zoom_start=14, tiles=tiles)
 
     geometries_json = json.loads(geometry.to_json())
     geometries_geojson = folium.features.GeoJson(geometries_json)
@@ -35,3 +85,252 @@ def plot_geometry(geometry, marker_cluster=False):
     else:
         map_.add_child(geometries_geojson)
     return map_
+
+def add_lod_layer(map_, geometry, zoom_levels=(10, 13, 16), precision=5, max_bytes=20000000):
+    """
+    Add geometries to a map with zoom dependent levels of detail
+
+    For each level, lines are simplified with Douglas-Peucker at the size of
+    a pixel at the level's most detailed zoom, coordinates are quantised to the
+    decimals that remain visible and delta encoded as Google polylines,
+    about 10x smaller than GeoJson. Levels too large for the browser are
+    replaced by a density grid of the vertices. The map only draws the level
+    of its current zoom, on a canvas. The geometries are embedded in the
+    page, but Leaflet is still loaded from its CDNs, and the tiles from
+    their server unless the map has none.
+
+    Parameters:
+    map_ (folium.Map): map
+    geometry (geopandas.GeoSeries): points, lines or polygons (drawn as their exterior ring)
+    zoom_levels (array[int]): zooms where a more detailed level starts
+    precision (int): decimals kept for the coordinates of the finest level
+    max_bytes (int): levels whose encoded geometries exceed this size are density grids
+
+    Returns:
+    dict: report with the number of geometries, the kind of each level,
+    the output size in bytes and the build time in seconds
+    """
+    start = time.time()
+    geometry = _explode(geometry)
+    is_point = (geometry.geom_type == "Point").values
+    points, lines = geometry[is_point], geometry[~is_point]
+
+    point_lat, point_lon, _ = linestrings2ragged(points)
+    # all points as a single polyline, sorted so that deltas are small
+    order = np.lexsort([np.round(point_lon, 2), np.round(point_lat, 2)])
+    point_lat, point_lon = point_lat[order], point_lon[order]
+
+    levels = []
+    min_zooms = [0] + list(zoom_levels[1:])
+    max_zooms = list(zoom_levels[1:]) + [None]
+    for min_zoom, max_zoom in zip(min_zooms, max_zooms):
+        if max_zoom is None:
+            # most detailed level: no simplification
+            level_precision = precision
+            lat, lon, offsets = linestrings2ragged(lines)
+        else:
+            # a pixel at the most detailed zoom of the level, in degrees
+            pixel = 360 / (256 * 2 ** (max_zoom - 1))
+            level_precision = int(min(precision, np.ceil(-np.log10(pixel)) + 1))
+            lat, lon, offsets = linestrings2ragged(lines.simplify(pixel, preserve_topology=False))
+        encoded_lines = _encode_polylines(lat, lon, offsets, level_precision)
+        encoded_points = _encode_polylines(point_lat, point_lon, [0, len(point_lat)], level_precision)
+
+        level = {"minZoom": min_zoom, "maxZoom": max_zoom or 99, "factor": 10 ** level_precision}
+        if sum(map(len, encoded_lines)) + len(encoded_points[0]) <= max_bytes:
+            level.update({"type": "geometry", "lines": encoded_lines, "points": encoded_points[0]})
+        else:
+            # 8 pixels at the level's first zoom
+            cell = 8 * 360 / (256 * 2 ** max(min_zoom, zoom_levels[0]))
+            level.update(
+                {"type": "density", "cell": cell, "cells": _density(np.r_[lat, point_lat], np.r_[lon, point_lon], cell)}
+            )
+        levels.append(level)
+
+    levels_json = json.dumps(levels, separators=(",", ":"))
+    # braces in the encoded strings would be read as template tags by branca
+    levels_json = re.sub(
+        r'"(?:[^"\\]|\\.)*"', lambda m: m.group(0).replace("{", "\\u007b").replace("}", "\\u007d"), levels_json
+    )
+    layer = MacroElement()
+    layer._template = Template(_LOD_TEMPLATE)
+    layer.levels_json = levels_json
+    map_.add_child(layer)
+
+    report = {
+        "geometries": len(geometry),
+        "levels": [level["type"] for level in levels],
+        "bytes": len(levels_json),
+        "seconds": time.time() - start,
+    }
+    return report
+
+def _leaflet_urls():
+    """CDN urls of the Leaflet version folium uses, a class attribute since folium 0.11"""
+    default_js = getattr(folium.Map, "default_js", None) or folium.folium._default_js
+    default_css = getattr(folium.Map, "default_css", None) or folium.folium._default_css
+    return {"leaflet.js": dict(default_js)["leaflet"], "leaflet.css": dict(default_css)["leaflet_css"]}
+
+def save_leaflet_assets(path):
+    """
+    Download the Leaflet files folium uses, once, for offline maps
+
+    Parameters:
+    path (str): directory, created if needed
+
+    Returns:
+    str: path, to pass as `leaflet_assets` to plot_geometry
+    """
+    os.makedirs(path, exist_ok=True)
+    for name, url in _leaflet_urls().items():
+        response = requests.get(url, timeout=60)
+        response.raise_for_status()
+        with open(os.path.join(path, name), "wb") as f:
+            f.write(response.content)
+    return path
+
+class _InlineLeaflet(MacroElement):
+    """Replaces the CDN links of the page by inline Leaflet files"""
+
+    def __init__(self, path):
+        super().__init__()
+        self._name = "InlineLeaflet"
+        with open(os.path.join(path, "leaflet.js"), encoding="utf-8") as f:
+            self.js = f.read()
+        with open(os.path.join(path, "leaflet.css"), encoding="utf-8") as f:
+            self.css = f.read()
+
+    def render(self, **kwargs):
+        # the map adds its links before rendering its children
+        header = self.get_root().header
+        for name, child in list(header._children.items()):
+            if isinstance(child, (JavascriptLink, CssLink)):
+                del header._children[name]
+        js, css = Element(), Element()
+        js._template = Template("<script>{{ this.code }}</script>")
+        css._template = Template("<style>{{ this.code }}</style>")
+        js.code, css.code = self.js, self.css
+        header.add_child(js, name="leaflet")
+        header.add_child(css, name="leaflet_css")
+        super().render(**kwargs)
+
+def _explode(geometry):
+    """Split multi-part geometries and replace polygons by their exterior ring"""
+    parts = []
+    for geom in geometry.values:
+        if geom is None or geom.is_empty:
+            continue
+        for part in getattr(geom, "geoms", [geom]):
+            if part.geom_type == "Polygon":
+                parts.append(LineString(part.exterior.coords))
+            else:
+                parts.append(part)
+    return gpd.GeoSeries(parts)
+
+def _encode_polylines(lat, lon, offsets, precision):
+    """
+    Google polyline encoding of many polylines at once
+
+    Coordinates are quantised to `precision` decimals and each one is
+    stored as the zigzag encoded delta from the previous vertex, in 5 bit
+    chunks of printable characters.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    factor = 10 ** precision
+    quantised = np.column_stack([np.round(np.asarray(lat) * factor), np.round(np.asarray(lon) * factor)]).astype(np.int64)
+    deltas = quantised.copy()
+    deltas[1:] -= quantised[:-1]
+    # each polyline starts from (0, 0)
+    starts = offsets[:-1][np.diff(offsets) > 0]
+    deltas[starts] = quantised[starts]
+
+    values = deltas.ravel()
+    zigzag = ((values << 1) ^ (values >> 63)).astype(np.uint64)
+    n_chunks = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 13):
+        n_chunks += zigzag >= np.uint64(1 << (5 * k))
+    chunk_ix = np.arange(n_chunks.max() if len(values) else 0)
+    chunks = (zigzag[:, None] >> (np.uint64(5) * chunk_ix.astype(np.uint64))) & np.uint64(31)
+    chunks = chunks.astype(np.int64)
+    chunks[chunk_ix < n_chunks[:, None] - 1] |= 0x20
+    text = (chunks[chunk_ix < n_chunks[:, None]] + 63).astype(np.uint8).tobytes().decode("ascii")
+
+    # characters of each polyline: both coordinates of its vertices
+    char_offsets = np.concatenate([[0], np.cumsum(n_chunks.reshape(-1, 2).sum(axis=1))])[offsets]
+    return [text[a:b] for a, b in zip(char_offsets[:-1], char_offsets[1:])]
+
+def _density(lat, lon, cell):
+    """Number of vertices per grid cell, as [lat index, lon index, count] rows"""
+    if len(lat) == 0:
+        return []
+    lat_ix = np.floor(np.asarray(lat) / cell).astype(np.int64)
+    lon_ix = np.floor(np.asarray(lon) / cell).astype(np.int64)
+    # one int64 key per cell, much faster to count than rows
+    keys, counts = np.unique((lat_ix << 32) + (lon_ix - lon_ix.min()), return_counts=True)
+    return np.column_stack([keys >> 32, (keys & 0xFFFFFFFF) + lon_ix.min(), counts]).tolist()
+
+_LOD_TEMPLATE = """
+{% macro script(this, kwargs) %}
+(function() {
+    var map = {{ this._parent.get_name() }};
+    var levels = {{ this.levels_json }};
+    var renderer = L.canvas();
+
+    function decode(str, factor) {
+        var coords = [], lat = 0, lon = 0, i = 0;
+        while (i < str.length) {
+            var values = [0, 0];
+            for (var c = 0; c < 2; c++) {
+                var shift = 0, result = 0, b;
+                do {
+                    b = str.charCodeAt(i++) - 63;
+                    result += (b & 0x1f) * Math.pow(2, shift);
+                    shift += 5;
+                } while (b >= 0x20);
+                values[c] = (result % 2) ? -(result + 1) / 2 : result / 2;
+            }
+            lat += values[0];
+            lon += values[1];
+            coords.push([lat / factor, lon / factor]);
+        }
+        return coords;
+    }
+
+    function build(level) {
+        var group = L.layerGroup();
+        if (level.type == "density") {
+            var max = Math.max.apply(null, level.cells.map(function(c) { return c[2]; }));
+            level.cells.forEach(function(c) {
+                L.rectangle(
+                    [[c[0] * level.cell, c[1] * level.cell], [(c[0] + 1) * level.cell, (c[1] + 1) * level.cell]],
+                    {renderer: renderer, stroke: false, fillColor: "#3388ff", fillOpacity: 0.1 + 0.8 * Math.log(1 + c[2]) / Math.log(1 + max)}
+                ).addTo(group);
+            });
+            return group;
+        }
+        level.lines.forEach(function(line) {
+            L.polyline(decode(line, level.factor), {renderer: renderer, weight: 2}).addTo(group);
+        });
+        decode(level.points, level.factor).forEach(function(point) {
+            L.circleMarker(point, {renderer: renderer, radius: 3, stroke: false, fillOpacity: 0.7}).addTo(group);
+        });
+        return group;
+    }
+
+    var layers = {}, current = null;
+    function update() {
+        var zoom = map.getZoom();
+        for (var i = 0; i < levels.length; i++) {
+            if (zoom >= levels[i].minZoom && zoom < levels[i].maxZoom) break;
+        }
+        if (i == current || i == levels.length) return;
+        if (current !== null) map.removeLayer(layers[current]);
+        layers[i] = layers[i] || build(levels[i]);
+        map.addLayer(layers[i]);
+        current = i;
+    }
+    map.on("zoomend", update);
+    update();
+})();
+{% endmacro %}
+"""
@@ -0,0 +1,349 @@
+import json
+import os
+from itertools import chain
+import numpy as np
+from scipy.spatial import cKDTree
+from geodesic import LocalProjection
+from lookup_store import META_FILE, save_arrays, load_arrays
+
+ARRAY_NAMES = ["segment_ids", "way_ids", "from_nodes", "to_nodes", "lat1", "lon1", "lat2", "lon2"]
+
+
+def _highway_handler(highways=None):
+    """
+    Handler collecting the node sequence and locations of every highway way
+
+    pyosmium is only needed to read .pbf files, so it is imported here
+    rather than with the module.
+    """
+    import osmium
+
+    class HighwayHandler(osmium.SimpleHandler):
+        def __init__(self):
+            osmium.SimpleHandler.__init__(self)
+            self.way_ids, self.node_ids, self.lats, self.lons, self.lengths = [], [], [], [], []
+
+        def way(self, way):
+            highway = way.tags.get("highway")
+            if highway is None or (highways is not None and highway not in highways):
+                return
+            nodes = [node for node in way.nodes if node.location.valid()]
+            self.way_ids.append(way.id)
+            self.lengths.append(len(nodes))
+            self.node_ids.extend(node.ref for node in nodes)
+            self.lats.extend(node.location.lat for node in nodes)
+            self.lons.extend(node.location.lon for node in nodes)
+
+    return HighwayHandler()
+
+
+class RoadSegmentIndex:
+    """
+    Nearest road segment of many GPS fixes, offline
+
+    Every node-to-node segment is stored in flat coordinate arrays, bulk
+    loaded with Sort-Tile-Recursive packing: segments are sorted into
+    vertical slices by x, each slice by y, and cut into leaves of
+    `leaf_size` consecutive segments, so a leaf is a contiguous range of
+    the arrays and covers a compact area. KD-trees over the leaf centers,
+    one per leaf size class, are the upper level of the tree.
+
+    A query first bounds the k-th nearest distance from the segments with
+    the closest midpoints, then only looks at the leaves whose bounding box
+    is within that bound, exactly as a best-first R-tree search would, but
+    for a whole block of points at once.
+
+    Distances are computed in a local equirectangular projection, see
+    geodesic.LocalProjection for the error bound.
+
+    Example:
+    index = RoadSegmentIndex.from_route_annotator(ra)
+    result = index.nearest(df['lat'], df['lon'], k=1, max_dist=50)
+    df['way_id'] = result['way_id'][:, 0]
+    """
+
+    def __init__(self, segment_ids, way_ids, from_nodes, to_nodes, lat1, lon1, lat2, lon2, leaf_size=16):
+        """
+        Parameters:
+        segment_ids (array[int]): id of each segment, e.g. its edge position
+        way_ids (array[int]): OSM way id of each segment
+        from_nodes (array[int]): OSM node id where each segment starts
+        to_nodes (array[int]): OSM node id where each segment ends
+        lat1 (array[float]): latitude where each segment starts
+        lon1 (array[float]): longitude where each segment starts
+        lat2 (array[float]): latitude where each segment ends
+        lon2 (array[float]): longitude where each segment ends
+        leaf_size (int): segments per leaf
+        """
+        self.leaf_size = leaf_size
+        self.projection = LocalProjection.around(np.concatenate([lat1, lat2]), np.concatenate([lon1, lon2]))
+        x1, y1 = self.projection.forward(lat1, lon1)
+        x2, y2 = self.projection.forward(lat2, lon2)
+
+        # STR packing
+        n_leaves = int(np.ceil(len(x1) / leaf_size))
+        slice_size = int(np.ceil(np.sqrt(n_leaves))) * leaf_size
+        center_x, center_y = (x1 + x2) / 2, (y1 + y2) / 2
+        order = np.argsort(center_x, kind="stable")
+        slices = np.arange(len(order)) // max(slice_size, 1)
+        order = order[np.lexsort([center_y[order], slices])]
+
+        self.segment_ids = np.asarray(segment_ids, dtype=np.int64)[order]
+        self.way_ids = np.asarray(way_ids, dtype=np.int64)[order]
+        self.from_nodes = np.asarray(from_nodes, dtype=np.int64)[order]
+        self.to_nodes = np.asarray(to_nodes, dtype=np.int64)[order]
+        self.lat1, self.lon1 = np.asarray(lat1, dtype=float)[order], np.asarray(lon1, dtype=float)[order]
+        self.lat2, self.lon2 = np.asarray(lat2, dtype=float)[order], np.asarray(lon2, dtype=float)[order]
+        self._x1, self._y1, self._x2, self._y2 = x1[order], y1[order], x2[order], y2[order]
+
+        starts = np.arange(0, len(order), leaf_size)
+        self._leaf_min_x = np.minimum.reduceat(np.minimum(self._x1, self._x2), starts)
+        self._leaf_max_x = np.maximum.reduceat(np.maximum(self._x1, self._x2), starts)
+        self._leaf_min_y = np.minimum.reduceat(np.minimum(self._y1, self._y2), starts)
+        self._leaf_max_y = np.maximum.reduceat(np.maximum(self._y1, self._y2), starts)
+        leaf_centers = np.column_stack(
+            [(self._leaf_min_x + self._leaf_max_x) / 2, (self._leaf_min_y + self._leaf_max_y) / 2]
+        )
+        leaf_radius = np.hypot(self._leaf_max_x - self._leaf_min_x, self._leaf_max_y - self._leaf_min_y) / 2
+        # leaves are grouped by their radius rounded up to a power of 2, with
+        # a KD-tree per group, so a few long segments only widen the search
+        # among the leaves as large as theirs
+        leaf_class = 2.0 ** np.ceil(np.log2(np.maximum(leaf_radius, 1)))
+        self._leaf_trees = []
+        for class_radius in np.unique(leaf_class):
+            leaves = np.flatnonzero(leaf_class == class_radius)
+            self._leaf_trees.append((class_radius, leaves, cKDTree(leaf_centers[leaves])))
+        self._midpoint_tree = cKDTree(np.column_stack([center_x[order], center_y[order]]))
+
+    @classmethod
+    def from_route_annotator(cls, route_annotator, leaf_size=16):
+        """
+        Build the index from the edges of a RouteAnnotator graph
+
+        Parameters:
+        route_annotator (RouteAnnotator): annotator with a built graph
+        leaf_size (int): segments per leaf
+
+        Returns:
+        RoadSegmentIndex: index, the segment ids are the positions of the edges in G.edges
+        """
+        G = route_annotator.G
+        from_nodes, to_nodes, way_ids = [], [], []
+        for u, v, data in G.edges(data=True):
+            osmid = data.get("osmid", -1)
+            # edges merged from several ways keep the first one
+            way_ids.append(osmid[0] if isinstance(osmid, list) else osmid)
+            from_nodes.append(u)
+            to_nodes.append(v)
+        lat = {node: data["y"] for node, data in G.nodes(data=True)}
+        lon = {node: data["x"] for node, data in G.nodes(data=True)}
+        return cls(
+            np.arange(len(from_nodes)),
+            way_ids,
+            from_nodes,
+            to_nodes,
+            [lat[n] for n in from_nodes],
+            [lon[n] for n in from_nodes],
+            [lat[n] for n in to_nodes],
+            [lon[n] for n in to_nodes],
+            leaf_size=leaf_size,
+        )
+
+    @classmethod
+    def from_pbf(cls, pbf_path, highways=None, leaf_size=16):
+        """
+        Build the index from the highway ways of an OSM extract
+
+        Parameters:
+        pbf_path (str): path to a .osm.pbf file
+        highways (set[str]): highway types to keep. Defaults to all
+        leaf_size (int): segments per leaf
+
+        Returns:
+        RoadSegmentIndex: index, the segment ids are consecutive in file order
+        """
+        handler = _highway_handler(highways)
+        handler.apply_file(pbf_path, locations=True)
+
+        lengths = np.array(handler.lengths, dtype=np.int64)
+        node_ids = np.array(handler.node_ids, dtype=np.int64)
+        lats, lons = np.array(handler.lats), np.array(handler.lons)
+        # a segment joins consecutive nodes of the same way
+        way_ix = np.repeat(np.arange(len(lengths)), lengths)
+        starts = np.flatnonzero(way_ix[:-1] == way_ix[1:])
+        ends = starts + 1
+        return cls(
+            np.arange(len(starts)),
+            np.array(handler.way_ids, dtype=np.int64)[way_ix[starts]],
+            node_ids[starts],
+            node_ids[ends],
+            lats[starts],
+            lons[starts],
+            lats[ends],
+            lons[ends],
+            leaf_size=leaf_size,
+        )
+
+    def save(self, path):
+        """
+        Save the segments as .npy files
+
+        Parameters:
+        path (str): directory, created if needed
+        """
+        save_arrays(path, {name: getattr(self, name) for name in ARRAY_NAMES})
+        with open(os.path.join(path, META_FILE), "w") as f:
+            json.dump({"leaf_size": self.leaf_size}, f)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load an index saved with `save` and rebuild its tree
+
+        Parameters:
+        path (str): directory
+
+        Returns:
+        RoadSegmentIndex: index
+        """
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        return cls(**load_arrays(path, ARRAY_NAMES), leaf_size=meta["leaf_size"])
+
+    def __len__(self):
+        return len(self.segment_ids)
+
+    def _segment_distances(self, px, py, segments):
+        """Distance from each point to its candidate segment and position along it"""
+        ax, ay = self._x1[segments], self._y1[segments]
+        dx, dy = self._x2[segments] - ax, self._y2[segments] - ay
+        length2 = dx ** 2 + dy ** 2
+        t = ((px - ax) * dx + (py - ay) * dy) / np.where(length2 > 0, length2, 1)
+        t = np.clip(t, 0, 1)
+        return np.hypot(px - ax - t * dx, py - ay - t * dy), t
+
+    def _nearest_block(self, px, py, k, max_dist):
+        n = len(px)
+        points = np.column_stack([px, py])
+
+        # 1. upper bound of the k-th nearest distance, from the segments with
+        # the closest midpoints
+        k_mid = min(k, len(self))
+        _, mid = self._midpoint_tree.query(points, k=k_mid)
+        mid = mid.reshape(n, k_mid)
+        distance, _ = self._segment_distances(px[:, None], py[:, None], mid)
+        bound = np.sort(distance, axis=1)[:, -1]
+        if max_dist is not None:
+            bound = np.minimum(bound, max_dist)
+
+        # 2. leaves whose bounding box is within the bound, searched around
+        # the leaf centers up to the bound plus the radius of the leaf group.
+        # Scalar radius per call, for scipy < 1.6: points are grouped by
+        # their radius rounded up to a power of 2^(1/4)
+        point, leaf = [], []
+        for class_radius, class_leaves, tree in self._leaf_trees:
+            radius = 2.0 ** (np.ceil(4 * np.log2(np.maximum(bound + class_radius, 1))) / 4)
+            for r in np.unique(radius):
+                group = np.flatnonzero(radius == r)
+                found = tree.query_ball_point(points[group], r)
+                counts = np.fromiter((len(ls) for ls in found), dtype=np.int64, count=len(group))
+                point.append(np.repeat(group, counts))
+                leaf.append(class_leaves[np.fromiter(chain.from_iterable(found), dtype=np.int64, count=counts.sum())])
+        point, leaf = np.concatenate(point), np.concatenate(leaf)
+        gap_x = np.maximum(np.maximum(self._leaf_min_x[leaf] - px[point], px[point] - self._leaf_max_x[leaf]), 0)
+        gap_y = np.maximum(np.maximum(self._leaf_min_y[leaf] - py[point], py[point] - self._leaf_max_y[leaf]), 0)
+        keep = np.hypot(gap_x, gap_y) <= bound[point]
+        point, leaf = point[keep], leaf[keep]
+
+        # 3. exact distance to every segment of the remaining leaves
+        leaf_start = leaf * self.leaf_size
+        leaf_count = np.minimum(leaf_start + self.leaf_size, len(self)) - leaf_start
+        point = np.repeat(point, leaf_count)
+        segment = np.repeat(leaf_start, leaf_count) + (
+            np.arange(leaf_count.sum()) - np.repeat(np.cumsum(leaf_count) - leaf_count, leaf_count)
+        )
+        distance, t = self._segment_distances(px[point], py[point], segment)
+        keep = distance <= bound[point]
+        point, segment, distance, t = point[keep], segment[keep], distance[keep], t[keep]
+
+        # 4. k best per point
+        order = np.lexsort([distance, point])
+        point, segment, distance, t = point[order], segment[order], distance[order], t[order]
+        first = np.searchsorted(point, np.arange(n))
+        rank = np.arange(len(point)) - first[point]
+        keep = rank < k
+        return point[keep], rank[keep], segment[keep], distance[keep], t[keep]
+
+    def nearest(self, lats, lons, k=1, max_dist=None, block_size=100000):
+        """
+        k nearest road segments of many points
+
+        Parameters:
+        lats (array[float]): latitudes
+        lons (array[float]): longitudes
+        k (int): segments per point
+        max_dist (float): ignore segments farther than this, in meters
+        block_size (int): points per vectorised block, bounds memory
+
+        Returns:
+        dict: arrays of shape (len(lats), k), closest first, -1 or NaN when
+        less than k segments are found:
+        segment_id, way_id, from_node, to_node (int),
+        distance (meters to the segment), offset (meters from the segment
+        start to the projected point), fraction (offset / segment length),
+        lat, lon (projected point)
+        """
+        lats, lons = np.atleast_1d(np.asarray(lats, dtype=float)), np.atleast_1d(np.asarray(lons, dtype=float))
+        px, py = self.projection.forward(lats, lons)
+        n = len(lats)
+        segment = np.full((n, k), -1, dtype=np.int64)
+        distance = np.full((n, k), np.nan)
+        t = np.full((n, k), np.nan)
+        for start in range(0, n, block_size):
+            end = min(start + block_size, n)
+            point, rank, seg, dist, frac = self._nearest_block(px[start:end], py[start:end], k, max_dist)
+            segment[start + point, rank] = seg
+            distance[start + point, rank] = dist
+            t[start + point, rank] = frac
+
+        found = segment >= 0
+        safe = np.where(found, segment, 0)
+        x = self._x1[safe] + t * (self._x2[safe] - self._x1[safe])
+        y = self._y1[safe] + t * (self._y2[safe] - self._y1[safe])
+        lat, lon = self.projection.inverse(x, y)
+        length = np.hypot(self._x2[safe] - self._x1[safe], self._y2[safe] - self._y1[safe])
+        return {
+            "segment_id": np.where(found, self.segment_ids[safe], -1),
+            "way_id": np.where(found, self.way_ids[safe], -1),
+            "from_node": np.where(found, self.from_nodes[safe], -1),
+            "to_node": np.where(found, self.to_nodes[safe], -1),
+            "distance": distance,
+            "offset": t * length,
+            "fraction": t,
+            "lat": np.where(found, lat, np.nan),
+            "lon": np.where(found, lon, np.nan),
+        }
+
+    def nearest_node(self, lats, lons, max_dist=None):
+        """
+        Offline replacement of OSRMFramework.nearest_many: snap each point
+        to its nearest road segment and pick the closest end node
+
+        Parameters:
+        lats (array[float]): latitudes
+        lons (array[float]): longitudes
+        max_dist (float): ignore segments farther than this, in meters
+
+        Returns:
+        dict: node_id (-1 if nothing found), lat, lon (snapped point on the
+        segment), way_id, distance (meters)
+        """
+        result = self.nearest(lats, lons, k=1, max_dist=max_dist)
+        closest_end = np.where(result["fraction"][:, 0] <= 0.5, result["from_node"][:, 0], result["to_node"][:, 0])
+        return {
+            "node_id": closest_end,
+            "lat": result["lat"][:, 0],
+            "lon": result["lon"][:, 0],
+            "way_id": result["way_id"][:, 0],
+            "distance": result["distance"][:, 0],
+        }
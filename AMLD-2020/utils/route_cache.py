@@ -0,0 +1,271 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def file_version(path):
+    """
+    Version string of a router data file, e.g., a segment-speed file
+
+    Parameters:
+    path (str): file path
+
+    Returns:
+    str: md5 of the file content
+    """
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class RouteCache:
+    """
+    Two tier cache for OSRM responses
+
+    Responses are kept in an in-memory LRU and, optionally, in a SQLite file
+    so they survive restarts and can be shared between runs. Keys are built
+    from the service, the coordinates rounded to `precision` decimals and the
+    request options, so repeated or near-identical trips hit the cache.
+
+    Results depend on the data loaded in the router. Every cache is tied to a
+    `data_version` (e.g. `router_utils.osrm_data_version`, which
+    `run_osrm_docker(..., cache=cache)` sets, or
+    `file_version('data/test_traffic.csv')` after restart_osrm_traffic.sh)
+    and opening or switching to a different version drops everything stored
+    before. Opening a file without a version keeps the one stored in it.
+
+    Disk writes are committed in batches, every `commit_every` writes or
+    `commit_seconds`, whichever comes first, and on `flush` and `close`.
+    The last access times of disk hits are kept in memory until then.
+
+    Example:
+    cache = RouteCache('data/routes_cache.sqlite', precision=5,
+                       data_version=file_version('data/test_traffic.csv'))
+    osm = OSRMFramework('localhost:5000', cache=cache)
+    osm.route(lat1, lon1, lat2, lon2)
+    cache.stats()
+    cache.close()
+    """
+
+    def __init__(
+        self,
+        path=None,
+        precision=5,
+        max_memory_items=100000,
+        max_disk_items=10000000,
+        data_version=None,
+        commit_every=1000,
+        commit_seconds=5.0,
+    ):
+        """
+        Parameters:
+        path (str): SQLite file for the disk tier. If None, only memory is used
+        precision (int): decimals kept from the coordinates when building keys.
+        5 decimals ~= 1 meter
+        max_memory_items (int): responses kept in memory before evicting the
+        least recently used
+        max_disk_items (int): responses kept on disk before evicting the least
+        recently used
+        data_version (str): version of the router data the responses belong to.
+        If None, the version stored in the file is kept
+        commit_every (int): disk writes between two commits
+        commit_seconds (float): seconds after which pending disk writes are
+        committed, checked on each write
+        """
+        self.precision = precision
+        self.max_memory_items = max_memory_items
+        self.max_disk_items = max_disk_items
+        self.data_version = None
+        self.commit_every = commit_every
+        self.commit_seconds = commit_seconds
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = None
+        self._disk_items = 0
+        self._pending = 0
+        self._last_commit = time.monotonic()
+        self._accessed = {}
+        if path is not None:
+            self._disk = sqlite3.connect(path, check_same_thread=False)
+            self._disk.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, value TEXT, last_access REAL)"
+            )
+            self._disk.execute(
+                "CREATE INDEX IF NOT EXISTS responses_access ON responses (last_access)"
+            )
+            self._disk.execute(
+                "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)"
+            )
+            self._disk.commit()
+            self._disk_items = self._disk.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            row = self._disk.execute("SELECT value FROM meta WHERE name = 'data_version'").fetchone()
+            self.data_version = None if row is None else json.loads(row[0])
+
+        if data_version is not None:
+            self.set_data_version(data_version)
+
+    def key(self, service, coords, optionals):
+        """
+        Build the cache key of a request
+
+        Parameters:
+        service (str): OSRM service, e.g. 'route'
+        coords (array[[float, float]]): lon/lat pairs of the request
+        optionals (dict): request options
+
+        Returns:
+        str: key
+        """
+        p = self.precision
+        coords_str = ";".join([f"{lon:.{p}f},{lat:.{p}f}" for lon, lat in coords])
+        optionals_str = "&".join([f"{k}={v}" for k, v in sorted(optionals.items())])
+        return f"{service}/{coords_str}?{optionals_str}"
+
+    def get(self, key):
+        """Return the cached response for key or None"""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return self._memory[key]
+
+            if self._disk is not None:
+                row = self._disk.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self._accessed[key] = time.time()
+                    self._wrote()
+                    self.disk_hits += 1
+                    value = json.loads(row[0])
+                    self._set_memory(key, value)
+                    return value
+
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        """Store a JSON serialisable response under key"""
+        with self._lock:
+            self._set_memory(key, value)
+            if self._disk is not None:
+                inserted = self._disk.execute(
+                    "INSERT OR IGNORE INTO responses VALUES (?, ?, ?)",
+                    (key, json.dumps(value), time.time()),
+                ).rowcount
+                self._disk_items += inserted
+                if self._disk_items > self.max_disk_items:
+                    self._evict_disk()
+                self._wrote()
+
+    def _set_memory(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def _wrote(self):
+        self._pending += 1
+        if self._pending >= self.commit_every or time.monotonic() - self._last_commit >= self.commit_seconds:
+            self._commit()
+
+    def _commit(self):
+        if self._accessed:
+            self._disk.executemany(
+                "UPDATE responses SET last_access = ? WHERE key = ?",
+                [(last_access, key) for key, last_access in self._accessed.items()],
+            )
+            self._accessed.clear()
+        self._disk.commit()
+        self._pending = 0
+        self._last_commit = time.monotonic()
+
+    def flush(self):
+        """Commit the pending disk writes"""
+        with self._lock:
+            if self._disk is not None:
+                self._commit()
+
+    def close(self):
+        """Commit the pending disk writes and close the SQLite file"""
+        with self._lock:
+            if self._disk is not None:
+                self._commit()
+                self._disk.close()
+                self._disk = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _evict_disk(self):
+        # access times of recent hits must be written before picking the oldest
+        if self._accessed:
+            self._commit()
+        # drop 10% more than needed so eviction doesn't run on every insert
+        n_evict = self._disk_items - int(self.max_disk_items * 0.9)
+        self._disk.execute(
+            "DELETE FROM responses WHERE key IN "
+            "(SELECT key FROM responses ORDER BY last_access LIMIT ?)",
+            (n_evict,),
+        )
+        self._disk_items -= n_evict
+
+    def set_data_version(self, data_version):
+        """
+        Tie the cache to a router data version, clearing it if the version changed
+
+        Parameters:
+        data_version (str): version of the router data, e.g. the
+        `file_version` of the segment-speed file given to osrm-customize
+        """
+        if data_version == self.data_version:
+            return
+        self.clear()
+        with self._lock:
+            self.data_version = data_version
+            if self._disk is not None:
+                self._disk.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('data_version', ?)",
+                    (json.dumps(data_version),),
+                )
+                self._commit()
+
+    def clear(self):
+        """Remove all cached responses from memory and disk"""
+        with self._lock:
+            self._memory.clear()
+            if self._disk is not None:
+                self._accessed.clear()
+                self._disk.execute("DELETE FROM responses")
+                self._commit()
+                self._disk_items = 0
+
+    def stats(self):
+        """
+        Hit/miss statistics
+
+        Returns:
+        dict: memory/disk hits, misses, hit rate and number of stored items
+        """
+        requests = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / requests if requests else 0.0,
+            "memory_items": len(self._memory),
+            "disk_items": self._disk_items,
+            "data_version": self.data_version,
+        }
@@ -0,0 +1,242 @@
+import random
+import threading
+import time
+from collections import deque
+import numpy as np
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
+
+# upper bounds of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# upper bounds of the response size histograms, in bytes
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+PHASES = ("connect", "wait", "transfer", "decode", "post_process")
+
+_connect_time = threading.local()
+
+
+class _TimedConnection(HTTPConnection):
+    """HTTP connection recording the time spent opening it, per thread"""
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            _connect_time.seconds = getattr(_connect_time, "seconds", 0.0) + time.perf_counter() - start
+
+
+class _TimedConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedConnection
+
+
+def _take_connect_time():
+    """Seconds spent opening connections by this thread since the last call"""
+    seconds = getattr(_connect_time, "seconds", 0.0)
+    _connect_time.seconds = 0.0
+    return seconds
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = np.zeros(len(buckets) + 1, dtype=np.int64)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[np.searchsorted(self.buckets, value)] += 1
+        self.sum += value
+
+    def snapshot(self):
+        return {
+            "buckets": list(self.buckets),
+            "counts": self.counts.tolist(),
+            "count": int(self.counts.sum()),
+            "sum": self.sum,
+        }
+
+
+class RouterMetrics:
+    """
+    Latency, size and error metrics of the queries of an OSRMFramework
+
+    Every HTTP query is split into phases, each with its own latency
+    histogram per service:
+    - connect: opening a new connection, 0 when a pooled one is reused
+    - wait: sending the query until the response headers arrive, the time
+      OSRM spends computing
+    - transfer: reading the response body
+    - decode: parsing the JSON
+    - post_process: the method's own work on the response, once per call
+
+    Response sizes have a histogram per service. Failures are counted per
+    service and code: the HTTP status, the OSRM code (NoRoute, NoMatch...)
+    or the exception name. Queries slower than `slow_seconds` are kept in
+    a bounded log, a `slow_sample_rate` fraction of them.
+
+    The client only calls the metrics when it has some: without, the cost
+    is a single `is None` check per query.
+
+    Example:
+    metrics = RouterMetrics(slow_seconds=0.5)
+    osrm = OSRMFramework('localhost:5000', metrics=metrics)
+    osrm.route_many(lat1, lon1, lat2, lon2)
+    metrics.snapshot()['route']['wait']
+    print(metrics.to_prometheus())
+    """
+
+    def __init__(self, slow_seconds=1.0, slow_sample_rate=1.0, slow_log_size=100):
+        """
+        Parameters:
+        slow_seconds (float): queries taking longer go to the slow query log
+        slow_sample_rate (float): fraction of the slow queries logged
+        slow_log_size (int): slow queries kept, the oldest are dropped
+        """
+        self.slow_seconds = slow_seconds
+        self.slow_sample_rate = slow_sample_rate
+        self.slow_queries = deque(maxlen=slow_log_size)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget everything recorded"""
+        with self._lock:
+            self.latencies = {}
+            self.sizes = {}
+            self.errors = {}
+            self.cache_hits = {}
+            self.slow_queries.clear()
+
+    def instrument(self, adapter):
+        """
+        Time connection opening in the pools of a requests HTTPAdapter
+
+        Parameters:
+        adapter (requests.adapters.HTTPAdapter): adapter, before its first request
+        """
+        adapter.poolmanager.pool_classes_by_scheme = dict(
+            adapter.poolmanager.pool_classes_by_scheme, http=_TimedConnectionPool
+        )
+
+    def observe_phase(self, service, phase, seconds):
+        """Record the duration of one phase of a query"""
+        with self._lock:
+            histogram = self.latencies.get((service, phase))
+            if histogram is None:
+                histogram = self.latencies[(service, phase)] = _Histogram(LATENCY_BUCKETS)
+            histogram.observe(seconds)
+
+    def observe_error(self, service, code):
+        """Count a failed query"""
+        with self._lock:
+            self.errors[(service, str(code))] = self.errors.get((service, str(code)), 0) + 1
+
+    def observe_cache_hit(self, service):
+        """Count a query answered by the client cache"""
+        with self._lock:
+            self.cache_hits[service] = self.cache_hits.get(service, 0) + 1
+
+    def observe_query(self, service, phases, n_bytes, status, code, query):
+        """
+        Record an HTTP query
+
+        Parameters:
+        service (str): OSRM service
+        phases (dict): phase -> seconds, among connect, wait, transfer and decode
+        n_bytes (int): response body size
+        status (int): HTTP status
+        code (str): OSRM code of the response, None if it has none
+        query (str): URL, for the slow query log
+        """
+        for phase, seconds in phases.items():
+            self.observe_phase(service, phase, seconds)
+        with self._lock:
+            histogram = self.sizes.get(service)
+            if histogram is None:
+                histogram = self.sizes[service] = _Histogram(SIZE_BUCKETS)
+            histogram.observe(n_bytes)
+        if status != 200:
+            self.observe_error(service, status)
+        elif code is not None and code != "Ok":
+            self.observe_error(service, code)
+
+        seconds = sum(phases.values())
+        if seconds >= self.slow_seconds and random.random() < self.slow_sample_rate:
+            self.slow_queries.append(
+                {
+                    "time": time.time(),
+                    "service": service,
+                    "seconds": seconds,
+                    "phases": dict(phases),
+                    "bytes": n_bytes,
+                    "status": status,
+                    "code": code,
+                    "query": query,
+                }
+            )
+
+    def snapshot(self):
+        """
+        Copy of the metrics
+
+        Returns:
+        dict: service -> {phase -> histogram, 'bytes' -> histogram,
+        'errors' -> {code -> count}, 'cache_hits' -> count}, plus
+        'slow_queries' -> list of the logged queries. A histogram is a dict
+        with buckets (upper bounds), counts (per bucket, the last one above
+        all bounds), count and sum
+        """
+        with self._lock:
+            services = {service for service, _ in self.latencies} | set(self.sizes) | set(self.cache_hits)
+            services |= {service for service, _ in self.errors}
+            result = {service: {"errors": {}, "cache_hits": self.cache_hits.get(service, 0)} for service in services}
+            for (service, phase), histogram in self.latencies.items():
+                result[service][phase] = histogram.snapshot()
+            for service, histogram in self.sizes.items():
+                result[service]["bytes"] = histogram.snapshot()
+            for (service, code), count in self.errors.items():
+                result[service]["errors"][code] = count
+            result["slow_queries"] = list(self.slow_queries)
+        return result
+
+    def to_prometheus(self, prefix="osrm"):
+        """
+        Metrics in the Prometheus text exposition format
+
+        Parameters:
+        prefix (str): prefix of the metric names
+
+        Returns:
+        str: osrm_query_seconds and osrm_response_bytes histograms,
+        osrm_errors_total and osrm_cache_hits_total counters
+        """
+        lines = []
+
+        def histogram_lines(name, histograms):
+            for labels, histogram in sorted(histograms.items()):
+                label_str = ",".join(f'{key}="{value}"' for key, value in labels)
+                cumulative = np.cumsum(histogram.counts)
+                for bound, count in zip(list(histogram.buckets) + ["+Inf"], cumulative):
+                    lines.append(f'{name}_bucket{{{label_str},le="{bound}"}} {count}')
+                lines.append(f"{name}_sum{{{label_str}}} {histogram.sum}")
+                lines.append(f"{name}_count{{{label_str}}} {cumulative[-1]}")
+
+        with self._lock:
+            lines += [f"# HELP {prefix}_query_seconds Duration of each phase of the OSRM queries",
+                      f"# TYPE {prefix}_query_seconds histogram"]
+            histogram_lines(
+                f"{prefix}_query_seconds",
+                {(("service", service), ("phase", phase)): h for (service, phase), h in self.latencies.items()},
+            )
+            lines += [f"# HELP {prefix}_response_bytes Size of the OSRM responses",
+                      f"# TYPE {prefix}_response_bytes histogram"]
+            histogram_lines(f"{prefix}_response_bytes", {(("service", service),): h for service, h in self.sizes.items()})
+            lines += [f"# HELP {prefix}_errors_total Failed OSRM queries",
+                      f"# TYPE {prefix}_errors_total counter"]
+            for (service, code), count in sorted(self.errors.items()):
+                lines.append(f'{prefix}_errors_total{{service="{service}",code="{code}"}} {count}')
+            lines += [f"# HELP {prefix}_cache_hits_total OSRM queries answered by the client cache",
+                      f"# TYPE {prefix}_cache_hits_total counter"]
+            for service, count in sorted(self.cache_hits.items()):
+                lines.append(f'{prefix}_cache_hits_total{{service="{service}"}} {count}')
+        return "\n".join(lines) + "\n"
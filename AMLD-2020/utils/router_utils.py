@@ -3,28 +3,185 @@ import requests
 import osmnx as ox
 import numpy as np
 import networkx as nx
+import functools
+import hashlib
+import os
 import pickle
-from itertools import combinations
-from helpers import np_distance_haversine
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from geodesic import haversine
+from helpers import routes_to_columns, to_ragged
+from lookup_store import ColumnTable
+from route_cache import file_version
+from router_metrics import _take_connect_time
+from segment_index import SegmentIndex
+from speed_profile import speed_profile
+
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+
+def _timed(service):
+    """
+    Record the post_process phase of an OSRMFramework method: its run time
+    minus the time its thread spent in _get and _map
+    """
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.metrics is None:
+                return method(self, *args, **kwargs)
+            network = getattr(self._local, "network", 0.0)
+            start = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start - (getattr(self._local, "network", 0.0) - network)
+                self.metrics.observe_phase(service, "post_process", max(elapsed, 0.0))
+
+        return wrapper
+
+    return decorator
 
 
 class OSRMFramework:
-    def __init__(self, OSRM_server_path):
-        self.server_url = OSRM_server_path
+    def __init__(self, OSRM_server_path, max_connections=10, max_retries=3, timeout=30, cache=None, metrics=None):
+        """
+        Client for an OSRM instance
 
-    def nearest(self, lat, lon):
-        SERVICE = "nearest"
-        optionals = {"number": 1}
-        coord = f"{lon},{lat}"
+        All calls share a session with a bounded pool of keep-alive
+        connections, so consecutive or concurrent queries reuse the same TCP
+        connections instead of opening a new one per query.
+
+        Parameters:
+        OSRM_server_path (str): host and port of the OSRM instance, e.g. 'localhost:5000'
+        max_connections (int): maximum number of pooled connections, also the
+        default number of concurrent requests in the *_many methods
+        max_retries (int): retries on connection errors and 429/5xx responses
+        timeout (float): seconds to wait for the server before giving up
+        cache (route_cache.RouteCache): optional cache for route, nearest and
+        match responses
+        metrics (router_metrics.RouterMetrics): optional latency, size and
+        error metrics of the queries
+        """
+        self.server_url = OSRM_server_path
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.cache = cache
+        self.metrics = metrics
+        # seconds each thread spent waiting on the server, see _timed
+        self._local = threading.local()
+        self._local.network = 0.0
+
+        retries = Retry(
+            total=max_retries,
+            backoff_factor=0.1,
+            status_forcelist=[429, 500, 502, 503, 504],
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=max_connections,
+            max_retries=retries,
+            pool_block=True,
+        )
+        if metrics is not None:
+            metrics.instrument(adapter)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
 
+    def _build_query(self, service, coords_str, optionals):
         optionals_str = "?"
         for k, v in optionals.items():
             optionals_str += f"{k}={v}&"
-        optionals = optionals_str[:-1]
+        optionals = optionals_str[:-1]  # remove last "&"
+
+        return f"http://{self.server_url}/{service}/v1/driving/{coords_str}{optionals}"
+
+    def _get(self, query):
+        if self.metrics is None:
+            return self.session.get(query, timeout=self.timeout).json()
+        return self._get_timed(query)
+
+    def _get_timed(self, query):
+        """_get recording the phases of the query in self.metrics"""
+        service = query.split("/", 4)[3]
+        _take_connect_time()
+        start = time.perf_counter()
+        response = None
+        try:
+            response = self.session.get(query, timeout=self.timeout)
+            received = time.perf_counter()
+            result = response.json()
+        except (requests.RequestException, ValueError) as error:
+            failed = response is not None and response.status_code != 200
+            self.metrics.observe_error(service, response.status_code if failed else type(error).__name__)
+            raise
+        finally:
+            self._local.network = getattr(self._local, "network", 0.0) + time.perf_counter() - start
+        decoded = time.perf_counter()
+
+        connect = _take_connect_time()
+        # elapsed: from sending the query until the headers are parsed, connecting included
+        wait = max(response.elapsed.total_seconds() - connect, 0.0)
+        phases = {
+            "connect": connect,
+            "wait": wait,
+            "transfer": max(received - start - connect - wait, 0.0),
+            "decode": decoded - received,
+        }
+        code = result.get("code") if isinstance(result, dict) else None
+        self.metrics.observe_query(service, phases, len(response.content), response.status_code, code, query)
+        return result
 
-        query = f"http://{self.server_url}/{SERVICE}/v1/driving/{coord}{optionals}"
+    def _request(self, service, coords, optionals):
+        """
+        Query the server for the lon/lat pairs in coords, going through the
+        cache first if one is set
+        """
+        coords_str = ";".join([f"{lon},{lat}" for lon, lat in coords])
+        query = self._build_query(service, coords_str, optionals)
         # print(f"query: {query}")
-        response = requests.get(query).json()
+        if self.cache is None:
+            return self._get(query)
+
+        key = self.cache.key(service, coords, optionals)
+        response = self.cache.get(key)
+        if response is None:
+            response = self._get(query)
+            # NoRoute, TooBig and errors may not hold for the next query
+            if response.get("code") == "Ok":
+                self.cache.set(key, response)
+        elif self.metrics is not None:
+            self.metrics.observe_cache_hit(service)
+        return response
+
+    def _map(self, func, items, max_workers=None):
+        """
+        Apply func to every item using a thread pool, keeping input order.
+        Items are submitted in chunks so millions of queries don't create
+        millions of pending futures at once.
+        """
+        max_workers = max_workers or self.max_connections
+        chunk_size = max_workers * 64
+        results = []
+        map_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for start in range(0, len(items), chunk_size):
+                results.extend(executor.map(func, items[start : start + chunk_size]))
+        if self.metrics is not None:
+            # the queries ran in the workers, this thread was waiting for them
+            self._local.network = getattr(self._local, "network", 0.0) + time.perf_counter() - map_start
+        return results
+
+    @_timed("nearest")
+    def nearest(self, lat, lon):
+        SERVICE = "nearest"
+        optionals = {"number": 1}
+        response = self._request(SERVICE, [[lon, lat]], optionals)
 
         if response["code"] == "Ok":
             waypoint = response["waypoints"][0]
@@ -36,6 +193,7 @@ class OSRMFramework:
         else:
             return np.nan, np.nan, np.nan, np.nan
 
+    @_timed("route")
     def route(self, lat1, lon1, lat2, lon2, max_n_routes=1):
         """
         Get route calculated by OSRM between two points
@@ -74,16 +232,8 @@ class OSRMFramework:
         long_lat1 = [lon1, lat1]
         long_lat2 = [lon2, lat2]
         coords = [long_lat1, long_lat2]
-        coords = ";".join([f"{lon},{lat}" for lon, lat in coords])
-
-        optionals_str = "?"
-        for k, v in optionals.items():
-            optionals_str += f"{k}={v}&"
-        optionals = optionals_str[:-1]
 
-        query = f"http://{self.server_url}/{SERVICE}/v1/driving/{coords}{optionals}"
-        # print(f'query: {query}')
-        response = requests.get(query).json()
+        response = self._request(SERVICE, coords, optionals)
 
         if response["code"] == "Ok":
             main_route = response["routes"][0]
@@ -100,56 +250,256 @@ class OSRMFramework:
         else:
             return np.nan, np.nan, np.nan, np.nan, np.nan
 
-    # Allow option to not return/process lat_lon from the route - just obtain distance/duration
-    def batch_route(self, lon_lat_list):
+    def nearest_many(self, lat, lon, df=None, max_workers=None):
+        """
+        Snap many points to their nearest street node concurrently
 
-        # coords = [[-73.996070, 40.732605], [-73.980675, 40.761864], [-73.977640, 40.752346], [-73.970390, 40.768867]]
-        coords_str = ";".join([f"{lon},{lat}" for lon, lat in lon_lat_list])
+        Parameters:
+        lat (array[float] or str): latitudes, or column name if `df` is given
+        lon (array[float] or str): longitudes, or column name if `df` is given
+        df (pandas.DataFrame): optional frame holding the coordinates
+        max_workers (int): concurrent requests. Defaults to `max_connections`
 
-        optionals = {"geometries": "geojson", "annotations": "true", "overview": "full", "steps": "false"}
-        optionals_str = "?"
-        for k, v in optionals.items():
-            optionals_str += f"{k}={v}&"
-        optionals = optionals_str[:-1]
+        Returns:
+        dict, in input order, with:
+            node_id (array[int]): snapped OSM node id, -1 if not found
+            lat (array[float]): snapped latitude, NaN if not found
+            lon (array[float]): snapped longitude, NaN if not found
+            name (array[str]): street name of the snapped node
+
+        Example:
+        osm = OSRMFramework('localhost:5000')
+        nearest = osm.nearest_many('pickup_latitude', 'pickup_longitude', df=df_train)
+        """
+        if df is not None:
+            lat, lon = df[lat].values, df[lon].values
+        coords = np.column_stack([lat, lon]).astype(float)
+
+        def nearest_or_nan(coord):
+            try:
+                return self.nearest(*coord)
+            except (requests.RequestException, ValueError):
+                return np.nan, np.nan, np.nan, np.nan
+
+        results = self._map(nearest_or_nan, coords, max_workers)
+
+        node_id = np.array([-1 if pd.isna(r[0]) else r[0] for r in results], dtype=np.int64)
+        return {
+            "node_id": node_id,
+            "lat": np.array([r[1] for r in results], dtype=float),
+            "lon": np.array([r[2] for r in results], dtype=float),
+            "name": np.array([r[3] for r in results], dtype=object),
+        }
+
+    def route_many(self, lat1, lon1, lat2, lon2, df=None, max_workers=None):
+        """
+        Get routes between many pick-ups and dropoffs concurrently
+
+        Each pair is routed as in `route`, but requests run concurrently over
+        the pooled connections and results come back as columns instead of
+        one tuple per trip. Routes and node ids have different lengths per
+        trip, so they are returned flattened together with offsets: trip i
+        goes from values[offsets[i]] to values[offsets[i + 1]].
+
+        Parameters:
+        lat1 (array[float] or str): pick-up latitudes, or column name if `df` is given
+        lon1 (array[float] or str): pick-up longitudes, or column name if `df` is given
+        lat2 (array[float] or str): dropoff latitudes, or column name if `df` is given
+        lon2 (array[float] or str): dropoff longitudes, or column name if `df` is given
+        df (pandas.DataFrame): optional frame holding the coordinates
+        max_workers (int): concurrent requests. Defaults to `max_connections`
+
+        Returns:
+        dict, in input order, with:
+            distance (array[float]): route distances in meters, NaN if no route
+            duration (array[float]): route durations in seconds, NaN if no route
+            lat (array[float]): flattened latitudes of all routes
+            lon (array[float]): flattened longitudes of all routes
+            geometry_offsets (array[int]): offsets of each route in lat/lon
+            node_ids (array[int]): flattened OSM node ids of all routes
+            node_offsets (array[int]): offsets of each route in node_ids
+
+        Example:
+        osm = OSRMFramework('localhost:5000', max_connections=16)
+        routes = osm.route_many('pickup_latitude', 'pickup_longitude',
+                                'dropoff_latitude', 'dropoff_longitude', df=df_train)
+        """
+        if df is not None:
+            lat1, lon1, lat2, lon2 = [df[col].values for col in [lat1, lon1, lat2, lon2]]
+        coords = np.column_stack([lat1, lon1, lat2, lon2]).astype(float)
+
+        def route_or_nan(coord):
+            try:
+                return self.route(*coord)
+            except (requests.RequestException, ValueError):
+                return np.nan, np.nan, np.nan, np.nan, np.nan
+
+        return routes_to_columns(self._map(route_or_nan, coords, max_workers))
+
+    @_timed("table")
+    def table(
+        self,
+        origins_lat,
+        origins_lon,
+        destinations_lat,
+        destinations_lon,
+        max_table_size=100,
+        max_workers=None,
+    ):
+        """
+        Get distance and duration matrices between origins and destinations
 
-        query = f"http://{self.server_url}/route/v1/driving/{coords_str}{optionals}"
-        response = requests.get(query).json()
+        Wraps OSRM's table service. osrm-routed refuses table queries with
+        more than `--max-table-size` squared sources x destinations (100 by
+        default), so origins and destinations are each split into blocks of
+        at most `max_table_size`, the blocks are queried concurrently and
+        written back into dense matrices.
 
+        Parameters:
+        origins_lat (array[float]): origins' latitudes
+        origins_lon (array[float]): origins' longitudes
+        destinations_lat (array[float]): destinations' latitudes
+        destinations_lon (array[float]): destinations' longitudes
+        max_table_size (int): maximum sources and maximum destinations per
+        request. Must match the server's `--max-table-size`
+        max_workers (int): concurrent requests. Defaults to `max_connections`
+
+        Returns:
+        distances (array[float32]): origins x destinations distances in meters,
+        NaN if no route was found
+        durations (array[float32]): origins x destinations durations in seconds,
+        NaN if no route was found
+
+        Example:
+        osm = OSRMFramework('localhost:5000')
+        distances, durations = osm.table(df['pickup_latitude'], df['pickup_longitude'],
+                                         df['dropoff_latitude'], df['dropoff_longitude'])
+        """
+        SERVICE = "table"
+        origins = np.column_stack([origins_lon, origins_lat]).astype(float)
+        destinations = np.column_stack([destinations_lon, destinations_lat]).astype(float)
+        n_origins, n_destinations = len(origins), len(destinations)
+        distances = np.full((n_origins, n_destinations), np.nan, dtype=np.float32)
+        durations = np.full((n_origins, n_destinations), np.nan, dtype=np.float32)
+        if n_origins == 0 or n_destinations == 0:
+            return distances, durations
+
+        origins_chunk = min(n_origins, max_table_size)
+        destinations_chunk = min(n_destinations, max_table_size)
+
+        blocks = [
+            (i, j)
+            for i in range(0, n_origins, origins_chunk)
+            for j in range(0, n_destinations, destinations_chunk)
+        ]
+
+        def table_block(block):
+            i, j = block
+            sources = origins[i : i + origins_chunk]
+            targets = destinations[j : j + destinations_chunk]
+            coords_str = ";".join([f"{lon},{lat}" for lon, lat in np.vstack([sources, targets])])
+            optionals = {
+                "sources": ";".join(map(str, range(len(sources)))),
+                "destinations": ";".join(map(str, range(len(sources), len(sources) + len(targets)))),
+                "annotations": "distance,duration",
+            }
+            try:
+                return self._get(self._build_query(SERVICE, coords_str, optionals))
+            except (requests.RequestException, ValueError):
+                return {"code": "RequestError"}
+
+        for (i, j), response in zip(blocks, self._map(table_block, blocks, max_workers)):
+            if response["code"] == "Ok":
+                # unreachable pairs come as null, which float conversion turns into NaN
+                block = np.s_[i : i + origins_chunk, j : j + destinations_chunk]
+                distances[block] = np.array(response["distances"], dtype=float)
+                durations[block] = np.array(response["durations"], dtype=float)
+
+        return distances, durations
+
+    @_timed("route")
+    def batch_route(self, lon_lat_list, geometry=True):
+        """
+        Route a batch of trips with a single request
+
+        The trips are chained in one multi-stop route: pick-up 1, dropoff 1,
+        pick-up 2, dropoff 2 and so on. OSRM returns one leg per consecutive
+        pair of points, so even legs are the trips and odd legs, from a
+        dropoff to the next pick-up, are discarded.
+
+        Parameters:
+        lon_lat_list (array[[float, float]]): lon/lat of pick-ups and dropoffs,
+        alternating, starting with a pick-up
+        geometry (bool): if False, the route geometry and annotations are not
+        requested and only distances and durations are returned, which keeps
+        the response small for big batches
+
+        Returns:
+        dict, in trip order, with:
+            distance (array[float]): trips' distances in meters
+            duration (array[float]): trips' durations in seconds
+        and if geometry is True:
+            lat (array[float]): flattened latitudes of all trips
+            lon (array[float]): flattened longitudes of all trips
+            geometry_offsets (array[int]): offsets of each trip in lat/lon
+            node_ids (array[int]): flattened OSM node ids of all trips
+            node_offsets (array[int]): offsets of each trip in node_ids
+        If no route is found, distances and durations are NaN and geometries empty
+
+        Example:
+        coords = [[-73.996070, 40.732605], [-73.980675, 40.761864], [-73.977640, 40.752346], [-73.970390, 40.768867]]
+        osm = OSRMFramework('localhost:5000')
+        trips = osm.batch_route(coords, geometry=False)
+        """
+        SERVICE = "route"
+        if geometry:
+            optionals = {"geometries": "geojson", "annotations": "true", "overview": "full", "steps": "false"}
+        else:
+            optionals = {"overview": "false", "steps": "false"}
+
+        response = self._request(SERVICE, lon_lat_list, optionals)
+
+        n_trips = len(lon_lat_list) // 2
         if response["code"] == "Ok":
-            response_route = np.array(response['routes'][0]['geometry']['coordinates'])
-
-            mapped_coords_ix = []
-            for coord_lon_lat in lon_lat_list:
-                distances_to_point = np_distance_haversine(lat1=response_route[:, 1],
-                                                           lon1=response_route[:, 0],
-                                                           lat2=np.ones(len(response_route)) * coord_lon_lat[1],
-                                                           lon2=np.ones(len(response_route)) * coord_lon_lat[0])
-                mapped_coords_ix.append(np.argmin(distances_to_point))
-
-            lat = []
-            lon = []
-            for i in np.arange(len(mapped_coords_ix) - 1, step=2):
-                route_segment = np.array(response_route[mapped_coords_ix[i]:mapped_coords_ix[i + 1] - 1])
-                lat.append(route_segment[:, 1])
-                lon.append(route_segment[:, 0])
-
-            ######
-
-            distance = []
-            duration = []
-            osm_node_ids = []
-            legs = response['routes'][0]['legs']
-            for i in np.arange(len(legs), step=2):
-                distance.append(legs[i]['distance'])
-                duration.append(legs[i]['duration'])
-                osm_node_ids.append(legs[i]['annotation']['nodes'])
+            trip_legs = response["routes"][0]["legs"][::2]
+            result = {
+                "distance": np.array([leg["distance"] for leg in trip_legs], dtype=float),
+                "duration": np.array([leg["duration"] for leg in trip_legs], dtype=float),
+            }
+        else:
+            result = {
+                "distance": np.full(n_trips, np.nan),
+                "duration": np.full(n_trips, np.nan),
+            }
+        if not geometry:
+            return result
 
-            return lat, lon, distance, duration, osm_node_ids
+        if response["code"] == "Ok":
+            route = response["routes"][0]
+            coordinates = np.array(route["geometry"]["coordinates"], dtype=float)
+
+            # with overview=full, the geometry is the concatenation of the legs'
+            # geometries sharing their end points, and each leg has one
+            # annotation per geometry segment. Leg i then spans
+            # coordinates[leg_start[i]:leg_start[i] + n_segments[i] + 1]
+            n_segments = np.array([len(leg["annotation"]["distance"]) for leg in route["legs"]])
+            leg_start = np.concatenate([[0], np.cumsum(n_segments)[:-1]])
+            trip_geometries = [
+                coordinates[start : start + n + 1] for start, n in zip(leg_start[::2], n_segments[::2])
+            ]
+            trip_nodes = [leg["annotation"]["nodes"] for leg in route["legs"][::2]]
         else:
-            na_array = [np.nan]*len(lon_lat_list)/2
-            return na_array, na_array, na_array, na_array, na_array
+            trip_geometries = [np.empty((0, 2))] * n_trips
+            trip_nodes = [[]] * n_trips
+
+        trip_coordinates, result["geometry_offsets"] = to_ragged(trip_geometries)
+        result["lat"] = trip_coordinates.reshape(-1, 2)[:, 1]
+        result["lon"] = trip_coordinates.reshape(-1, 2)[:, 0]
+        result["node_ids"], result["node_offsets"] = to_ragged(trip_nodes, dtype=np.int64)
+        return result
 
     # TODO: Interpolate timestamps in case of new nodes being created on map matching, e.g., new corner nodes
+    @_timed("match")
     def match(self, lat, lon, timestamps=None, radiuses=None):
         """
         Snaps GPS traces to the street thought map matching
@@ -185,30 +535,9 @@ class OSRMFramework:
         optionals = {"geometries": "geojson", "annotations": "nodes"}
 
         if timestamps is not None:
-            timestamp_unix = pd.to_datetime(
-                timestamps, format="%Y-%M-%d %H:%m:%S"
-            ).strftime("%s")
-            timestamp_unix = ";".join(timestamp_unix)
-            optionals["timestamps"] = timestamp_unix
-
-        if radiuses is not None:
-            # increase chance of finding correct candidate by doubling std (95% chance)
-            RADIUS_TOLERANCE_MULT = 1
-            radiuses = np.array(radiuses * RADIUS_TOLERANCE_MULT).astype(str)
-            radiuses = ";".join(radiuses)
-            optionals["radiuses"] = radiuses
-
-        optionals_str = "?"
-        for k, v in optionals.items():
-            optionals_str += f"{k}={v}&"
-        optionals = optionals_str[:-1]  # remove last "&"
-
-        coords = [[lon_, lat_] for lon_, lat_ in zip(lon, lat)]
-        coords_str = ";".join([f"{lon},{lat}" for lon, lat in coords])
+            timestamps = self._to_unix(timestamps)
 
-        query = f"http://{self.server_url}/{SERVICE}/v1/driving/{coords_str}{optionals}"
-
-        response = requests.get(query).json()
+        response = self._match_request(lat, lon, timestamps, radiuses, optionals)
         if response["code"] == "Ok":
             match_coords = response["matchings"][0]["geometry"]["coordinates"]
 
@@ -224,6 +553,145 @@ class OSRMFramework:
         else:
             raise Exception(f"Error in Mapmatching: {response['code']}")
 
+    @_timed("match")
+    def match_long(
+        self,
+        lat,
+        lon,
+        timestamps=None,
+        radiuses=None,
+        window_size=100,
+        overlap=10,
+        max_workers=None,
+    ):
+        """
+        Map match GPS traces of any length
+
+        osrm-routed refuses to match more points than its
+        `--max-matching-size` (100 by default). The trace is cut into windows
+        of `window_size` points, consecutive windows sharing `overlap` points,
+        and the windows are matched concurrently. Each overlap is then split
+        in the middle: legs starting before the middle come from the earlier
+        window and the remaining ones from the later window, so the stitched
+        result is a single continuous sequence.
+
+        Parameters:
+        lat (array[float]): sequence of latitudes
+        lon (array[float]): sequence of longitudes
+        timestamps (array[str or int]): datetimes or UNIX timestamps of each GPS point
+        radiuses (array[int]): accuracy associated to each GPS point
+        window_size (int): maximum points per request
+        overlap (int): points shared by consecutive windows
+        max_workers (int): concurrent requests. Defaults to `max_connections`
+
+        Returns: lat, lon, node_id_list, confidence
+        lat (array[float]): latitudes of the matched route
+        lon (array[float]): longitudes of the matched route
+        node_id_list (array[int]): matched OSM node ids, consecutive repetitions removed
+        confidence (array[float]): mean confidence of the matchings of each window,
+        NaN for windows that couldn't be matched
+
+        Example:
+        osm = OSRMFramework('localhost:5000')
+        lat, lon, nodes_id, confidence = osm.match_long(trace['lat'], trace['lon'], trace['timestamp'])
+        """
+        SERVICE_OPTIONALS = {"geometries": "geojson", "annotations": "nodes,distance", "overview": "full"}
+        if not 0 <= overlap < window_size:
+            raise ValueError("overlap must be smaller than window_size")
+
+        lat, lon = np.asarray(lat, dtype=float), np.asarray(lon, dtype=float)
+        if timestamps is not None:
+            timestamps = self._to_unix(timestamps)
+        if radiuses is not None:
+            radiuses = np.asarray(radiuses)
+
+        n_points = len(lat)
+        if n_points > window_size:
+            starts = list(range(0, n_points - overlap, window_size - overlap))
+        else:
+            starts = [0]
+        # window k keeps the legs starting in [bounds[k], bounds[k + 1])
+        bounds = [0] + [start + overlap // 2 for start in starts[1:]] + [n_points]
+
+        def match_window(start):
+            window = slice(start, start + window_size)
+            try:
+                return self._match_request(
+                    lat[window],
+                    lon[window],
+                    None if timestamps is None else timestamps[window],
+                    None if radiuses is None else radiuses[window],
+                    SERVICE_OPTIONALS,
+                )
+            except (requests.RequestException, ValueError):
+                return {"code": "RequestError"}
+
+        coordinates = []
+        nodes = []
+        confidence = np.full(len(starts), np.nan)
+        for k, (start, response) in enumerate(zip(starts, self._map(match_window, starts, max_workers))):
+            if response["code"] != "Ok":
+                continue
+            confidence[k] = np.mean([matching["confidence"] for matching in response["matchings"]])
+
+            # input points of each matching, ordered as its legs' start points
+            matched_points = [[] for _ in response["matchings"]]
+            for i, tracepoint in enumerate(response["tracepoints"]):
+                if tracepoint is not None:
+                    matched_points[tracepoint["matchings_index"]].append(
+                        (tracepoint["waypoint_index"], start + i)
+                    )
+
+            for matching, points in zip(response["matchings"], matched_points):
+                leg_points = [point for _, point in sorted(points)]
+                matching_coords = np.array(matching["geometry"]["coordinates"], dtype=float)
+                leg_start = 0
+                for leg, point in zip(matching["legs"], leg_points):
+                    n_segments = len(leg["annotation"]["distance"])
+                    if bounds[k] <= point < bounds[k + 1]:
+                        coordinates.append(matching_coords[leg_start : leg_start + n_segments + 1])
+                        nodes.append(leg["annotation"]["nodes"])
+                    leg_start += n_segments
+
+        if len(coordinates) == 0:
+            return np.array([]), np.array([]), np.array([], dtype=np.int64), confidence
+
+        # consecutive legs share their end point and end nodes
+        coordinates = np.concatenate(coordinates)
+        is_new = np.concatenate([[True], np.any(np.diff(coordinates, axis=0) != 0, axis=1)])
+        coordinates = coordinates[is_new]
+        nodes = np.concatenate(nodes).astype(np.int64)
+        nodes = nodes[np.concatenate([[True], np.diff(nodes) != 0])]
+
+        return coordinates[:, 1], coordinates[:, 0], nodes, confidence
+
+    def _match_request(self, lat, lon, timestamps, radiuses, optionals):
+        optionals = dict(optionals)
+        if timestamps is not None:
+            optionals["timestamps"] = ";".join(np.asarray(timestamps).astype(str))
+
+        if radiuses is not None:
+            # increase chance of finding correct candidate by doubling std (95% chance)
+            RADIUS_TOLERANCE_MULT = 1
+            radiuses = (np.asarray(radiuses) * RADIUS_TOLERANCE_MULT).astype(str)
+            optionals["radiuses"] = ";".join(radiuses)
+
+        coords = [[lon_, lat_] for lon_, lat_ in zip(lon, lat)]
+
+        return self._request("match", coords, optionals)
+
+    @staticmethod
+    def _to_unix(timestamps):
+        """
+        Convert datetimes (or datetime strings) to UNIX seconds in one
+        vectorised pass. Numeric input is taken as UNIX seconds already
+        """
+        timestamps = np.asarray(timestamps)
+        if np.issubdtype(timestamps.dtype, np.number):
+            return timestamps.astype(np.int64)
+        datetimes = pd.to_datetime(pd.Series(timestamps), utc=True)
+        return ((datetimes - pd.Timestamp(0, tz="UTC")) // pd.Timedelta(seconds=1)).values
+
     def split_close_tours(
         self,
         df,
@@ -232,40 +700,106 @@ class OSRMFramework:
         dropoff_lat_col,
         dropoff_lon_col,
         threshold_km=0.3,
+        driver_col=None,
+        chain_col="chain_id",
+        chunksize=100000,
     ):
+        """
+        Split trips into chains of close tours in a single pass
 
-        all_tours_distant = False
-        df_ind_tours = pd.DataFrame()
-
-        df_2 = df.copy()
-        while all_tours_distant != True:
-            df_2[[f"{pickup_lat_col}_shift", f"{pickup_lon_col}_shift"]] = df_2[
-                [pickup_lat_col, pickup_lon_col]
-            ].shift(-1)
-            df_2["distance_next_point"] = np_distance_haversine(
-                lat1=df_2[dropoff_lat_col],
-                lon1=df_2[dropoff_lon_col],
-                lat2=df_2[f"{pickup_lat_col}_shift"],
-                lon2=df_2[f"{pickup_lon_col}_shift"],
-            )
+        Consecutive trips of a driver form a chain when each dropoff is
+        closer than threshold_km to the next pickup. Every trip of a chain
+        but the last goes to the close tours, the last one stays with the
+        distant trips. Only consecutive trips are compared, the input is
+        expected ordered by time within each driver.
+
+        The input can be streamed in chunks: only the last trip of each
+        driver is kept between chunks, so memory is bounded by the chunk
+        size and the number of drivers, not by the length of the log.
+
+        Parameters:
+        df (pandas.DataFrame, str or iterator): trips, a CSV path read in
+        chunks, or an iterator of DataFrames
+        pickup_lat_col (str): pickup latitude column
+        pickup_lon_col (str): pickup longitude column
+        dropoff_lat_col (str): dropoff latitude column
+        dropoff_lon_col (str): dropoff longitude column
+        threshold_km (float): maximum distance between a dropoff and the next pickup
+        driver_col (str): driver/vehicle column. Trips are only chained within
+        a driver. Defaults to treating all trips as one driver
+        chain_col (str): name of the chain id column added to both outputs.
+        Ids are unique per chain, their numbering depends on the chunking
+        chunksize (int): rows per chunk when df is a CSV path
 
-            is_close_index = df_2.loc[df_2["distance_next_point"] < threshold_km].index
-            if len(is_close_index) == 0:
-                all_tours_distant = True
+        Returns:
+        df_distant (pandas.DataFrame): trips not followed by a close pickup
+        df_close (pandas.DataFrame): trips followed by a close pickup
+
+        Example:
+        df_distant, df_close = osrm.split_close_tours(
+            'data/trips.csv', 'pickup_lat', 'pickup_lon', 'dropoff_lat', 'dropoff_lon',
+            driver_col='medallion')
+        df_close.groupby('chain_id').size()
+        """
+        if isinstance(df, str):
+            chunks = pd.read_csv(df, chunksize=chunksize)
+        elif isinstance(df, pd.DataFrame):
+            chunks = [df]
+        else:
+            chunks = df
+
+        distant, close = [], []
+        # last trip of each driver, waiting for its next trip
+        pending = None
+        next_chain = 0
+        n_rows = 0
+        for chunk in chunks:
+            if len(chunk) == 0:
+                continue
+            chunk = chunk.copy()
+            chunk["_row"] = np.arange(n_rows, n_rows + len(chunk))
+            chunk[chain_col] = -1
+            n_rows += len(chunk)
+            if pending is not None:
+                chunk = pd.concat([pending, chunk], sort=False)
+
+            # stable sort keeps pending trips first and time order within a driver
+            if driver_col is not None:
+                chunk = chunk.iloc[np.argsort(chunk[driver_col].values, kind="mergesort")]
+                driver = chunk[driver_col].values
+                same_driver_next = np.append(driver[1:] == driver[:-1], False)
             else:
-                df_ind_tours = pd.concat(
-                    [df_ind_tours, df_2.loc[df_2.index.isin(is_close_index)]]
-                )
-                df_2 = df_2.loc[~df_2.index.isin(is_close_index)]
-        cols_to_remove = [
-            f"{pickup_lat_col}_shift",
-            f"{pickup_lon_col}_shift",
-            "distance_next_point",
-        ]
-        return (
-            df_2.drop(cols_to_remove, axis=1),
-            df_ind_tours.drop(cols_to_remove, axis=1),
-        )
+                same_driver_next = np.append(np.ones(len(chunk) - 1, dtype=bool), False)
+
+            distance = haversine(
+                lat1=chunk[dropoff_lat_col].values[:-1],
+                lon1=chunk[dropoff_lon_col].values[:-1],
+                lat2=chunk[pickup_lat_col].values[1:],
+                lon2=chunk[pickup_lon_col].values[1:],
+            )
+            linked = same_driver_next & np.append(distance < threshold_km, False)
+
+            # trips not linked from the previous trip start a new chain,
+            # pending trips keep the chain given in the previous chunk
+            chain = chunk[chain_col].values.copy()
+            starts = ~np.insert(linked[:-1], 0, False) & (chain == -1)
+            chain[starts] = np.arange(next_chain, next_chain + starts.sum())
+            next_chain += starts.sum()
+            chain = pd.Series(np.where(chain == -1, np.nan, chain)).ffill().values.astype(np.int64)
+            chunk[chain_col] = chain
+
+            is_last = ~same_driver_next
+            close.append(chunk[linked])
+            distant.append(chunk[~linked & ~is_last])
+            pending = chunk[is_last]
+
+        if pending is not None:
+            distant.append(pending)
+        if len(distant) == 0:
+            return pd.DataFrame(), pd.DataFrame()
+        df_distant = pd.concat(distant, sort=False).sort_values("_row").drop("_row", axis=1)
+        df_close = pd.concat(close, sort=False).sort_values("_row").drop("_row", axis=1)
+        return df_distant, df_close
 
 
 class RouteAnnotator:
@@ -315,46 +849,53 @@ class RouteAnnotator:
         self.add_speeds()
         self._build_lookups()
 
-    def add_speeds(self):
-        """
-        Loops through edges and connecting nodes and extract speed limit given
-        tag or highway type. If tag is not present, use highway type
+    def add_speeds(self, speed_multiplier=1.0, hour=None, hourly_overrides=None):
         """
+        Set speed limit and travel time of every edge
 
-        for u, v, k, data in self.G.edges(data=True, keys=True):
-            if (
-                "maxspeed" in data
-                and type(data["maxspeed"]) == str
-                and data["maxspeed"].isdigit()
-            ):
-                continue
-            else:
-                if (
-                    type(data["highway"]) == list
-                ):  # sometimes data['highway'] comes with a list
-                    cond = [
-                        elem in self.HIGHWAY_SPEED_LIMITS for elem in data["highway"]
-                    ]
-                    highway_type = data["highway"][np.where(cond)[0][0]]
-                else:
-                    highway_type = data["highway"]
+        Edges are processed in bulk by speed_profile.speed_profile: maxspeed
+        tags in any format (numbers, mph, lists, zones) are parsed and edges
+        without a usable tag get their highway type speed from
+        HIGHWAY_SPEED_LIMITS. Each edge gets `maxspeed` (km/h) and
+        `travel_time` (seconds), used as weight by GraphRouter and isochrones.
 
-                if highway_type in self.HIGHWAY_SPEED_LIMITS:
-                    speed = self.HIGHWAY_SPEED_LIMITS[highway_type]
-                    data["maxspeed"] = speed
+        Parameters:
+        speed_multiplier (float): ratio of the speed limit actually driven
+        hour (int): hour of the day to apply `hourly_overrides` for
+        hourly_overrides (dict): hour -> multiplier, or hour -> {highway type: multiplier}
+        """
+        keys = list(self.G.edges(keys=True))
+        edges = pd.DataFrame(
+            {
+                "length": [data["length"] for u, v, data in self.G.edges(data=True)],
+                "highway": [data.get("highway") for u, v, data in self.G.edges(data=True)],
+                "maxspeed": [data.get("maxspeed") for u, v, data in self.G.edges(data=True)],
+            }
+        )
+        maxspeed, travel_time = speed_profile(
+            edges,
+            self.HIGHWAY_SPEED_LIMITS,
+            speed_multiplier=speed_multiplier,
+            hour=hour,
+            hourly_overrides=hourly_overrides,
+        )
+        nx.set_edge_attributes(self.G, dict(zip(keys, maxspeed.values.tolist())), "maxspeed")
+        nx.set_edge_attributes(self.G, dict(zip(keys, travel_time.values.tolist())), "travel_time")
 
     def _build_lookups(self):
         """
         Loops through edges and connecting nodes build three lookup dictionaries:
             - segment_lookup: return the way id given two nodes. It can return
-            ways even if provided nodes are not sequentially connected
+            ways even if provided nodes are not sequentially connected. Stored
+            as a SegmentIndex, which grows linearly with the number of edges
             - way_lookup: return way metadata given the way id
             - node_lookup: return node metadata given the node id
         """
         # build segment lookup
-        segment_lookup = {}
         segment_lengths = {}
-        way2nodes = {}
+        edge_from = []
+        edge_to = []
+        edge_way = []
         way2nodes_pair = {}
         way_lookup = {}
         way_segment_lengths = {}
@@ -369,12 +910,13 @@ class RouteAnnotator:
                 way_ids = data["osmid"]
 
             for way in way_ids:
-                if way not in way2nodes.keys():
-                    way2nodes[way] = []
+                if way not in way2nodes_pair.keys():
                     way2nodes_pair[way] = []
-                    way_lookup[way] = data
+                    way_lookup[way] = dict(data)  # copy, so way attributes don't overwrite the edge's
                     way_segment_lengths[way] = []
-                way2nodes[way].extend([u, v])  # add all nodes associated to a way
+                edge_from.append(u)  # add edge (u, v) of each way to the segment index
+                edge_to.append(v)
+                edge_way.append(way)
                 way2nodes_pair[way].append(
                     [u, v]
                 )  # add pair of nodes belonging to way id
@@ -413,7 +955,6 @@ class RouteAnnotator:
                         val not in node_sequence
                     ):  # run through `relations` finding the node sequence pair by pair
                         node_sequence.append(val)
-                        count += 1
                         begin_key = val
                         val = relations[begin_key]
                 except Exception as e:  # until a pair is not found in the dict anymore = exception
@@ -422,29 +963,22 @@ class RouteAnnotator:
                     way_id
                 ] = node_sequence  # and store node "ordered" list as a Way metadata
             else:
-                final_node_sequence[way_id] = (
-                    list(keys)[0] + list(values_)[0]
-                )  # if way has only 1 node, store it as it is
+                final_node_sequence[way_id] = [
+                    list(keys)[0],
+                    list(values_)[0],
+                ]  # if way has only 1 node, store it as it is
 
         for key, value in way_lookup.items():
             way_lookup[key]["length"] = np.sum(way_segment_lengths[key])
             way_lookup[key]["node_sequence"] = final_node_sequence[key]
 
-        # build dict: key1: node1, key2: node2, value: way_id between ALL pair of nodes id IN way
-        nodes2way = {}
-        for key, values in way2nodes.items():
-            for pair in combinations(values, 2):
-                if pair[0] not in nodes2way.keys():
-                    nodes2way[pair[0]] = {}
-                nodes2way[pair[0]][pair[1]] = key
-
         # build dict key1: node_id, value: node_metadata
         for node in self.G.nodes(data=True):
             node_lookup[node[0]] = node[1]
 
-        self.segment_lookup_ = nodes2way
-        self.way_lookup_ = way_lookup
-        self.node_lookup_ = node_lookup
+        self.segment_lookup_ = SegmentIndex.from_edges(edge_from, edge_to, edge_way)
+        self.way_lookup_ = ColumnTable.from_dict(way_lookup)
+        self.node_lookup_ = ColumnTable.from_dict(node_lookup)
 
     def segment_lookup(self, node_id_list):
         """
@@ -456,24 +990,24 @@ class RouteAnnotator:
         if both nodes belong to the way.
 
         Parameters:
-        node_id_list (array[int]): node id list.
+        node_id_list (array[int]): node id list. A single id has no pair and
+        gives an empty list
 
         Returns:
         nodes_lookup (array[int]): return ways connecting the nodes. Given
         node_id_list = [1,2,3], segment_lookup will return a list of size 2
         giving the ways that connect nodes [1,2] and [2,3] and so on.
+
+        Raises:
+        KeyError: with the first pair of nodes no way contains. Only the
+        `*_many` lookups mask missing ids, see `segment_lookup_many`
         """
-        if type(node_id_list) == int:
-            return self.segment_lookup_[node_id_list[i]][node_id_list[i + 1]]
-        else:
-            ways_id = []
-            i = 0
-            while i < len(node_id_list) - 1:
-                ways_id.append(
-                    self.segment_lookup_[node_id_list[i]][node_id_list[i + 1]]
-                )
-                i += 1
-            return ways_id
+        node_id_list = np.atleast_1d(np.asarray(node_id_list, dtype=np.int64))
+        ways_id = self.segment_lookup_.lookup_many(node_id_list[:-1], node_id_list[1:])
+        if np.any(ways_id == -1):
+            missing = np.argmax(ways_id == -1)
+            raise KeyError((int(node_id_list[missing]), int(node_id_list[missing + 1])))
+        return ways_id.tolist()
 
     def way_lookup(self, way_id_list):
         """
@@ -488,7 +1022,7 @@ class RouteAnnotator:
         Returns:
         ways_lookup (array[dict]): return ways' metadata in array
         """
-        if type(way_id_list) == int:
+        if np.isscalar(way_id_list):
             return self.way_lookup_[way_id_list]
         else:
             ways_lookup = []
@@ -509,7 +1043,7 @@ class RouteAnnotator:
         Returns:
         nodes_lookup (array[dict]): return nodes' metadata in array
         """
-        if type(node_id_list) == int:
+        if np.isscalar(node_id_list):
             return self.node_lookup_[node_id_list]
         else:
             nodes_lookup = []
@@ -518,31 +1052,353 @@ class RouteAnnotator:
             return nodes_lookup
 
     @staticmethod
-    def AMLD_local_lookups(place, network_type="drive_service"):
+    def _sequence_ids(ids, offsets):
+        """Sequence (e.g. route) each flattened id belongs to"""
+        if offsets is None:
+            return np.zeros(len(ids), dtype=np.int64)
+        return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+    def node_lookup_many(self, node_ids, offsets=None, attributes=("y", "x")):
         """
-        Build RouteAnnotator and load local lookup dictionaries
+        Get metadata of many nodes in one vectorised pass
 
-        OSMnx download the whole city network before processing and this
-        takes a lot of memory. For the AMLD presentation, we load already saved
-        dictionaries as downloading the network was breaking Docker container
+        Parameters:
+        node_ids (array[int]): node ids, flat or the values of a ragged array
+        offsets (array[int]): if given, sequence i is node_ids[offsets[i]:offsets[i + 1]],
+        e.g., node_ids and node_offsets from OSRMFramework.route_many
+        attributes (array[str]): node attributes to return. None for all
+
+        Returns:
+        pandas.DataFrame: one row per node id, in input order, with columns
+        node_id, found, the requested attributes (NaN/None for unknown nodes)
+        and `sequence` if offsets are given
+
+        Example:
+        routes = osm.route_many(...)
+        nodes = ra.node_lookup_many(routes['node_ids'], routes['node_offsets'])
+        nodes[['y', 'x']]  # lat/lon of every node of every route
+        """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        nodes = self.node_lookup_.take(node_ids, None if attributes is None else list(attributes))
+        nodes.insert(0, "node_id", node_ids)
+        if offsets is not None:
+            nodes.insert(0, "sequence", self._sequence_ids(node_ids, offsets))
+        return nodes
+
+    def way_lookup_many(self, way_ids, attributes=None):
+        """
+        Get metadata of many ways in one vectorised pass
+
+        Parameters:
+        way_ids (array[int]): way ids, -1 or unknown ids give missing values
+        attributes (array[str]): way attributes to return, e.g.
+        ['highway', 'maxspeed', 'length']. None for all
+
+        Returns:
+        pandas.DataFrame: one row per way id, in input order, with columns
+        way_id, found and the requested attributes (NaN/None for unknown ways)
+        """
+        way_ids = np.asarray(way_ids, dtype=np.int64)
+        ways = self.way_lookup_.take(way_ids, None if attributes is None else list(attributes))
+        ways.insert(0, "way_id", way_ids)
+        return ways
+
+    def segment_lookup_many(self, node_ids, offsets=None, way_attributes=None):
+        """
+        Get the way of every consecutive pair of nodes in one vectorised pass
+
+        Parameters:
+        node_ids (array[int]): node ids, flat or the values of a ragged array.
+        Pairs are never built across two sequences
+        offsets (array[int]): if given, sequence i is node_ids[offsets[i]:offsets[i + 1]]
+        way_attributes (array[str]): way attributes to join to each segment,
+        e.g. ['highway', 'maxspeed']
+
+        Returns:
+        pandas.DataFrame: one row per segment with columns from_node, to_node,
+        way_id (-1 if no way contains both nodes), `sequence` if offsets are
+        given and the requested way attributes
+
+        Example:
+        routes = osm.route_many(...)
+        segments = ra.segment_lookup_many(routes['node_ids'], routes['node_offsets'], ['maxspeed'])
+        """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        sequence = self._sequence_ids(node_ids, offsets)
+        # a pair is valid when both nodes belong to the same sequence
+        same_sequence = sequence[:-1] == sequence[1:]
+        from_node, to_node = node_ids[:-1][same_sequence], node_ids[1:][same_sequence]
+
+        segments = pd.DataFrame({"from_node": from_node, "to_node": to_node})
+        segments["way_id"] = self.segment_lookup_.lookup_many(from_node, to_node)
+        if offsets is not None:
+            segments.insert(0, "sequence", sequence[:-1][same_sequence])
+        if way_attributes is not None:
+            ways = self.way_lookup_.take(segments["way_id"].values, list(way_attributes))
+            for attribute in way_attributes:
+                segments[attribute] = ways[attribute].values
+        return segments
+
+    def save_lookups(self, path):
+        """
+        Save node, way and segment lookups as memory-mappable columns
+
+        Each lookup goes to its own folder of .npy files (see
+        lookup_store.ColumnTable and SegmentIndex), which `load_lookups` opens
+        without reading them into memory.
 
         Parameters:
+        path (str): output folder, e.g. 'data/AMLD_lookups'
+        """
+        self.node_lookup_.save(os.path.join(path, "nodes"))
+        self.way_lookup_.save(os.path.join(path, "ways"))
+        self.segment_lookup_.save(os.path.join(path, "segments"))
+
+    @staticmethod
+    def load_lookups(path, place=None, network_type="drive_service"):
+        """
+        Build RouteAnnotator with lookups saved by `save_lookups`
+
+        Lookups are memory-mapped, so loading takes the same time for any
+        city size and worker processes loading the same folder share the
+        same physical memory.
+
+        Parameters:
+        path (str): folder given to `save_lookups`
         place (str): place to be inverse geocoded by nominatin in OSMnx
         network_type (str): type of network. Check OSMnx
 
         Returns:
         ra (RouteAnnotator): object with loaded lookups
+
+        Example:
+        ra.save_lookups('data/AMLD_lookups')
+        ra = RouteAnnotator.load_lookups('data/AMLD_lookups', 'new york, USA')
         """
         ra = RouteAnnotator(place, network_type)
-        with open("data/AMLD_lookups.pickle", "rb") as f:
-            node_lookup_, segment_lookup_, way_lookup_ = pickle.load(f)
-        ra.node_lookup_ = node_lookup_
-        ra.segment_lookup_ = segment_lookup_
-        ra.way_lookup_ = way_lookup_
+        ra.node_lookup_ = ColumnTable.load(os.path.join(path, "nodes"))
+        ra.way_lookup_ = ColumnTable.load(os.path.join(path, "ways"))
+        ra.segment_lookup_ = SegmentIndex.load(os.path.join(path, "segments"))
         return ra
 
+    @staticmethod
+    def AMLD_local_lookups(place, network_type="drive_service", path="data/AMLD_lookups"):
+        """
+        Build RouteAnnotator and load local lookups
+
+        OSMnx download the whole city network before processing and this
+        takes a lot of memory. For the AMLD presentation, we load already saved
+        lookups as downloading the network was breaking Docker container.
+        The first call converts the dictionaries of `path`.pickle to the
+        memory-mapped folder `path` (see `save_lookups`), later calls only
+        map that folder.
+
+        Parameters:
+        place (str): place to be inverse geocoded by nominatin in OSMnx
+        network_type (str): type of network. Check OSMnx
+        path (str): lookups folder, converted from `path`.pickle if missing
+
+        Returns:
+        ra (RouteAnnotator): object with loaded lookups
+        """
+        if not os.path.isdir(path):
+            ra = RouteAnnotator(place, network_type)
+            with open(f"{path}.pickle", "rb") as f:
+                node_lookup_, segment_lookup_, way_lookup_ = pickle.load(f)
+            ra.node_lookup_ = ColumnTable.from_dict(node_lookup_)
+            ra.segment_lookup_ = SegmentIndex.from_nested_dict(segment_lookup_)
+            ra.way_lookup_ = ColumnTable.from_dict(way_lookup_)
+            # an interrupted conversion must not leave a folder that looks complete
+            ra.save_lookups(f"{path}.tmp")
+            os.replace(f"{path}.tmp", path)
+        return RouteAnnotator.load_lookups(path, place, network_type)
+
+
+def _md5_sidecar(session, url, timeout):
+    """Expected md5 of a download from its .md5 sidecar, None when the server has none"""
+    try:
+        response = session.get(url + ".md5", timeout=timeout)
+    except requests.RequestException:
+        return None
+    fields = response.text.split() if response.status_code == 200 else []
+    return fields[0].lower() if fields else None
+
+
+def _file_md5(path, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _remove_part(part_path):
+    for name in (part_path, part_path + ".validator"):
+        if os.path.exists(name):
+            os.remove(name)
+
+
+def _download_part(session, url, part_path, chunk_size, max_retries, timeout, verbose, backoff):
+    """
+    Download url to part_path, resuming what is already there
+
+    A resume sends the ETag, or Last-Modified, seen when the part file was
+    started as If-Range: if the file changed on the server since, the
+    server sends it whole instead of the range.
+
+    Returns:
+    bool: whether bytes were appended to an existing part file
+    """
+    validator_path = part_path + ".validator"
+    resumed = False
+    for attempt in range(max_retries + 1):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset and not os.path.exists(validator_path):
+            # part file of unknown origin, it cannot be safely resumed
+            offset = 0
+        headers = {}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+            with open(validator_path) as f:
+                validator = f.read()
+            if validator:
+                headers["If-Range"] = validator
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+                if response.status_code == 416:
+                    total = response.headers.get("Content-Range", "").split("/")[-1]
+                    if total.isdigit() and int(total) == offset:
+                        # nothing left after offset: the part file is complete
+                        break
+                    # the part file is longer than the remote file
+                    _remove_part(part_path)
+                    if attempt == max_retries:
+                        raise IOError(f"{part_path} is longer than {url}, it was removed")
+                    continue
+                response.raise_for_status()
+                if response.status_code == 206:
+                    mode, size = "ab", int(response.headers["Content-Range"].split("/")[-1])
+                    resumed = True
+                else:
+                    mode, size = "wb", int(response.headers.get("Content-Length", -1))
+                    with open(validator_path, "w") as f:
+                        f.write(response.headers.get("ETag") or response.headers.get("Last-Modified") or "")
+                with open(part_path, mode) as f:
+                    for chunk in response.iter_content(chunk_size):
+                        f.write(chunk)
+            if size >= 0 and os.path.getsize(part_path) < size:
+                raise requests.ConnectionError(f"connection closed at {os.path.getsize(part_path)} of {size} bytes")
+            return resumed
+        except requests.RequestException as error:
+            client_error = isinstance(error, requests.HTTPError) and error.response.status_code < 500
+            if client_error or attempt == max_retries:
+                raise
+            if verbose:
+                print(f"Download of {url} interrupted ({error}), resuming")
+            time.sleep(min(backoff * 2 ** attempt, 30))
+    return resumed
+
+
+def download_file(
+    url,
+    path,
+    chunk_size=DOWNLOAD_CHUNK_SIZE,
+    max_retries=5,
+    timeout=60,
+    check_md5=True,
+    session=None,
+    verbose=False,
+    backoff=1.0,
+):
+    """
+    Download a large file to disk in fixed-size chunks, resuming after failures
+
+    Bytes go to `path + '.part'` as they arrive, so memory stays at one
+    chunk whatever the file size. After a dropped connection, and on a
+    later call after a crash, the download resumes from the end of the
+    part file with an HTTP Range request, conditional on the file being
+    unchanged on the server (If-Range). Servers that ignore ranges send
+    the whole file again. The file is checked against the `url + '.md5'`
+    sidecar published by Geofabrik, when there is one, and only then
+    renamed to `path`. A resumed download failing the check is downloaded
+    again once from the start.
+
+    Parameters:
+    url (str): file to download
+    path (str): destination
+    chunk_size (int): bytes read and written at a time
+    max_retries (int): resumes after connection errors, timeouts and 5xx responses
+    timeout (float): seconds to wait for the server
+    check_md5 (bool): verify the .md5 sidecar
+    session (requests.Session): session to use, e.g. to share connections
+    verbose (bool): print resumes and restarts
+    backoff (float): seconds before the first resume, doubled at each one
+    up to 30 s. 0 resumes at once
+
+    Returns:
+    str: path
+    """
+    session = session or requests.Session()
+    expected_md5 = _md5_sidecar(session, url, timeout) if check_md5 else None
+    part_path = path + ".part"
+
+    resumed = _download_part(session, url, part_path, chunk_size, max_retries, timeout, verbose, backoff)
+    if expected_md5 is not None:
+        md5 = _file_md5(part_path, chunk_size)
+        if md5 != expected_md5 and resumed:
+            if verbose:
+                print(f"md5 of {url} is {md5} after resuming, downloading it again")
+            _remove_part(part_path)
+            _download_part(session, url, part_path, chunk_size, max_retries, timeout, verbose, backoff)
+            md5 = _file_md5(part_path, chunk_size)
+        if md5 != expected_md5:
+            _remove_part(part_path)
+            raise IOError(f"md5 of {url} is {md5}, expected {expected_md5}. The partial file was removed")
+    os.replace(part_path, path)
+    _remove_part(part_path)
+    return path
+
+
+def download_files(urls, paths, max_workers=4, **kwargs):
+    """
+    Download several files concurrently with `download_file`
+
+    Parameters:
+    urls (array[str]): files to download
+    paths (array[str]): destination of each file
+    max_workers (int): concurrent downloads
+    kwargs: passed to `download_file`
+
+    Returns:
+    array[str]: paths
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda url_path: download_file(*url_path, **kwargs), zip(urls, paths)))
+
+
+def osrm_data_version(osrm_files_path: str, place_name: str, traffic_file_name: str = None) -> str:
+    """
+    Version of the data a router built by run_osrm_docker serves, for RouteCache
+
+    Parameters:
+    osrm_files_path (str): folder with the {place_name}.osm.pbf extract
+    place_name (str): place name, as given to run_osrm_docker
+    traffic_file_name (str): segment-speed file in osrm_files_path, if any
+
+    Returns:
+    str: file versions of the extract and the traffic file
+
+    Example:
+    cache.set_data_version(osrm_data_version('data', 'hamburg', 'test_traffic.csv'))
+    """
+    version = file_version(f"{osrm_files_path}/{place_name.lower()}.osm.pbf")
+    if traffic_file_name is not None:
+        version += "+" + file_version(f"{osrm_files_path}/{traffic_file_name}")
+    return version
+
+
 def run_osrm_docker(
-    osrm_files_path: str, place_name: str, traffic_file_name: str = None, download_pbf: bool = True
+    osrm_files_path: str, place_name: str, traffic_file_name: str = None, download_pbf: bool = True, cache=None
 ) -> str:
     """ Run a custom osrm-backend container..
 
@@ -558,6 +1414,7 @@ def run_osrm_docker(
         :param plot_2_type: one of ['density', 'histogram'] for data source 2
         :param plot_config: plt.plot parameters as dictionary. Check 'plot_properties' for available features
         :param axis: pyplot axis. Usually created by plt.subplots(nrow, ncol) and plot subplots
+        :param cache: optional route_cache.RouteCache, tied to the new extract and traffic file with osrm_data_version
         """
     # os.system("docker pull osrm/osrm-backend:v5.22.0")
     pbf_city2url = {
@@ -579,30 +1436,25 @@ def run_osrm_docker(
     }
     place_name = place_name.lower()
     if download_pbf:
-        if not os.path.isfile(f"{osrm_files_path}/{place_name}.osm.pbf"):
+        pbf_path = f"{osrm_files_path}/{place_name}.osm.pbf"
+        if not os.path.isfile(pbf_path):
             pbf_url = pbf_city2url[place_name]
             print(f"\nDownloading pbf file for {place_name} at {pbf_url}")
-            if place_name != "hamburg":
-                r = requests.get(pbf_url)
-                with open(f'{osrm_files_path}/{place_name}.osm.pbf', 'wb') as f:
-                    f.write(r.content)
+            if isinstance(pbf_url, str):
+                download_file(pbf_url, pbf_path, verbose=True)
             else:
-                i = 1
-                for pbf_url_ in pbf_url:
-                    r = requests.get(pbf_url_)
-                    with open(f'{osrm_files_path}/hamburg_{i}.osm.pbf', 'wb') as f:
-                        f.write(r.content)
-                    i += 1
-                os.system(f"osmium merge {osrm_files_path}/hamburg_1.osm.pbf {osrm_files_path}/hamburg_2.osm.pbf"
-                          + f" -o {osrm_files_path}/hh-sh.osm.pbf")
-                os.remove(f"{osrm_files_path}/hamburg_1.osm.pbf")
-                os.remove(f"{osrm_files_path}/hamburg_2.osm.pbf")
-                os.system(f"osmium merge {osrm_files_path}/hh-sh.osm.pbf {osrm_files_path}/hamburg_3.osm.pbf"
-                          + f" -o {osrm_files_path}/hamburg.osm.pbf")
-                os.remove(f"{osrm_files_path}/hh-sh.osm.pbf")
-                os.remove(f"{osrm_files_path}/hamburg_3.osm.pbf")
+                # regions are fetched concurrently, then merged in one pass
+                region_paths = [f"{osrm_files_path}/{place_name}_{i}.osm.pbf" for i in range(1, len(pbf_url) + 1)]
+                download_files(pbf_url, region_paths, verbose=True)
+                if os.system(f"osmium merge {' '.join(region_paths)} -o {pbf_path}") != 0:
+                    # a partial output would be taken for a complete file on the next run
+                    if os.path.exists(pbf_path):
+                        os.remove(pbf_path)
+                    raise RuntimeError(f"osmium merge of {region_paths} failed, the regions were kept")
+                for region_path in region_paths:
+                    os.remove(region_path)
         else:
-            print(f"File {osrm_files_path}/{place_name}.osm.pbf already exists.")
+            print(f"File {pbf_path} already exists.")
 
     print(f"\nExtracting graph data... at {osrm_files_path}")
     command = f"docker run -t -v {osrm_files_path}:/data osrm/osrm-backend osrm-extract "\
@@ -624,6 +1476,9 @@ def run_osrm_docker(
              + f"osrm-customize /data/{place_name}.osm {traffic_file_str}"
     print(command)
     os.system(command)
+    if cache is not None:
+        # responses of the previous extract or traffic file are dropped
+        cache.set_data_version(osrm_data_version(osrm_files_path, place_name, traffic_file_name))
 
     print("Running Router...")
     command = f"docker run --name python_docker_{place_name} -d -t -i -p 5000:5000 " \
@@ -0,0 +1,236 @@
+import numpy as np
+from lookup_store import save_arrays, load_arrays
+
+ARRAY_NAMES = ["node_ids", "way_ids", "way_order", "edge_keys", "edge_ways", "member_keys", "member_first", "member_last"]
+
+
+class SegmentIndex:
+    """
+    Compact "which way connects node a and node b" index
+
+    Replaces the nested dict with every pair of nodes of every way, which
+    grows quadratically with the number of nodes per way. Sorted int64 key
+    arrays are kept instead, growing linearly with the edges:
+
+    - member keys: (node, way) for every node of every way, with the first
+    and last position of the node in the way's node list, the [u, v] of its
+    edges in graph order. As in the nested dict, which paired each node
+    with the nodes after it in that list, node b follows node a on a way
+    if a first appears before b last appears. Nodes that aren't directly
+    connected are found, and one-way ways don't match backwards
+    - edge keys: explicit (from node, to node) pairs and their way, only
+    used for indexes converted from a nested dict, whose pairs are kept as
+    they are
+
+    When several ways contain a pair, the way whose first edge comes last
+    wins, as later ways overwrote earlier ones in the nested dict.
+
+    Nodes and ways are stored by their position in the sorted `node_ids` and
+    `way_ids` arrays, which makes the keys fit in a single int64.
+
+    Example:
+    index = SegmentIndex.from_edges(edge_from=[1, 2], edge_to=[2, 3], edge_way=[100, 100])
+    index.lookup(1, 3)  # 100
+    index.lookup(3, 1)  # KeyError, the way only goes from 1 to 3
+    """
+
+    def __init__(self, node_ids, way_ids, way_order, edge_keys, edge_ways, member_keys, member_first, member_last):
+        """
+        Parameters:
+        node_ids (array[int]): sorted OSM node ids
+        way_ids (array[int]): sorted OSM way ids
+        way_order (array[int]): position of the first edge of each way, the
+        last way containing a pair wins
+        edge_keys (array[int]): sorted from_node_ix * len(node_ids) + to_node_ix
+        of the explicit pairs
+        edge_ways (array[int]): way position of each edge key
+        member_keys (array[int]): sorted node_ix * len(way_ids) + way_ix
+        member_first (array[int]): first position of each member in its way's node list
+        member_last (array[int]): last position of each member in its way's node list
+        """
+        self.node_ids = node_ids
+        self.way_ids = way_ids
+        self.way_order = way_order
+        self.edge_keys = edge_keys
+        self.edge_ways = edge_ways
+        self.member_keys = member_keys
+        self.member_first = member_first
+        self.member_last = member_last
+
+    @classmethod
+    def from_edges(cls, edge_from, edge_to, edge_way):
+        """
+        Build the index from the graph edges
+
+        Parameters:
+        edge_from (array[int]): OSM node id where each edge starts
+        edge_to (array[int]): OSM node id where each edge ends
+        edge_way (array[int]): OSM way id of each edge, in graph order. Edges
+        belonging to several ways appear once per way
+
+        Returns:
+        SegmentIndex: index
+        """
+        edge_from = np.asarray(edge_from, dtype=np.int64)
+        edge_to = np.asarray(edge_to, dtype=np.int64)
+        edge_way = np.asarray(edge_way, dtype=np.int64)
+
+        node_ids, node_ix = np.unique(np.concatenate([edge_from, edge_to]), return_inverse=True)
+        node_ix = node_ix.ravel()
+        from_ix, to_ix = node_ix[: len(edge_from)], node_ix[len(edge_from) :]
+        way_ids, way_first, way_ix = np.unique(edge_way, return_index=True, return_inverse=True)
+        way_ix = way_ix.ravel()
+
+        # rank of each edge within its way: its nodes are at 2 * rank and 2 * rank + 1
+        by_way = np.argsort(way_ix, kind="stable")
+        group_start = np.searchsorted(way_ix[by_way], way_ix[by_way])
+        rank = np.empty(len(edge_way), dtype=np.int64)
+        rank[by_way] = np.arange(len(edge_way)) - group_start
+
+        keys = np.concatenate([from_ix * len(way_ids) + way_ix, to_ix * len(way_ids) + way_ix])
+        positions = np.concatenate([2 * rank, 2 * rank + 1])
+        order = np.lexsort([positions, keys])
+        keys, positions = keys[order], positions[order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])[: len(keys)]
+        ends = np.r_[starts[1:], len(keys)][: len(starts)] - 1
+        empty = np.empty(0, dtype=np.int64)
+        return cls(node_ids, way_ids, way_first.astype(np.int64), empty, empty.astype(np.int32),
+                   keys[starts], positions[starts], positions[ends])
+
+    @classmethod
+    def from_nested_dict(cls, segment_lookup):
+        """
+        Build the index from the legacy {node_a: {node_b: way_id}} lookup
+
+        Parameters:
+        segment_lookup (dict): nested dict lookup, e.g., from AMLD_lookups.pickle
+
+        Returns:
+        SegmentIndex: index
+        """
+        edge_from, edge_to, edge_way = [], [], []
+        for node_a, ways in segment_lookup.items():
+            edge_from.extend([node_a] * len(ways))
+            edge_to.extend(ways.keys())
+            edge_way.extend(ways.values())
+        edge_from = np.asarray(edge_from, dtype=np.int64)
+        edge_to = np.asarray(edge_to, dtype=np.int64)
+        edge_way = np.asarray(edge_way, dtype=np.int64)
+
+        # the dict already holds every pair, they are kept as explicit pairs
+        node_ids, node_ix = np.unique(np.concatenate([edge_from, edge_to]), return_inverse=True)
+        node_ix = node_ix.ravel()
+        way_ids, way_ix = np.unique(edge_way, return_inverse=True)
+        edge_keys = node_ix[: len(edge_from)] * len(node_ids) + node_ix[len(edge_from) :]
+        order = np.argsort(edge_keys)
+        empty = np.empty(0, dtype=np.int64)
+        return cls(node_ids, way_ids, np.arange(len(way_ids)), edge_keys[order], way_ix.ravel()[order].astype(np.int32),
+                   empty, empty, empty)
+
+    def save(self, path):
+        """
+        Save the index arrays as .npy files
+
+        Parameters:
+        path (str): directory, created if needed
+        """
+        save_arrays(path, {name: getattr(self, name) for name in ARRAY_NAMES})
+
+    @classmethod
+    def load(cls, path):
+        """
+        Memory-map an index saved with `save`
+
+        Parameters:
+        path (str): directory
+
+        Returns:
+        SegmentIndex: index backed by read-only memmaps
+        """
+        return cls(**load_arrays(path, ARRAY_NAMES))
+
+    def node_positions(self, node_ids):
+        """
+        Positions of node ids in `node_ids`, -1 for unknown nodes
+
+        Parameters:
+        node_ids (array[int]): OSM node ids
+
+        Returns:
+        array[int]: positions
+        """
+        return self._search(self.node_ids, np.asarray(node_ids, dtype=np.int64))
+
+    @staticmethod
+    def _search(sorted_keys, keys):
+        """Position of each key in sorted_keys, -1 if missing"""
+        if len(sorted_keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        ix = np.searchsorted(sorted_keys, keys)
+        ix[ix == len(sorted_keys)] = 0
+        return np.where(sorted_keys[ix] == keys, ix, -1)
+
+    def lookup_many(self, from_nodes, to_nodes):
+        """
+        Way connecting each pair of nodes, in one vectorised pass
+
+        Parameters:
+        from_nodes (array[int]): OSM node ids
+        to_nodes (array[int]): OSM node ids
+
+        Returns:
+        array[int]: OSM way id per pair, -1 if no way contains both nodes
+        """
+        from_ix = self.node_positions(from_nodes)
+        to_ix = self.node_positions(to_nodes)
+        known = (from_ix >= 0) & (to_ix >= 0)
+        way_ix = np.full(len(from_ix), -1, dtype=np.int64)
+
+        # 1. explicit pairs
+        edge_pos = self._search(self.edge_keys, from_ix * len(self.node_ids) + to_ix)
+        direct = known & (edge_pos >= 0)
+        way_ix[direct] = self.edge_ways[edge_pos[direct]]
+
+        # 2. nodes on the same way, in order: expand the ways of each from
+        # node and keep the last one where the to node comes after it
+        pending = np.flatnonzero(known & ~direct)
+        if len(pending) > 0 and len(self.member_keys) > 0:
+            n_ways = len(self.way_ids)
+            starts = np.searchsorted(self.member_keys, from_ix[pending] * n_ways)
+            ends = np.searchsorted(self.member_keys, (from_ix[pending] + 1) * n_ways)
+            counts = ends - starts
+            pair = np.repeat(pending, counts)
+            from_member = np.repeat(starts, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            candidate_way = self.member_keys[from_member] % n_ways
+            to_member = self._search(self.member_keys, to_ix[pair] * n_ways + candidate_way)
+            shared = to_member >= 0
+            shared[shared] = self.member_first[from_member[shared]] < self.member_last[to_member[shared]]
+            pair, candidate_way = pair[shared], candidate_way[shared]
+            order = np.lexsort([-self.way_order[candidate_way], pair])
+            pair, candidate_way = pair[order], candidate_way[order]
+            first = np.unique(pair, return_index=True)[1]
+            way_ix[pair[first]] = candidate_way[first]
+
+        way_ids = np.full(len(way_ix), -1, dtype=np.int64)
+        way_ids[way_ix >= 0] = self.way_ids[way_ix[way_ix >= 0]]
+        return way_ids
+
+    def lookup(self, node_a, node_b):
+        """
+        Way connecting two nodes
+
+        Parameters:
+        node_a (int): OSM node id
+        node_b (int): OSM node id
+
+        Returns:
+        int: OSM way id. Raises KeyError if no way contains both nodes
+        """
+        way_id = self.lookup_many([node_a], [node_b])[0]
+        if way_id == -1:
+            raise KeyError((node_a, node_b))
+        return int(way_id)
+
+    def nbytes(self):
+        """Memory used by the index arrays, in bytes"""
+        return sum(getattr(self, name).nbytes for name in ARRAY_NAMES)
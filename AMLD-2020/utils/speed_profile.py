@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+
+MPH_TO_KMH = 1.609344
+KNOTS_TO_KMH = 1.852
+
+# implicit speed limits written as words, e.g. 'DE:urban' or 'walk'
+MAXSPEED_ZONES = {
+    "urban": 50,
+    "rural": 90,
+    "living_street": 10,
+    "walk": 6,
+}
+
+
+def parse_maxspeed(maxspeed):
+    """
+    Convert raw OSM maxspeed tags to km/h in one vectorised pass
+
+    Handles numbers, numeric strings ('50'), units ('25 mph', '10 knots'),
+    several values ('50;30' or lists such as ['40', '50'], the lowest is
+    kept) and implicit zones ('DE:urban', 'walk'). Values without a speed,
+    such as 'signals', 'variable' or 'none', are NaN.
+
+    Parameters:
+    maxspeed (pandas.Series): raw maxspeed values
+
+    Returns:
+    pandas.Series: speed in km/h, same index as maxspeed
+    """
+    text = maxspeed.reset_index(drop=True).astype(str).str.lower()
+
+    numbers = text.str.extractall(r"(?P<speed>\d+(?:\.\d+)?)\s*(?P<unit>mph|knots)?")
+    speed = numbers["speed"].astype(float)
+    speed = speed.where(numbers["unit"] != "mph", speed * MPH_TO_KMH)
+    speed = speed.where(numbers["unit"] != "knots", speed * KNOTS_TO_KMH)
+    speed = speed.groupby(level=0).min().reindex(text.index)
+
+    zones = text.str.extract("(" + "|".join(MAXSPEED_ZONES) + ")", expand=False).map(MAXSPEED_ZONES)
+
+    return pd.Series(speed.fillna(zones.astype(float)).values, index=maxspeed.index)
+
+
+def highway_speed(highway, highway_speed_limits):
+    """
+    Default speed of each highway type, in one vectorised pass
+
+    Parameters:
+    highway (pandas.Series): OSM highway values. Lists are allowed, the
+    first type found in highway_speed_limits is used
+    highway_speed_limits (dict): highway type -> km/h
+
+    Returns:
+    pandas.Series: speed in km/h, NaN for unknown types, same index as highway
+    """
+    types = highway.reset_index(drop=True).astype(str).str.extractall(r"([a-z_]+)")[0]
+    speed = types.map(highway_speed_limits).groupby(level=0).first().reindex(range(len(highway)))
+    return pd.Series(speed.values, index=highway.index)
+
+
+def speed_profile(
+    edges,
+    highway_speed_limits,
+    speed_multiplier=1.0,
+    hour=None,
+    hourly_overrides=None,
+    default_highway="unclassified",
+):
+    """
+    Compute maxspeed and travel time of every edge in one vectorised pass
+
+    The tagged maxspeed is used when it can be parsed, the highway type
+    default otherwise. The speed actually driven is the maxspeed times
+    `speed_multiplier` and, if `hour` is given, times its hourly override.
+
+    Parameters:
+    edges (pandas.DataFrame): one row per edge with `length` (meters),
+    `highway` and optionally `maxspeed`, e.g. from RouteAnnotator graph edges
+    highway_speed_limits (dict): highway type -> km/h
+    speed_multiplier (float): ratio of the speed limit actually driven
+    hour (int): hour of the day to apply `hourly_overrides` for
+    hourly_overrides (dict): hour -> multiplier, or hour -> {highway type: multiplier},
+    e.g. {8: {'primary': 0.5}} to halve primary roads' speed at 8h
+    default_highway (str): highway type used when neither maxspeed nor the
+    edge's highway type give a speed
+
+    Returns:
+    maxspeed (pandas.Series): speed limit in km/h
+    travel_time (pandas.Series): seconds to drive the edge
+
+    Example:
+    edges = pd.DataFrame({'length': [100, 100], 'highway': ['primary', 'residential'],
+                          'maxspeed': ['30 mph', np.nan]})
+    maxspeed, travel_time = speed_profile(edges, ra.HIGHWAY_SPEED_LIMITS, speed_multiplier=0.8)
+    """
+    default_speed = highway_speed(edges["highway"], highway_speed_limits)
+    if "maxspeed" in edges:
+        maxspeed = parse_maxspeed(edges["maxspeed"]).fillna(default_speed)
+    else:
+        maxspeed = default_speed
+    maxspeed = maxspeed.fillna(highway_speed_limits[default_highway])
+
+    driven_speed = maxspeed * speed_multiplier
+    if hour is not None and hourly_overrides is not None and hour in hourly_overrides:
+        override = hourly_overrides[hour]
+        if isinstance(override, dict):
+            types = edges["highway"].astype(str).str.extract(r"([a-z_]+)", expand=False)
+            driven_speed = driven_speed * types.map(override).fillna(1.0)
+        else:
+            driven_speed = driven_speed * override
+
+    travel_time = edges["length"] / (driven_speed / 3.6)
+    return maxspeed, travel_time
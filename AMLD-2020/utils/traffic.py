@@ -0,0 +1,213 @@
+import os
+import numpy as np
+import pandas as pd
+
+
+def explode_segments(node_ids, node_offsets):
+    """
+    Consecutive node pairs of many routes, without Python loops
+
+    Parameters:
+    node_ids (array[int]): node ids of all routes concatenated, e.g. from OSRMFramework.route_many
+    node_offsets (array[int]): route i is node_ids[node_offsets[i]:node_offsets[i + 1]]
+
+    Returns:
+    from_nodes (array[int]): node where each segment starts
+    to_nodes (array[int]): node where each segment ends
+    route (array[int]): route of each segment
+    position (array[int]): position of each segment's first node in node_ids
+    """
+    node_ids = np.asarray(node_ids, dtype=np.int64)
+    node_offsets = np.asarray(node_offsets, dtype=np.int64)
+    route = np.repeat(np.arange(len(node_offsets) - 1), np.diff(node_offsets))
+    # a pair is a segment if both nodes belong to the same route and differ
+    position = np.flatnonzero(
+        (route[:-1] == route[1:]) & (node_ids[:-1] != node_ids[1:]) & (node_ids[:-1] >= 0) & (node_ids[1:] >= 0)
+    )
+    return node_ids[position], node_ids[position + 1], route[position], position
+
+
+def _group_sum(keys, values):
+    """Sum values by unique rows of keys (sort based): unique keys, summed values"""
+    order = np.lexsort(keys[::-1])
+    keys = [key[order] for key in keys]
+    values = [value[order] for value in values]
+    if len(order) == 0:
+        return keys, values
+    new_group = np.ones(len(order), dtype=bool)
+    new_group[1:] = np.any([key[1:] != key[:-1] for key in keys], axis=0)
+    starts = np.flatnonzero(new_group)
+    return [key[starts] for key in keys], [np.add.reduceat(value, starts) for value in values]
+
+
+def _records(keys):
+    """Rows of keys as a structured array, ordered like np.lexsort(keys[::-1])"""
+    records = np.empty(len(keys[0]), dtype=[(f"k{i}", key.dtype) for i, key in enumerate(keys)])
+    for i, key in enumerate(keys):
+        records[f"k{i}"] = key
+    return records
+
+
+def _merge_sum(keys, values, new_keys, new_values):
+    """
+    Add grouped rows to a grouped table, both sorted by unique keys as _group_sum returns them
+
+    Existing keys are found with a binary search and new ones inserted in
+    place, so the table is not sorted again.
+    """
+    table, new = _records(keys), _records(new_keys)
+    position = np.searchsorted(table, new)
+    found = position < len(table)
+    found[found] = table[position[found]] == new[found]
+    values = [value.copy() for value in values]
+    for value, new_value in zip(values, new_values):
+        value[position[found]] += new_value[found]
+    insert = position[~found]
+    return ([np.insert(key, insert, new_key[~found]) for key, new_key in zip(keys, new_keys)],
+            [np.insert(value, insert, new_value[~found]) for value, new_value in zip(values, new_values)])
+
+
+class TrafficAggregator:
+    """
+    Segment counts and observed speeds per time bin, built incrementally
+
+    Routed or matched trips are exploded into (from node, to node) segments,
+    binned by their trip timestamp and aggregated with a sort based group
+    by. Chunks can be added one after the other: only the aggregated table
+    is kept, so month-long logs fit in memory, and each chunk is grouped on
+    its own and merged into it. The result is written as OSRM
+    segment speed files, one per bin, ready for restart_osrm_traffic.sh.
+
+    Example:
+    aggregator = TrafficAggregator(bin_seconds=3600, period_seconds=86400)  # hour of the day profiles
+    for chunk in pd.read_csv('data/train.csv', chunksize=100000):
+        routes = osrm.route_many(chunk['pickup_latitude'], chunk['pickup_longitude'],
+                                 chunk['dropoff_latitude'], chunk['dropoff_longitude'])
+        aggregator.add(routes['node_ids'], routes['node_offsets'], chunk['pickup_datetime'],
+                       speeds=routes['distance'] / chunk['trip_duration'] * 3.6)
+    aggregator.write_speed_files('data/traffic_{bin}.csv')
+    """
+
+    def __init__(self, bin_seconds=3600, period_seconds=None):
+        """
+        Parameters:
+        bin_seconds (int): bin width, e.g. 600 for 10 minutes bins
+        period_seconds (int): fold the bins over this period to build
+        historical profiles, e.g. 86400 for hour of the day bins. Defaults
+        to absolute time bins
+        """
+        self.bin_seconds = bin_seconds
+        self.period_seconds = period_seconds
+        self.bins = np.empty(0, dtype=np.int64)
+        self.from_nodes = np.empty(0, dtype=np.int64)
+        self.to_nodes = np.empty(0, dtype=np.int64)
+        self.records = np.empty(0, dtype=np.int64)
+        self.speed_sums = np.empty(0, dtype=float)
+        self.speed_records = np.empty(0, dtype=np.int64)
+
+    def _bins(self, timestamps):
+        seconds = pd.to_datetime(pd.Series(timestamps)).values.astype("datetime64[s]").astype(np.int64)
+        if self.period_seconds is not None:
+            seconds = seconds % self.period_seconds
+        return seconds // self.bin_seconds
+
+    def add(self, node_ids, node_offsets, timestamps, speeds=None, segment_speeds=None):
+        """
+        Add a chunk of trips
+
+        Parameters:
+        node_ids (array[int]): node ids of all trips concatenated, -1 for unknown nodes
+        node_offsets (array[int]): trip i is node_ids[node_offsets[i]:node_offsets[i + 1]]
+        timestamps (array[datetime]): time of each trip, e.g. its pickup time
+        speeds (array[float]): observed km/h of each trip, applied to all its segments
+        segment_speeds (array[float]): observed km/h aligned with node_ids, value k
+        for the segment from node_ids[k] to node_ids[k + 1], e.g. from matched traces.
+        Used instead of speeds
+
+        Returns:
+        int: number of segments added
+        """
+        from_nodes, to_nodes, trip, position = explode_segments(node_ids, node_offsets)
+        bins = self._bins(timestamps)[trip]
+
+        if segment_speeds is not None:
+            speed = np.asarray(segment_speeds, dtype=float)[position]
+        elif speeds is not None:
+            speed = np.asarray(speeds, dtype=float)[trip]
+        else:
+            speed = np.full(len(trip), np.nan)
+        observed = np.isfinite(speed)
+
+        # the chunk is grouped on its own, then merged into the sorted table
+        keys, values = _merge_sum(
+            [self.bins, self.from_nodes, self.to_nodes],
+            [self.records, self.speed_sums, self.speed_records],
+            *_group_sum(
+                [bins, from_nodes, to_nodes],
+                [np.ones(len(trip), dtype=np.int64), np.where(observed, speed, 0), observed.astype(np.int64)],
+            )
+        )
+        self.bins, self.from_nodes, self.to_nodes = keys
+        self.records, self.speed_sums, self.speed_records = values
+        return len(trip)
+
+    def _bin_labels(self, bins):
+        if self.period_seconds is not None:
+            return bins
+        return pd.to_datetime(bins * self.bin_seconds, unit="s")
+
+    def to_frame(self):
+        """
+        Aggregated segments
+
+        Returns:
+        pandas.DataFrame: seg_date (bin start, or bin number within the
+        period), from_node, to_node, records and speed (mean observed km/h,
+        NaN without observations)
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            speed = self.speed_sums / self.speed_records
+        return pd.DataFrame(
+            {
+                "seg_date": self._bin_labels(self.bins),
+                "from_node": self.from_nodes,
+                "to_node": self.to_nodes,
+                "records": self.records,
+                "speed": np.where(self.speed_records > 0, speed, np.nan),
+            }
+        )
+
+    def write_speed_files(self, path, min_records=1, min_speed=1):
+        """
+        Write one OSRM segment speed file per bin
+
+        Each file has one `from,to,speed` line per segment, no header nor
+        index, speed in integer km/h, as osrm-customize --segment-speed-file
+        expects (see restart_osrm_traffic.sh). Segments without observed
+        speed are left out.
+
+        Parameters:
+        path (str): file name with a {bin} placeholder, e.g. 'data/traffic_{bin}.csv'
+        min_records (int): leave out segments with fewer observed speeds
+        min_speed (int): lowest speed written. OSRM breaks with 0 km/h speeds
+
+        Returns:
+        dict: bin label -> file written
+        """
+        keep = (self.speed_records >= max(min_records, 1))
+        bins = self.bins[keep]
+        speed = np.maximum(np.round(self.speed_sums[keep] / self.speed_records[keep]), min_speed).astype(np.int64)
+        rows = np.column_stack([self.from_nodes[keep], self.to_nodes[keep], speed])
+
+        files = {}
+        unique_bins, starts = np.unique(bins, return_index=True)
+        ends = np.append(starts[1:], len(bins))
+        for bin_, label, start, end in zip(unique_bins, self._bin_labels(unique_bins), starts, ends):
+            name = label.strftime("%Y%m%d%H%M") if isinstance(label, pd.Timestamp) else str(label)
+            file_path = path.format(bin=name)
+            directory = os.path.dirname(file_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            np.savetxt(file_path, rows[start:end], fmt="%d", delimiter=",")
+            files[label] = file_path
+        return files
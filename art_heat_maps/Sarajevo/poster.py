@@ -0,0 +1,317 @@
+# To render very large posters of a street network with bounded memory
+import struct
+import zlib
+import numpy as np
+from multiprocessing import Pool
+from matplotlib.colors import to_rgba_array
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+
+###############################################################################
+#                     Tiled Poster Rendering                                   #
+###############################################################################
+# Radius of the Lanczos filter, in pixels of the final image
+LANCZOS_SUPPORT = 3
+
+# Extract edge segments
+def graph_segments(G, colors, widths):
+    """
+    Gets the straight segments of every edge of a street network
+
+    Parameters
+    ----------
+
+    G: networkx.MultiDiGraph,
+        OSMnx graph. Simplified edges are split along their 'geometry'.
+
+    colors, widths: list,
+        Color and line width (in pixels) of each edge, in G.edges order,
+        e.g. from annotator.edge_styles.
+
+    return: dict with lon1, lat1, lon2, lat2, color (RGB uint8) and width
+    arrays, one item per segment.
+    """
+    rgb = (to_rgba_array(colors)[:, :3] * 255).round().astype(np.uint8)
+    lons, lats, edge = [], [], []
+    for i, (u, v, data) in enumerate(G.edges(data = True)):
+        if 'geometry' in data:
+            x, y = data['geometry'].xy
+        else:
+            x = [G.nodes[u]['x'], G.nodes[v]['x']]
+            y = [G.nodes[u]['y'], G.nodes[v]['y']]
+        lons.append(np.asarray(x, dtype = float))
+        lats.append(np.asarray(y, dtype = float))
+        edge.append(np.full(len(x), i))
+
+    lon, lat, edge = np.concatenate(lons), np.concatenate(lats), np.concatenate(edge)
+    # a segment joins consecutive points of the same edge
+    start = np.flatnonzero(edge[:-1] == edge[1:])
+    return {
+        'lon1': lon[start], 'lat1': lat[start], 'lon2': lon[start + 1], 'lat2': lat[start + 1],
+        'color': rgb[edge[start]], 'width': np.asarray(widths, dtype = float)[edge[start]],
+    }
+
+# Streaming image writers
+class PNGStripWriter:
+    """
+    Writes an RGB PNG strip by strip, without holding the whole image
+    """
+
+    def __init__(self, path, width, height):
+        self.file = open(path, 'wb')
+        self.width = width
+        self.compressor = zlib.compressobj(6)
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+    def _chunk(self, kind, data):
+        self.file.write(struct.pack('>I', len(data)) + kind + data)
+        self.file.write(struct.pack('>I', zlib.crc32(kind + data) & 0xFFFFFFFF))
+
+    def write(self, rows):
+        # every scanline starts with its filter type, 0 (none)
+        scanlines = np.zeros((rows.shape[0], self.width * 3 + 1), dtype = np.uint8)
+        scanlines[:, 1:] = rows.reshape(rows.shape[0], -1)
+        data = self.compressor.compress(scanlines.tobytes())
+        if data:
+            self._chunk(b'IDAT', data)
+
+    def close(self):
+        self._chunk(b'IDAT', self.compressor.flush())
+        self._chunk(b'IEND', b'')
+        self.file.close()
+
+
+class TIFFStripWriter:
+    """
+    Writes an RGB TIFF strip by strip (deflate compressed), without holding
+    the whole image
+    """
+
+    def __init__(self, path, width, height):
+        self.file = open(path, 'wb')
+        self.width, self.height = width, height
+        self.offsets, self.byte_counts = [], []
+        self.rows_per_strip = None
+        # header, the first IFD offset is written on close
+        self.file.write(b'II*\x00\x00\x00\x00\x00')
+
+    def write(self, rows):
+        if self.rows_per_strip is None:
+            self.rows_per_strip = rows.shape[0]
+        data = zlib.compress(rows.tobytes(), 6)
+        self.offsets.append(self.file.tell())
+        self.byte_counts.append(len(data))
+        self.file.write(data)
+
+    def close(self):
+        if self.file.tell() % 2:
+            self.file.write(b'\x00')
+        n = len(self.offsets)
+        arrays_offset = self.file.tell()
+        self.file.write(struct.pack('<3H', 8, 8, 8))
+        self.file.write(struct.pack(f'<{n}I', *self.offsets))
+        self.file.write(struct.pack(f'<{n}I', *self.byte_counts))
+        bits_offset, offsets_offset, counts_offset = arrays_offset, arrays_offset + 6, arrays_offset + 6 + 4 * n
+
+        ifd_offset = self.file.tell()
+        tags = [
+            (256, 4, 1, self.width),                    # ImageWidth
+            (257, 4, 1, self.height),                   # ImageLength
+            (258, 3, 3, bits_offset),                   # BitsPerSample
+            (259, 3, 1, 8),                             # Compression: deflate
+            (262, 3, 1, 2),                             # PhotometricInterpretation: RGB
+            (273, 4, n, offsets_offset if n > 1 else self.offsets[0]),  # StripOffsets
+            (277, 3, 1, 3),                             # SamplesPerPixel
+            (278, 4, 1, self.rows_per_strip),           # RowsPerStrip
+            (279, 4, n, counts_offset if n > 1 else self.byte_counts[0]),  # StripByteCounts
+            (284, 3, 1, 1),                             # PlanarConfiguration: contiguous
+        ]
+        self.file.write(struct.pack('<H', len(tags)))
+        for tag, kind, count, value in tags:
+            if kind == 3 and count == 1:
+                self.file.write(struct.pack('<HHIHH', tag, kind, count, value, 0))
+            else:
+                self.file.write(struct.pack('<HHII', tag, kind, count, value))
+        self.file.write(struct.pack('<I', 0))
+        self.file.seek(4)
+        self.file.write(struct.pack('<I', ifd_offset))
+        self.file.close()
+
+# Render poster
+def render_poster(segments, output_image, bbox, width = 12000, height = None, bgcolor = '#061529',
+                  fill = '#e0474c', bottom = 800, left = None, right = None, top = None,
+                  texts = None, tile_size = 1024, supersample = 2):
+    """
+    Renders a street network poster tile by tile and writes it strip by strip
+
+    Segments are projected to pixels once and indexed by the tiles they
+    cross, so each tile only draws its own segments. The border and the
+    texts are drawn on each tile as well, so the full image is never held
+    in memory: peak memory is one strip of tiles, whatever the poster size.
+
+    Parameters
+    ----------
+
+    segments: dict,
+        Segments to draw, from graph_segments.
+
+    output_image: str,
+        Output file name, .png or .tif/.tiff.
+
+    bbox: tuple,
+        (north, south, east, west) of the map, as in ox.plot_graph.
+
+    width, height: int,
+        Size of the map in pixels, without the border. Default height keeps
+        the map aspect at the center latitude.
+
+    bgcolor: str,
+        Map background color.
+
+    fill: str,
+        Hex code for border color. Default is set to reddish.
+
+    bottom, left, right, top: int,
+        Integer object specifying the border with in pixels.
+
+    texts: list,
+        (x, y, text, color, font file, font size) to draw, in pixels of the
+        final image, e.g. [(900, 9200, 'SARAJEVO, BOSNIA', '#ffffff', 'PMINGLIU.ttf', 650)].
+        Use None as font file for PIL's default font.
+
+    tile_size: int,
+        Tile side in pixels.
+
+    supersample: int,
+        Tiles are drawn this many times larger and scaled down, for smooth lines.
+    """
+    if left == None:
+        left = 0
+    if right == None:
+        right = 0
+    if top == None:
+        top = 0
+    north, south, east, west = bbox
+    if height == None:
+        aspect = (north - south) / ((east - west) * np.cos(np.radians((north + south) / 2)))
+        height = int(round(width * aspect))
+
+    total_width, total_height = left + width + right, top + height + bottom
+    fonts = [(x, y, text, ImageColor.getrgb(color),
+              ImageFont.truetype(font, size) if font is not None else ImageFont.load_default())
+             for x, y, text, color, font, size in (texts or [])]
+
+    # segments in pixels of the final image
+    x1 = left + (segments['lon1'] - west) / (east - west) * width
+    x2 = left + (segments['lon2'] - west) / (east - west) * width
+    y1 = top + (north - segments['lat1']) / (north - south) * height
+    y2 = top + (north - segments['lat2']) / (north - south) * height
+    # tiles are drawn with a margin wider than the lines and the Lanczos
+    # support, then cropped, so the image does not depend on tile_size
+    pad = int(np.ceil(np.max(segments['width'], initial = 0))) + LANCZOS_SUPPORT + 1
+    index = _tile_index(x1, y1, x2, y2, segments['width'], tile_size, total_width, total_height, pad)
+    colors = [tuple(color) for color in segments['color'].tolist()]
+
+    writer_class = TIFFStripWriter if output_image.lower().endswith(('.tif', '.tiff')) else PNGStripWriter
+    writer = writer_class(output_image, total_width, total_height)
+    n_cols = int(np.ceil(total_width / tile_size))
+    map_box = (left, top, left + width, top + height)
+    try:
+        for row_start in range(0, total_height, tile_size):
+            strip_height = min(tile_size, total_height - row_start)
+            strip = np.empty((strip_height, total_width, 3), dtype = np.uint8)
+            for col in range(n_cols):
+                col_start = col * tile_size
+                tile_width = min(tile_size, total_width - col_start)
+                ix = index.get((row_start // tile_size) * n_cols + col, [])
+                tile = _render_tile(col_start, row_start, tile_width, strip_height, x1[ix], y1[ix], x2[ix], y2[ix],
+                                    [colors[i] for i in ix], segments['width'][ix], map_box, bgcolor, fill,
+                                    fonts, supersample, pad)
+                strip[:, col_start:col_start + tile_width] = np.asarray(tile)
+            writer.write(strip)
+    finally:
+        writer.close()
+
+def _tile_index(x1, y1, x2, y2, widths, tile_size, total_width, total_height, pad = 0):
+    """Segments crossing each tile or its pad, from their bounding box: {tile: array of segments}"""
+    margin = np.asarray(widths) / 2 + 1 + pad
+    n_cols, n_rows = int(np.ceil(total_width / tile_size)), int(np.ceil(total_height / tile_size))
+    col_min = np.clip(np.floor((np.minimum(x1, x2) - margin) / tile_size), 0, n_cols - 1).astype(np.int64)
+    col_max = np.clip(np.floor((np.maximum(x1, x2) + margin) / tile_size), 0, n_cols - 1).astype(np.int64)
+    row_min = np.clip(np.floor((np.minimum(y1, y2) - margin) / tile_size), 0, n_rows - 1).astype(np.int64)
+    row_max = np.clip(np.floor((np.maximum(y1, y2) + margin) / tile_size), 0, n_rows - 1).astype(np.int64)
+    # segments entirely outside the image are dropped
+    visible = (np.maximum(x1, x2) + margin >= 0) & (np.minimum(x1, x2) - margin < total_width) \
+        & (np.maximum(y1, y2) + margin >= 0) & (np.minimum(y1, y2) - margin < total_height)
+
+    segment, tiles = [], []
+    for dr in range(int((row_max - row_min).max(initial = 0)) + 1):
+        for dc in range(int((col_max - col_min).max(initial = 0)) + 1):
+            ok = visible & (row_min + dr <= row_max) & (col_min + dc <= col_max)
+            segment.append(np.flatnonzero(ok))
+            tiles.append((row_min[ok] + dr) * n_cols + col_min[ok] + dc)
+    segment, tiles = np.concatenate(segment), np.concatenate(tiles)
+    order = np.argsort(tiles, kind = 'stable')
+    segment, tiles = segment[order], tiles[order]
+    # draw in the original order, so overlaps look as in a single plot
+    keys, starts = np.unique(tiles, return_index = True)
+    return {key: np.sort(part) for key, part in zip(keys.tolist(), np.split(segment, starts[1:]))}
+
+def _render_tile(x0, y0, tile_width, tile_height, x1, y1, x2, y2, colors, widths, map_box, bgcolor, fill,
+                 fonts, supersample, pad = 0):
+    """Draws one tile: border, map background, segments and texts, with pad pixels around cropped away"""
+    s = supersample
+    x0, y0 = x0 - pad, y0 - pad
+    padded_width, padded_height = tile_width + 2 * pad, tile_height + 2 * pad
+    tile = Image.new('RGB', (padded_width * s, padded_height * s), ImageColor.getrgb(fill))
+    draw = ImageDraw.Draw(tile)
+    map_left, map_top, map_right, map_bottom = [(v - o) * s for v, o in zip(map_box, (x0, y0, x0, y0))]
+    draw.rectangle([map_left, map_top, map_right - 1, map_bottom - 1], fill = ImageColor.getrgb(bgcolor))
+
+    # endpoints are rounded in image pixels before moving to the tile: PIL
+    # truncates negative coordinates, which would shift lines leaving a tile
+    # by its left or top side
+    start_x, start_y = np.round(x1 * s) - x0 * s, np.round(y1 * s) - y0 * s
+    end_x, end_y = np.round(x2 * s) - x0 * s, np.round(y2 * s) - y0 * s
+    for a, b, c, d, color, width in zip(start_x, start_y, end_x, end_y, colors, widths):
+        draw.line([(a, b), (c, d)], fill = color, width = max(1, int(round(width * s))))
+
+    # the border hides what the lines draw outside the map
+    border = ImageColor.getrgb(fill)
+    full_width, full_height = padded_width * s, padded_height * s
+    for box in ([0, 0, full_width, map_top - 1], [0, map_bottom, full_width, full_height],
+                [0, 0, map_left - 1, full_height], [map_right, 0, full_width, full_height]):
+        if box[2] >= box[0] and box[3] >= box[1]:
+            draw.rectangle(box, fill = border)
+
+    if s > 1:
+        tile = tile.resize((padded_width, padded_height), Image.LANCZOS)
+    tile = tile.crop((pad, pad, pad + tile_width, pad + tile_height))
+    # texts are drawn at the final resolution, on every tile they cross
+    draw = ImageDraw.Draw(tile)
+    for x, y, text, color, font in fonts:
+        draw.text((x - x0 - pad, y - y0 - pad), text, color, font = font)
+    return tile
+
+def _render_job(kwargs):
+    render_poster(**kwargs)
+    return kwargs['output_image']
+
+# Render many posters
+def render_many(jobs, processes = 4):
+    """
+    Renders several posters in parallel
+
+    Parameters
+    ----------
+
+    jobs: list,
+        render_poster keyword arguments of each poster.
+
+    processes: int,
+        Worker processes. Memory per process is bounded by a strip of tiles.
+
+    return: list of output image names.
+    """
+    with Pool(processes) as pool:
+        return pool.map(_render_job, jobs)